@@ -23,7 +23,7 @@ class Headers:
     def __init__(self):
         self.style = {'description_width': 'initial'}
 
-        self.start_list = ['...', 'View', 'Add', 'Update', 'Delete']
+        self.start_list = ['...', 'View', 'Add', 'Update', 'Delete', 'Import']
 
         self.table_choice = ['...', 'Projects', 'Reagents', 'Consumables', 'Project_Standards']
 
@@ -0,0 +1,221 @@
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from db_control.db_pool import POOL_MAX_CONN, POOL_MIN_CONN, get_pool
+
+try:
+    import ipywidgets as ipw
+except ImportError:
+    ipw = None
+
+# psycopg 3 runs queries natively on the event loop; without it they run on the shared psycopg2 pool in threads
+try:
+    from psycopg.conninfo import make_conninfo
+    from psycopg_pool import AsyncConnectionPool
+except ImportError:
+    make_conninfo = None
+    AsyncConnectionPool = None
+
+# One worker per pooled connection, more would only wait for a free connection
+QUERY_EXECUTOR = ThreadPoolExecutor(max_workers=POOL_MAX_CONN, thread_name_prefix="db-query")
+CANCEL_LOCK = threading.Lock()
+# psycopg 3 pools shared per set of connection params, like DB_POOLS; each entry is the task opening the pool
+ASYNC_POOLS = {}
+
+SPINNER_HTML = "<i class='fa fa-spinner fa-spin'></i> Querying database..."
+
+
+def conninfo(params):
+    # database.ini uses psycopg2's "database" alias, libpq only knows "dbname"
+    params = dict(params)
+    if 'database' in params:
+        params['dbname'] = params.pop('database')
+    return make_conninfo(**params)
+
+
+async def open_async_pool(params, pool_key):
+    try:
+        pool = AsyncConnectionPool(conninfo(params), min_size=POOL_MIN_CONN, max_size=POOL_MAX_CONN, open=False)
+        await pool.open()
+    except Exception:
+        # The next query tries again instead of getting the same error forever
+        ASYNC_POOLS.pop(pool_key, None)
+        raise
+    return pool
+
+
+async def close_async_pools():
+    openings = list(ASYNC_POOLS.values())
+    ASYNC_POOLS.clear()
+    for opening in openings:
+        if opening.done() and opening.exception() is None:
+            await opening.result().close()
+
+
+class AsyncDb:
+    """
+    Read queries that can be awaited from the notebook's event loop. With psycopg 3 and psycopg_pool installed
+    they run on an AsyncConnectionPool, otherwise on the shared psycopg2 DbPool in worker threads (so they are
+    still timed by QUERY_STATS). In the threaded case cancelling the awaiting task also cancels the statement on
+    the server, since the worker thread itself can't be interrupted.
+    """
+    def __init__(self, params):
+        self.params = params
+        self.pool = get_pool(params)
+
+    async def get_async_pool(self):
+        # The pool belongs to the loop it was opened on, so it is only created once a loop is running.
+        # Queries started while it opens wait for the same opening, shielded so a cancelled query doesn't stop it
+        pool_key = tuple(sorted(self.params.items()))
+        opening = ASYNC_POOLS.get(pool_key)
+        if opening is None:
+            opening = asyncio.ensure_future(open_async_pool(self.params, pool_key))
+            ASYNC_POOLS[pool_key] = opening
+        return await asyncio.shield(opening)
+
+    async def query(self, query, params=None):
+        # Rows of a SELECT, None for a statement that returns nothing
+        if AsyncConnectionPool is not None:
+            pool = await self.get_async_pool()
+            async with pool.connection() as conn:
+                cur = await conn.execute(query, params)
+                return await cur.fetchall() if cur.description is not None else None
+        return await self.query_in_thread(query, params)
+
+    async def gather(self, *queries):
+        """
+        Runs independent queries at the same time, each on its own connection. queries are query strings or
+        (query, params) tuples; the results come back in the same order.
+        """
+        return await asyncio.gather(*[
+            self.query(query) if isinstance(query, str) else self.query(*query) for query in queries
+        ])
+
+    async def query_in_thread(self, query, params):
+        running = {}
+        future = asyncio.get_running_loop().run_in_executor(QUERY_EXECUTOR, self.run_query, query, params, running)
+        try:
+            return await future
+        except asyncio.CancelledError:
+            with CANCEL_LOCK:
+                conn = running.get('conn')
+                if conn is not None:
+                    conn.cancel()
+            raise
+
+    def run_query(self, query, params, running):
+        with self.pool.connection() as conn:
+            with CANCEL_LOCK:
+                running['conn'] = conn
+            try:
+                with conn.cursor() as cur:
+                    cur.execute(query, params)
+                    return cur.fetchall() if cur.description is not None else None
+            finally:
+                with CANCEL_LOCK:
+                    running.pop('conn', None)
+
+
+def kernel_loop():
+    # Notebook cells and widget callbacks run on ipykernel's asyncio loop; a plain script gets its own loop
+    try:
+        return asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.new_event_loop()
+
+
+class QueryRunner:
+    """
+    Runs database coroutines for widget callbacks without blocking the kernel. Every job has a key, and
+    scheduling a key again cancels the job still running under it, so only the result for the latest inputs
+    is shown. While any job runs the status widget shows a spinner, and a failed job leaves its error there.
+    schedule() can be called from any thread, e.g. from a debounced ReactiveGraph update. Outside a running
+    loop (a plain script) jobs run to completion right away.
+    """
+    def __init__(self, status=None, loop=None):
+        self.loop = loop if loop is not None else kernel_loop()
+        self.status = status if status is not None else (ipw.HTML() if ipw is not None else None)
+        self.tasks = {}
+        # Latest scheduled and latest finished generation per key, a key is busy while they differ
+        self.generations = {}
+        self.finished = {}
+        self.lock = threading.Lock()
+
+    def schedule(self, key, func, *args, on_done=None):
+        """
+        Runs the coroutine function func(*args) under key; on_done(result) is called on the loop afterwards
+        unless the job was superseded or cancelled in the meantime.
+        """
+        with self.lock:
+            generation = self.generations.get(key, 0) + 1
+            self.generations[key] = generation
+        if self.loop.is_running():
+            self.loop.call_soon_threadsafe(self.start, key, generation, func, args, on_done)
+        else:
+            self.show_status()
+            self.loop.run_until_complete(self.run(key, generation, func, args, on_done))
+
+    def start(self, key, generation, func, args, on_done):
+        if not self.is_current(key, generation):
+            # Superseded before it got to start
+            return
+        previous = self.tasks.get(key)
+        if previous is not None:
+            previous.cancel()
+        self.tasks[key] = self.loop.create_task(self.run(key, generation, func, args, on_done))
+        self.show_status()
+
+    async def run(self, key, generation, func, args, on_done):
+        try:
+            result = await func(*args)
+        except asyncio.CancelledError:
+            raise
+        except Exception as error:
+            if self.is_current(key, generation):
+                self.finish(key, generation)
+                self.show_status(error)
+            return
+        if self.is_current(key, generation):
+            self.finish(key, generation)
+            if on_done is not None:
+                on_done(result)
+            self.show_status()
+
+    def is_current(self, key, generation):
+        with self.lock:
+            return self.generations.get(key) == generation
+
+    def finish(self, key, generation):
+        with self.lock:
+            self.finished[key] = generation
+        self.tasks.pop(key, None)
+
+    def busy(self, key=None):
+        with self.lock:
+            keys = [key] if key is not None else list(self.generations)
+            return any(self.generations.get(name, 0) != self.finished.get(name, 0) for name in keys)
+
+    def cancel(self, key=None):
+        # Drops one job (or all of them) including ones that are scheduled but not started yet
+        with self.lock:
+            keys = [key] if key is not None else list(self.generations)
+            for name in keys:
+                generation = self.generations.get(name, 0) + 1
+                self.generations[name] = generation
+                self.finished[name] = generation
+        for name in keys:
+            task = self.tasks.pop(name, None)
+            if task is not None:
+                task.cancel()
+        self.show_status()
+
+    def show_status(self, error=None):
+        if self.status is None:
+            return
+        if error is not None:
+            message_split = str(error).split('DETAIL:')
+            self.status.value = 'ERROR: ' + '<br>'.join(message_split)
+        elif self.busy():
+            self.status.value = SPINNER_HTML
+        else:
+            self.status.value = ''
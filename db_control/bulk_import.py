@@ -0,0 +1,285 @@
+import argparse
+import io
+import os
+import sys
+import pandas as pd
+from config import config, Headers
+from db_control.db_pool import get_pool
+
+HEADERS = Headers()
+# Columns a file can fill per table as (column, inventory form header); the id columns are generated
+IMPORT_TABLES = dict(
+    reagents=list(zip(HEADERS.reagent_query_cols[1:], HEADERS.reagent_cols)),
+    consumables=list(zip(HEADERS.consumable_query_cols[1:], HEADERS.consumable_cols))
+)
+NAME_COLS = dict(reagents='reagent', consumables='item')
+# A vendor's catalogue number identifies an item, rows matching an existing one update it
+CONFLICT_COLS = ('vendor', 'cat_num')
+EXCEL_SUFFIXES = ('.xlsx', '.xlsm')
+# Files have a header row, so the first data row is line 2
+FIRST_LINE = 2
+
+NUMBER_PATTERN = r'^[-+]?([0-9]+\.?[0-9]*|\.[0-9]+)([eE][-+]?[0-9]+)?$'
+NUMERIC_TYPES = ('smallint', 'integer', 'bigint', 'numeric', 'real', 'double precision')
+
+# Unique, non-partial indexes of a table covering exactly the conflict columns, ON CONFLICT needs one
+IMPORT_KEY_QUERY = """
+    SELECT indexrelid::regclass::text
+    FROM pg_index
+    WHERE indrelid = %(table)s::regclass AND indisunique AND indisvalid AND indpred IS NULL
+    AND indnatts = cardinality(%(columns)s::text[])
+    AND (
+        SELECT array_agg(attname::text ORDER BY attname)
+        FROM pg_attribute
+        WHERE attrelid = indrelid AND attnum = ANY(indkey)
+    ) = (SELECT array_agg(column_name ORDER BY column_name) FROM unnest(%(columns)s::text[]) AS column_name)
+"""
+
+COLUMN_TYPES_QUERY = """
+    SELECT attname, format_type(atttypid, atttypmod)
+    FROM pg_attribute
+    WHERE attrelid = %s::regclass AND attnum > 0 AND NOT attisdropped
+"""
+
+
+class ImportResult:
+    def __init__(self, table, rows, inserted=0, updated=0, rejected=None):
+        self.table = table
+        self.rows = rows
+        self.inserted = inserted
+        self.updated = updated
+        # (file line, reason) of every row that was left out
+        self.rejected = rejected or []
+
+    def summary(self):
+        return (
+            f"{self.table}: {self.rows} rows read, {self.inserted} added, {self.updated} updated, "
+            f"{len(self.rejected)} rejected"
+        )
+
+
+def read_import_file(source, file_name=None):
+    """
+    Rows of a CSV or Excel file as strings, with file line numbers as the index. source is a path or a file
+    object (then file_name tells the format). Values stay text so that Postgres, not pandas, decides what
+    parses as a number.
+    """
+    file_name = file_name or (source if isinstance(source, str) else "")
+    if file_name.lower().endswith(EXCEL_SUFFIXES):
+        frame = pd.read_excel(source, dtype=str, engine='openpyxl')
+    else:
+        # utf-8-sig drops the byte order mark Excel puts in front of CSV exports
+        frame = pd.read_csv(source, dtype=str, keep_default_na=False, skipinitialspace=True, encoding='utf-8-sig')
+    frame = frame.fillna("")
+    frame.index = range(FIRST_LINE, FIRST_LINE + len(frame))
+    return frame
+
+
+def import_rows(table, frame):
+    """
+    The file's columns in table column order. Headers can be either the inventory form's headers
+    (e.g. 'Category Number') or the column names (cat_num), in any case; other columns are ignored.
+    """
+    if table not in IMPORT_TABLES:
+        raise KeyError(f"Bulk import is not available for {table}")
+    by_header = {}
+    for column, header in IMPORT_TABLES[table]:
+        by_header[column.lower()] = column
+        by_header[header.lower()] = column
+    renamed = {}
+    for name in frame.columns:
+        column = by_header.get(str(name).strip().lower())
+        if column is not None and column not in renamed.values():
+            renamed[name] = column
+    frame = frame[list(renamed)].rename(columns=renamed)
+    missing = [column for column in (NAME_COLS[table],) + CONFLICT_COLS if column not in frame.columns]
+    if missing:
+        raise ValueError(f"Import file has no {', '.join(missing)} column")
+    columns = [column for column, header in IMPORT_TABLES[table] if column in frame.columns]
+    return frame[columns]
+
+
+def column_casts(cur, table, columns):
+    # Staged text is cast to the real column types; numbers go through numeric so '12.0' still fits an integer
+    cur.execute(COLUMN_TYPES_QUERY, (table,))
+    column_types = dict(cur.fetchall())
+    casts = {}
+    for column in columns:
+        column_type = column_types[column]
+        if column_type.split('(')[0] in NUMERIC_TYPES:
+            casts[column] = (f"::numeric::{column_type}", True)
+        else:
+            casts[column] = (f"::{column_type}", False)
+    return casts
+
+
+def reject_query(table, columns, casts):
+    # Marks rows with an empty key or a value that isn't a number, then every earlier repeat of a vendor/cat_num
+    # (a single upsert can't update the same row twice, the last line wins)
+    checks = [
+        f"WHEN NULLIF(trim({column}), '') IS NULL THEN '{column} is empty'"
+        for column in (NAME_COLS[table],) + CONFLICT_COLS
+    ] + [
+        f"WHEN NULLIF(trim({column}), '') !~ '{NUMBER_PATTERN}' THEN '{column} is not a number: ' || {column}"
+        for column in columns if casts[column][1]
+    ]
+    newline = "\n                "
+    return f"""
+        WITH invalid AS (
+            SELECT line, CASE
+                {newline.join(checks)}
+            END AS reason
+            FROM import_staging
+        ),
+        repeated AS (
+            SELECT line, max(line) OVER (PARTITION BY trim(vendor), trim(cat_num)) AS last_line
+            FROM import_staging
+            INNER JOIN invalid USING (line)
+            WHERE invalid.reason IS NULL
+        ),
+        rejects AS (
+            SELECT line, reason FROM invalid WHERE reason IS NOT NULL
+            UNION ALL
+            SELECT line, 'vendor/cat_num repeated on line ' || last_line FROM repeated WHERE line < last_line
+        )
+        UPDATE import_staging
+        SET reject = rejects.reason
+        FROM rejects
+        WHERE import_staging.line = rejects.line
+        RETURNING import_staging.line, rejects.reason
+    """
+
+
+def upsert_query(table, columns, casts, add_on_hand):
+    values = [f"NULLIF(trim({column}), ''){casts[column][0]}" for column in columns]
+    updates = []
+    for column in columns:
+        if column in CONFLICT_COLS:
+            continue
+        if column == 'on_hand' and add_on_hand:
+            # A shipment adds to the stock already there
+            updates.append("on_hand = COALESCE(target.on_hand, 0) + COALESCE(EXCLUDED.on_hand, 0)")
+        else:
+            # Blank cells keep the current value
+            updates.append(f"{column} = COALESCE(EXCLUDED.{column}, target.{column})")
+    return f"""
+        INSERT INTO {table} AS target ({', '.join(columns)})
+        SELECT {', '.join(values)}
+        FROM import_staging
+        WHERE reject IS NULL
+        ORDER BY line
+        ON CONFLICT ({', '.join(CONFLICT_COLS)}) DO UPDATE
+        SET {', '.join(updates)}
+        RETURNING xmax = 0
+    """
+
+
+def duplicate_keys_query(table):
+    return f"""
+        SELECT {', '.join(CONFLICT_COLS)}, count(*)
+        FROM {table}
+        GROUP BY {', '.join(CONFLICT_COLS)}
+        HAVING count(*) > 1
+        ORDER BY {', '.join(CONFLICT_COLS)}
+    """
+
+
+def has_import_key(cur, table):
+    cur.execute(IMPORT_KEY_QUERY, dict(table=table, columns=list(CONFLICT_COLS)))
+    return cur.fetchone() is not None
+
+
+def create_import_keys(conn):
+    """
+    One-off setup: adds the unique vendor + cat_num index bulk_import upserts on to every import table. Existing
+    items that repeat a vendor/cat_num have to be merged first, they are listed in the error.
+    """
+    with conn.cursor() as cur:
+        for table in IMPORT_TABLES:
+            if has_import_key(cur, table):
+                continue
+            cur.execute(duplicate_keys_query(table))
+            duplicates = cur.fetchall()
+            if duplicates:
+                raise ValueError(f"{table} has items sharing a vendor/cat_num, merge them before adding the key: " + (
+                    "; ".join(f"{vendor} {cat_num} ({count} rows)" for vendor, cat_num, count in duplicates)
+                ))
+            cur.execute(f"CREATE UNIQUE INDEX {table}_vendor_cat_num ON {table} ({', '.join(CONFLICT_COLS)})")
+
+
+def bulk_import(conn, table, source, file_name=None, add_on_hand=True):
+    """
+    Loads a CSV or Excel file of reagents or consumables in one transaction on conn. The rows are streamed with
+    COPY into a temporary staging table, checked there, and upserted on vendor + cat_num with a single
+    INSERT ... ON CONFLICT: new items are added, existing ones get the file's non-blank values and, with
+    add_on_hand, the file's on_hand added to their stock. Rejected rows are skipped and reported with their
+    file line; anything else that fails rolls the whole file back. The table needs the vendor + cat_num key added
+    once by create_import_keys (python -m db_control.bulk_import --create-keys).
+    """
+    table = table.lower()
+    rows = import_rows(table, read_import_file(source, file_name))
+    columns = list(rows.columns)
+    if rows.empty:
+        return ImportResult(table, 0)
+
+    buffer = io.StringIO()
+    rows.to_csv(buffer, header=False, index=True)
+    buffer.seek(0)
+
+    with conn.cursor() as cur:
+        if not has_import_key(cur, table):
+            raise ValueError(
+                f"{table} has no unique index on {', '.join(CONFLICT_COLS)} to import on, "
+                f"run 'python -m db_control.bulk_import --create-keys' once first"
+            )
+        casts = column_casts(cur, table, columns)
+        cur.execute(f"""
+            CREATE TEMP TABLE import_staging (
+                line INTEGER PRIMARY KEY, {', '.join(f'{column} TEXT' for column in columns)}, reject TEXT
+            ) ON COMMIT DROP
+        """)
+        cur.copy_expert(
+            f"COPY import_staging (line, {', '.join(columns)}) FROM STDIN WITH (FORMAT csv)", buffer
+        )
+        cur.execute(reject_query(table, columns, casts))
+        rejected = sorted(cur.fetchall())
+        cur.execute(upsert_query(table, columns, casts, add_on_hand))
+        inserted_flags = [row[0] for row in cur.fetchall()]
+
+    inserted = sum(inserted_flags)
+    return ImportResult(table, len(rows), inserted, len(inserted_flags) - inserted, rejected)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Bulk import reagents or consumables from a CSV or Excel file.")
+    parser.add_argument("table", nargs="?", choices=sorted(IMPORT_TABLES), help="inventory table to load into")
+    parser.add_argument("file", nargs="?", help="CSV or .xlsx file, one row per item")
+    parser.add_argument(
+        "--create-keys", action="store_true",
+        help="one-off setup: add the unique vendor/cat_num index the import needs to each table"
+    )
+    parser.add_argument(
+        "--replace-on-hand", action="store_true",
+        help="set on_hand of existing items to the file's value instead of adding to it"
+    )
+    args = parser.parse_args(argv)
+
+    if args.create_keys:
+        with get_pool(config()).connection() as conn:
+            create_import_keys(conn)
+        print(f"vendor/cat_num keys ready on {', '.join(IMPORT_TABLES)}")
+        return 0
+    if args.table is None or args.file is None:
+        parser.error("table and file are required unless --create-keys is given")
+    if not os.path.exists(args.file):
+        parser.error(f"{args.file} not found")
+    with get_pool(config()).connection() as conn:
+        result = bulk_import(conn, args.table, args.file, add_on_hand=not args.replace_on_hand)
+    print(result.summary())
+    for line, reason in result.rejected:
+        print(f"  line {line}: {reason}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
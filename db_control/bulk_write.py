@@ -0,0 +1,69 @@
+from psycopg2.extras import execute_values
+from db_control.bulk_import import COLUMN_TYPES_QUERY
+
+# Column types per table, looked up once per process so every later bulk write is a single statement
+COLUMN_TYPES = {}
+
+
+def column_types(cur, table):
+    types = COLUMN_TYPES.get(table)
+    if types is None:
+        cur.execute(COLUMN_TYPES_QUERY, (table,))
+        types = dict(cur.fetchall())
+        COLUMN_TYPES[table] = types
+    return types
+
+
+def form_value(value):
+    # The inventory tables show NULL as 'None'
+    return None if value == 'None' else value
+
+
+def checked_rows(data):
+    # Cell values of the table rows whose checkbox (the last cell) is ticked
+    return [
+        tuple(form_value(box.value) for box in row.children[:-1])
+        for row in data if row.children[-1].value
+    ]
+
+
+def update_rows(cur, table, columns, rows, returning):
+    """
+    Writes every row with one UPDATE ... FROM (VALUES ...) matched on the first column. The text from the form
+    is cast to the column types in the VALUES list. Returns (key, returning column) of the rows updated.
+    """
+    if not rows:
+        return []
+    table = table.lower()
+    types = column_types(cur, table)
+    key = columns[0]
+    template = "(" + ", ".join(f"%s::{types[column]}" for column in columns) + ")"
+    set_string = ", ".join(f"{column} = update_data.{column}" for column in columns[1:])
+    # page_size covers all rows so execute_values sends a single statement
+    return execute_values(cur, f"""
+        UPDATE {table}
+        SET {set_string}
+        FROM (VALUES %s) AS update_data ({', '.join(columns)})
+        WHERE {table}.{key} = update_data.{key}
+        RETURNING {table}.{key}, {table}.{returning}
+    """, rows, template=template, page_size=len(rows), fetch=True)
+
+
+def delete_rows(cur, table, key, ids):
+    # Deletes every id with one DELETE ... = ANY(array), returns the ids that were there
+    if not ids:
+        return []
+    table = table.lower()
+    types = column_types(cur, table)
+    cur.execute(f"""
+        DELETE FROM {table}
+        WHERE {key} = ANY(%s::{types[key]}[])
+        RETURNING {key}
+    """, (list(ids),))
+    return [row[0] for row in cur.fetchall()]
+
+
+def missing_keys(keys, found):
+    # Requested keys with no matching row, compared as text since the form's keys are strings
+    found = {str(key) for key in found}
+    return [key for key in keys if str(key) not in found]
@@ -2,6 +2,10 @@ import psycopg2 as pg2
 import ipywidgets as ipw
 from IPython.display import display
 from config import config
+from db_control.async_db import AsyncDb, QueryRunner
+from db_control.bulk_write import checked_rows, delete_rows, missing_keys, update_rows
+from db_control.db_pool import get_pool
+from protocol_control.reactive import ReactiveGraph
 
 # This establishes the connection to the inventory_tracker database
 # PARAMS = config()
@@ -24,21 +28,19 @@ PROJECT_COLS_QUERY = ['proj_id', 'proj_name']
 class Db:
     def __init__(self, params):
         self.params = params
-        self.__connect()
-
-    def __connect(self):
-        self.conn = pg2.connect(**self.params)
+        self.pool = get_pool(self.params)
 
     def close(self):
-        self.conn.close()
+        # Connections go back to the shared pool after every call, nothing is held open per Db
+        pass
 
     def choose_project(self):
         """
         This function is called to create a select query from the database, pulling the known projects,
         creating a dictionary, and passing the dictionary back to the original function
         """
-        with self.conn:
-            cur = self.conn.cursor()
+        with self.pool.connection() as conn:
+            cur = conn.cursor()
             select_query = f"""
             SELECT * FROM projects
             """
@@ -50,42 +52,32 @@ class Db:
         return proj_dict
 
     def update_table(self, data, table, query_header, message):
-        row_to_update = []
-        return_value = []
-        update_count = 0
-        for row in data:
-            if row.children[-1].value:
-                update_list = tuple([box.value for box in row.children[:-1]])
-                row_to_update.append(update_list)
-        with self.conn:
-            cur = self.conn.cursor()
-            for row in row_to_update:
-                proj_dict = dict(zip(query_header.split(','), row))
-                query_set = [f"{key} = '{value}'" for (key, value) in proj_dict.items()]
-                set_string = ', '.join(query_set[1:])
-                update_query = f"""
-                    UPDATE {table.lower()}
-                    SET {set_string}
-                    WHERE {query_header.split(',')[0]} = {row[0]}
-                    RETURNING on_hand
-                """
-                try:
-                    cur.execute(update_query)
-                except (Exception, pg2.DatabaseError) as error:
-                    message_split = error.args[0].split('DETAIL:')
-                    message.children = [ipw.HTML('ERROR:')] + [
-                        ipw.HTML(f'{msg}') for msg in message_split
-                    ]
-                else:
-                    message.children = [ipw.HTML('<b>Update(s) made!</b>')]
-                    return_value.append(cur.fetchone()[0])
-                    update_count += cur.rowcount
-                    self.conn.commit()
-            return return_value, update_count
+        # Every checked row in one statement and one transaction, reported row by row
+        row_to_update = checked_rows(data)
+        if not row_to_update:
+            message.children = [ipw.HTML('No rows checked to update.')]
+            return [], 0
+        columns = [column.strip() for column in query_header.split(',')]
+        try:
+            with self.pool.connection() as conn:
+                updated = update_rows(conn.cursor(), table, columns, row_to_update, columns[-1])
+        except (Exception, pg2.DatabaseError) as error:
+            message_split = str(error).split('DETAIL:')
+            message.children = [ipw.HTML('ERROR: no rows were updated.')] + [
+                ipw.HTML(f'{msg}') for msg in message_split
+            ]
+            return [], 0
+        not_found = missing_keys([row[0] for row in row_to_update], [key for key, value in updated])
+        message.children = [ipw.HTML(f'<b>Update(s) made! {len(updated)} row(s) updated.</b>')] + [
+            ipw.HTML(f'{columns[0]} {key}: {columns[-1]} is now {value}') for key, value in updated
+        ] + [
+            ipw.HTML(f'{columns[0]} {key}: not found') for key in not_found
+        ]
+        return [value for key, value in updated], len(updated)
 
     def insert_to_cons_reag(self, table, query_header, data, message):
-        with self.conn:
-            cur = self.conn.cursor()
+        with self.pool.connection() as conn:
+            cur = conn.cursor()
             insert_query = f"""
             INSERT INTO {table.lower()} ({', '.join(query_header[1:])})
             VALUES {str(tuple([box.value for box in data]))}
@@ -98,14 +90,14 @@ class Db:
                     ipw.HTML(f'{message}') for message in message_split
                 ]
             else:
-                self.conn.commit()
+                conn.commit()
                 message.children = [ipw.HTML(f'{table} added!</b>')]
 
     def insert_to_standards(self, table, project, data, message):
-        with self.conn:
+        with self.pool.connection() as conn:
             insert_values = [box.value for box in data]
             insert_values.insert(0, project)
-            cur = self.conn.cursor()
+            cur = conn.cursor()
             insert_query = f"""
                 INSERT INTO {table.lower()} ({', '.join(STANDARD_COLS_QUERY[1:])})
                 VALUES {str(tuple(insert_values))}
@@ -118,12 +110,12 @@ class Db:
                     ipw.HTML(f'{message}') for message in message_split
                 ]
             else:
-                self.conn.commit()
+                conn.commit()
                 message.children = [ipw.HTML(f'Project standard added!</b>')]
 
     def add_insert_to_projects(self, proj_type, table, project, data, reagent_data, message):
-        with self.conn:
-            cur = self.conn.cursor()
+        with self.pool.connection() as conn:
+            cur = conn.cursor()
             if proj_type == 'New':
                 proj_name = data.children[0].value
                 insert_query = f"""
@@ -141,7 +133,7 @@ class Db:
                     proj_id = None
                 else:
                     proj_id = cur.fetchone()[0]
-                    self.conn.commit()
+                    conn.commit()
             else:
                 proj_id = project
             if not proj_id:
@@ -170,42 +162,38 @@ class Db:
                             ipw.HTML(f'{message}') for message in message_split
                         ]
                     else:
-                        self.conn.commit()
+                        conn.commit()
                         message.children = [ipw.HTML(f'{table} added/updated!</b>')]
 
     def delete_data(self, table, data, message):
-        with self.conn:
-            cur = self.conn.cursor()
-            pk_id = PROJECT_COLS_QUERY[0] if table == 'Projects' else REAGENT_COLS_QUERY[0] \
-                if table == 'Reagents' else CONSUMABLE_COLS_QUERY[0] \
-                if table == 'Consumables' else STANDARD_COLS_QUERY[0] \
-                if table == 'Project_Standards' else ""
-
-            row_to_delete = []
-            for Hbox in data:
-                if Hbox.children[-1].value:
-                    delete_list = tuple([box.value for box in Hbox.children[:-1]])
-                    row_to_delete.append(delete_list)
-            for row in row_to_delete:
-                insert_query = f"""
-                    DELETE FROM {table}
-                    WHERE {pk_id} = {row[0]}
-                """
-                try:
-                    cur.execute(insert_query)
-                except (Exception, pg2.DatabaseError) as error:
-                    message_split = error.args[0].split('DETAIL:')
-                    message.children = [ipw.HTML('ERROR:')] + [
-                        ipw.HTML(f'{message}') for message in message_split
-                    ]
-                else:
-                    self.conn.commit()
-                    message.children = [
-                        ipw.HTML(f'Sorry! Still under construction ¯\_(ツ)_/¯ </b>')]
+        pk_id = PROJECT_COLS_QUERY[0] if table == 'Projects' else REAGENT_COLS_QUERY[0] \
+            if table == 'Reagents' else CONSUMABLE_COLS_QUERY[0] \
+            if table == 'Consumables' else STANDARD_COLS_QUERY[0] \
+            if table == 'Project_Standards' else ""
+
+        # Every checked row in one statement and one transaction, reported row by row
+        row_to_delete = [row[0] for row in checked_rows(data)]
+        if not row_to_delete:
+            message.children = [ipw.HTML('No rows checked to delete.')]
+            return
+        try:
+            with self.pool.connection() as conn:
+                deleted = delete_rows(conn.cursor(), table, pk_id, row_to_delete)
+        except (Exception, pg2.DatabaseError) as error:
+            message_split = str(error).split('DETAIL:')
+            message.children = [ipw.HTML('ERROR: no rows were deleted.')] + [
+                ipw.HTML(f'{msg}') for msg in message_split
+            ]
+        else:
+            message.children = [ipw.HTML(f'<b>{len(deleted)} row(s) deleted.</b>')] + [
+                ipw.HTML(f'{pk_id} {key}: deleted') for key in deleted
+            ] + [
+                ipw.HTML(f'{pk_id} {key}: not found') for key in missing_keys(row_to_delete, deleted)
+            ]
 
     def query_call(self, query):
-        with self.conn:
-            cur = self.conn.cursor()
+        with self.pool.connection() as conn:
+            cur = conn.cursor()
             cur.execute(query)
             if 'SELECT' in query:
                 data = cur.fetchall()
@@ -222,6 +210,9 @@ class DbControl:
         # self.cur = CONN.cursor()
         self.params = config()
         self.db = Db(self.params)
+        # Lookups run on the kernel's event loop so Reset and the other buttons keep working while they are out
+        self.async_db = AsyncDb(self.params)
+        self.runner = QueryRunner()
         # Data Table to show
         self.data_table = []
         self.existing_data_table = []
@@ -275,6 +266,7 @@ class DbControl:
                 self.updates_button,
                 self.reset_button
             ]),
+            self.runner.status,
             self.update_message_container
         ])
         self.form_sections_container = ipw.VBox([
@@ -391,7 +383,11 @@ class DbControl:
                 project_choice.value = proj_names['...']
                 project_choice.disabled = True
 
-        ipw.interactive(enable_dropdowns, option=start_menu, table=table_choice, p_type=proj_type, project=project_choice)
+        # Dropdown choices apply right away; the callback only reruns when one of its inputs really changed
+        self.input_graph = ReactiveGraph(wait=0)
+        self.input_graph.bind(option=start_menu, table=table_choice, p_type=proj_type, project=project_choice)
+        self.input_graph.node('dropdowns', ['option', 'table', 'p_type', 'project'], enable_dropdowns)
+        self.input_graph.refresh()
 
     # TODO Try to put all returned query data into same output container
         # # Button to capture inputs
@@ -497,12 +493,11 @@ class DbControl:
                 self.second_placeholder.children = []
                 self.proj_type.value = '...'
 
-        # This widget will feed live inputs into the update_inputs function
-        ipw.interactive(update_inputs,
-                        start_choice=self.start_menu,
-                        table_choice=self.table_choice,
-                        type_choice=self.proj_type
-                        )
+        # The graph feeds live inputs into the update_inputs function
+        self.input_graph = ReactiveGraph(wait=0)
+        self.input_graph.bind(start_choice=self.start_menu, table_choice=self.table_choice, type_choice=self.proj_type)
+        self.input_graph.node('inputs', ['start_choice', 'table_choice', 'type_choice'], update_inputs)
+        self.input_graph.refresh()
         display(self.input_section_display)
 
     # def capture_inputs(self, event):
@@ -577,6 +572,8 @@ class DbControl:
         """
         This function will reset all the boxes and placeholders, as well as re-enable disabled input boxes
         """
+        # Results of queries still running would land in the reset form
+        self.runner.cancel()
         self.initialize_input_section()
         # self.out_display.clear_output()
         # self.start_menu.value = '...'
@@ -669,84 +666,29 @@ class DbControl:
         # Addition of reagents to an existing project
         elif self.proj_type.value == 'Existing':
             # Selects current reagents from the existing project
-            select_query = f"""
+            existing_query = """
             SELECT reagents.reagent_id, reagent, on_hand, project_reagents.assay_id, project_reagents.desired_conc FROM reagents
             INNER JOIN project_reagents
             ON project_reagents.reagent_id = reagents.reagent_id
-            WHERE project_reagents.proj_id = {self.project_choice.value}            
+            WHERE project_reagents.proj_id = %s
             """
-            existing_table = self.db.query_call(select_query)
-            # self.cur.execute(select_query)
-            # existing_table = self.cur.fetchall()
-            existing_table.insert(0, ['Reagent_id', 'Reagent', 'On Hand', 'Assay', 'Desired Conc'])
-            self.current_reagents_container.children = [
-                ipw.HBox([
-                    ipw.HTML(value=f'<b>{str(row_item[i])}</b>',
-                             layout=ipw.Layout(
-                                 width='10%',
-                                 border='solid'),
-                             disabled=True)
-                    if 'id' in str(row_item[0]) else
-                    ipw.Checkbox(value=row_item[i],
-                                 indent=False,
-                                 layout=ipw.Layout(
-                                     width='10%',
-                                     border='0.5px solid'))
-                    if isinstance(row_item[i], bool) else
-                    ipw.Text(value=str(row_item[i]),
-                             layout=ipw.Layout(
-                                 width='10%',
-                                 border='0.5px solid'),
-                             disabled=False)
-                    for i in range(0, len(row_item))
-                ]) for row_item in existing_table
-            ]
-
             # Selects remaining reagents that are NOT currently in the existing project that user can choose and add
-            select_query = f"""
+            select_query = """
                 SELECT reagents.reagent_id, reagent, on_hand
                 FROM   reagents
                 WHERE  NOT EXISTS (
                    SELECT project_reagents.proj_id, project_reagents.reagent_id
                    FROM   project_reagents
                    WHERE  project_reagents.reagent_id = reagents.reagent_id 
-                   AND project_reagents.proj_id = {self.project_choice.value}
+                   AND project_reagents.proj_id = %s
                    );     
             """
-            # self.cur.execute(select_query)
-            # data_table = self.cur.fetchall()
-            data_table = self.db.query_call(select_query)
-            data_table.insert(0, ['Reagent_id', 'Reagent', 'On Hand'])
-            conv_data = []
-            for row in data_table[:1]:
-                row = list(row) + ['Assay', 'Desired Conc', 'Add']
-                conv_data.append(row)
-            for row in data_table[1:]:
-                row = list(row) + [0, 0, False]
-                conv_data.append(row)
-
-            self.add_reagents_container.children = [
-                ipw.HBox([
-                    ipw.HTML(value=f'<b>{str(row_item[i])}</b>',
-                             layout=ipw.Layout(
-                                 width='10%',
-                                 border='solid'),
-                             disabled=True)
-                    if 'id' in str(row_item[0]) else
-                    ipw.Checkbox(value=row_item[i],
-                                 indent=False,
-                                 layout=ipw.Layout(
-                                     width='10%',
-                                     border='0.5px solid'))
-                    if isinstance(row_item[i], bool) else
-                    ipw.Text(value=str(row_item[i]),
-                             layout=ipw.Layout(
-                                 width='10%',
-                                 border='0.5px solid'),
-                             disabled=False)
-                    for i in range(0, len(row_item))
-                ]) for row_item in conv_data
-            ]
+            # Both lookups run at the same time on their own connections, the tables fill in once both are back
+            project = self.project_choice.value
+            self.runner.schedule(
+                'project_reagents', self.async_db.gather, (existing_query, (project,)), (select_query, (project,)),
+                on_done=self.show_project_reagents
+            )
 
         elif self.table_choice.value == 'Project_Standards':
             header = STANDARD_COLS[1:]
@@ -796,6 +738,64 @@ class DbControl:
                 ]) for row_item in conv_data
             ]
 
+    def show_project_reagents(self, query_data):
+        existing_table, data_table = query_data
+        existing_table.insert(0, ['Reagent_id', 'Reagent', 'On Hand', 'Assay', 'Desired Conc'])
+        self.current_reagents_container.children = [
+            ipw.HBox([
+                ipw.HTML(value=f'<b>{str(row_item[i])}</b>',
+                         layout=ipw.Layout(
+                             width='10%',
+                             border='solid'),
+                         disabled=True)
+                if 'id' in str(row_item[0]) else
+                ipw.Checkbox(value=row_item[i],
+                             indent=False,
+                             layout=ipw.Layout(
+                                 width='10%',
+                                 border='0.5px solid'))
+                if isinstance(row_item[i], bool) else
+                ipw.Text(value=str(row_item[i]),
+                         layout=ipw.Layout(
+                             width='10%',
+                             border='0.5px solid'),
+                         disabled=False)
+                for i in range(0, len(row_item))
+            ]) for row_item in existing_table
+        ]
+
+        data_table.insert(0, ['Reagent_id', 'Reagent', 'On Hand'])
+        conv_data = []
+        for row in data_table[:1]:
+            row = list(row) + ['Assay', 'Desired Conc', 'Add']
+            conv_data.append(row)
+        for row in data_table[1:]:
+            row = list(row) + [0, 0, False]
+            conv_data.append(row)
+
+        self.add_reagents_container.children = [
+            ipw.HBox([
+                ipw.HTML(value=f'<b>{str(row_item[i])}</b>',
+                         layout=ipw.Layout(
+                             width='10%',
+                             border='solid'),
+                         disabled=True)
+                if 'id' in str(row_item[0]) else
+                ipw.Checkbox(value=row_item[i],
+                             indent=False,
+                             layout=ipw.Layout(
+                                 width='10%',
+                                 border='0.5px solid'))
+                if isinstance(row_item[i], bool) else
+                ipw.Text(value=str(row_item[i]),
+                         layout=ipw.Layout(
+                             width='10%',
+                             border='0.5px solid'),
+                         disabled=False)
+                for i in range(0, len(row_item))
+            ]) for row_item in conv_data
+        ]
+
     def update_data(self):
         if self.start_menu.value == "View":
             toggle = True
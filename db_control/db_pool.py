@@ -0,0 +1,123 @@
+import threading
+import time
+from contextlib import contextmanager
+import psycopg2 as pg2
+from psycopg2 import extensions as pg2_extensions
+from psycopg2 import pool as pg2_pool
+from db_control.query_stats import InstrumentedCursor
+
+# Every form in the process shares one pool per set of connection params
+DB_POOLS = {}
+DB_POOLS_LOCK = threading.Lock()
+
+POOL_MIN_CONN = 1
+POOL_MAX_CONN = 5
+# Seconds to wait for a free connection before giving up, and idle time after which a connection is pinged
+POOL_TIMEOUT = 30
+HEALTH_CHECK_AFTER = 60
+
+
+class DbPool:
+    """
+    Bounded psycopg2 ThreadedConnectionPool. Nothing connects until the first query, callers wait for a free
+    connection instead of getting a PoolError, and connections that were idle for a while are checked with a
+    SELECT 1 before they are handed out.
+    """
+    def __init__(self, params, minconn=POOL_MIN_CONN, maxconn=POOL_MAX_CONN, timeout=POOL_TIMEOUT):
+        self.params = params
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.pool = None
+        self.lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(maxconn)
+        self.last_used = {}
+
+    def get_pool(self):
+        with self.lock:
+            if self.pool is None or self.pool.closed:
+                # Every statement on a pooled connection is timed and fingerprinted, see db_control.query_stats
+                self.pool = pg2_pool.ThreadedConnectionPool(
+                    self.minconn, self.maxconn, cursor_factory=InstrumentedCursor, **self.params
+                )
+            return self.pool
+
+    def is_healthy(self, conn):
+        if conn.closed:
+            return False
+        last_used = self.last_used.get(id(conn))
+        if last_used is None or time.monotonic() - last_used < HEALTH_CHECK_AFTER:
+            return True
+        try:
+            # A plain cursor, so the pings stay out of QUERY_STATS
+            with conn.cursor(cursor_factory=pg2_extensions.cursor) as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+        except pg2.Error:
+            return False
+        return True
+
+    def getconn(self):
+        pool = self.get_pool()
+        conn = pool.getconn()
+        if not self.is_healthy(conn):
+            # Drop the dead connection, the pool opens a fresh one in its place
+            pool.putconn(conn, close=True)
+            self.last_used.pop(id(conn), None)
+            conn = pool.getconn()
+        return pool, conn
+
+    def putconn(self, pool, conn):
+        if conn.closed:
+            self.last_used.pop(id(conn), None)
+            pool.putconn(conn, close=True)
+        else:
+            self.last_used[id(conn)] = time.monotonic()
+            pool.putconn(conn)
+
+    @contextmanager
+    def connection(self):
+        """
+        Borrows a connection for one transaction. Like "with conn:" in psycopg2 it commits when the block
+        finishes and rolls back on an exception, then the connection goes back to the pool.
+        """
+        if not self.slots.acquire(timeout=self.timeout):
+            raise pg2_pool.PoolError(f"No free database connection after {self.timeout}s")
+        try:
+            pool, conn = self.getconn()
+            try:
+                with conn:
+                    yield conn
+            finally:
+                self.putconn(pool, conn)
+        finally:
+            self.slots.release()
+
+    @contextmanager
+    def cursor(self, **kwargs):
+        with self.connection() as conn:
+            with conn.cursor(**kwargs) as cur:
+                yield cur
+
+    def close(self):
+        with self.lock:
+            if self.pool is not None and not self.pool.closed:
+                self.pool.closeall()
+            self.last_used.clear()
+
+
+def get_pool(params):
+    pool_key = tuple(sorted(params.items()))
+    with DB_POOLS_LOCK:
+        db_pool = DB_POOLS.get(pool_key)
+        if db_pool is None:
+            db_pool = DbPool(params)
+            DB_POOLS[pool_key] = db_pool
+    return db_pool
+
+
+def close_pools():
+    with DB_POOLS_LOCK:
+        for db_pool in DB_POOLS.values():
+            db_pool.close()
+        DB_POOLS.clear()
@@ -1,79 +1,88 @@
+import io
 import psycopg2 as pg2
 import ipywidgets as ipw
+import pandas as pd
 from IPython.display import display
 from config import config, Headers
+from db_control.async_db import AsyncDb, QueryRunner
+from db_control.bulk_import import IMPORT_TABLES, bulk_import
+from db_control.bulk_write import checked_rows, delete_rows, missing_keys, update_rows
+from db_control.db_pool import get_pool
+from protocol_control.reactive import ReactiveGraph
 # from db_control.db_main import Db
 
+try:
+    from ipydatagrid import DataGrid
+except ImportError:
+    DataGrid = None
+
+# Rows fetched per page for the View/Update tables. Update needs a widget per cell so its pages stay small,
+# View renders a page as one DataGrid when ipydatagrid is installed
+PAGE_SIZE = 50
+GRID_PAGE_SIZE = 1000
+# Rejected rows listed after a bulk import, the rest are only counted
+REJECTS_SHOWN = 50
+
+PROJECTS_QUERY = """
+    SELECT * FROM projects
+"""
+
+
+def project_dict(data_table):
+    # Dropdown options, project name -> proj_id
+    proj_dict = {'...': 0}
+    proj_dict.update({row[1]: row[0] for row in data_table})
+    return proj_dict
+
 
 class Db:
     def __init__(self, params):
         self.params = params
-        self.__connect()
+        self.pool = get_pool(self.params)
         self.headers = Headers()
 
-    def __connect(self):
-        self.conn = pg2.connect(**self.params)
-
     def close(self):
-        self.conn.close()
+        # Connections go back to the shared pool after every call, nothing is held open per Db
+        pass
 
     def choose_project(self):
         """
         This function is called to create a select query from the database, pulling the known projects,
         creating a dictionary, and passing the dictionary back to the original function
         """
-        with self.conn:
-            cur = self.conn.cursor()
-            select_query = f"""
-            SELECT * FROM projects
-            """
-            cur.execute(select_query)
+        with self.pool.connection() as conn:
+            cur = conn.cursor()
+            cur.execute(PROJECTS_QUERY)
             data_table = cur.fetchall()
-            proj_dict = {'...': 0}
-            proj_dict.update({row[1]: row[0] for row in data_table})
 
-        return proj_dict
+        return project_dict(data_table)
 
     def update_table(self, data, table, query_header):
-        row_to_update = []
-        # return_value = []
-        update_count = 0
-        for row in data:
-            if row.children[-1].value:
-                update_list = tuple([box.value for box in row.children[:-1]])
-                row_to_update.append(update_list)
-        with self.conn:
-            cur = self.conn.cursor()
-            for row in row_to_update:
-                proj_dict = dict(zip(query_header.split(','), row))
-                query_set = [f"{key} = '{value}'" for (key, value) in proj_dict.items()]
-                set_string = ', '.join(query_set[1:])
-                update_query = f"""
-                    UPDATE {table.lower()}
-                    SET {set_string}
-                    WHERE {query_header.split(',')[0]} = {row[0]}
-                    RETURNING {query_header.split(',')[-1]}
-                """
-                try:
-                    cur.execute(update_query)
-                except (Exception, pg2.DatabaseError) as error:
-                    message_split = error.args[0].split('DETAIL:')
-                    message_container = [ipw.HTML('ERROR:')] + [
-                        ipw.HTML(f'{msg}') for msg in message_split
-                    ]
-                else:
-                    update_count += cur.rowcount
-                    return_data = cur.fetchone()[-1]
-
-                    message_container = [ipw.HTML(f'<b>Update(s) made! {update_count} row(s) updated. Value updated: {return_data}</b>')]
-                    # return_value.append(cur.fetchone()[0])
-
-                    self.conn.commit()
+        # Every checked row in one statement and one transaction, reported row by row
+        row_to_update = checked_rows(data)
+        if not row_to_update:
+            return [ipw.HTML('No rows checked to update.')]
+        columns = [column.strip() for column in query_header.split(',')]
+        try:
+            with self.pool.connection() as conn:
+                updated = update_rows(conn.cursor(), table, columns, row_to_update, columns[-1])
+        except (Exception, pg2.DatabaseError) as error:
+            message_split = str(error).split('DETAIL:')
+            message_container = [ipw.HTML('ERROR: no rows were updated.')] + [
+                ipw.HTML(f'{msg}') for msg in message_split
+            ]
+        else:
+            not_found = missing_keys([row[0] for row in row_to_update], [key for key, value in updated])
+            message_container = [ipw.HTML(f'<b>Update(s) made! {len(updated)} row(s) updated.</b>')] + [
+                ipw.HTML(f'{columns[0]} {key}: {columns[-1]} is now {value}') for key, value in updated
+            ] + [
+                ipw.HTML(f'{columns[0]} {key}: not found') for key in not_found
+            ]
         return message_container
 
     def insert_to_cons_reag(self, table, query_header, data):
-        with self.conn:
-            cur = self.conn.cursor()
+        with self.pool.connection() as conn:
+            cur = conn.cursor()
             insert_query = f"""
             INSERT INTO {table.lower()} ({', '.join(query_header[1:])})
             VALUES {str(tuple([box.value for box in data]))}
@@ -91,16 +100,16 @@ class Db:
                 returned_data = cur.fetchone()
                 returned_id = returned_data[0]
                 returned_on_hand = returned_data[1]
-                self.conn.commit()
+                conn.commit()
                 message_container = [ipw.HTML(f'<b>{table} added! On Hand: {returned_on_hand}</b>')]
 
         return message_container, returned_id
 
     def insert_to_standards(self, table, project, data):
-        with self.conn:
+        with self.pool.connection() as conn:
             insert_values = [box.value for box in data]
             insert_values.insert(0, project)
-            cur = self.conn.cursor()
+            cur = conn.cursor()
             insert_query = f"""
                 INSERT INTO {table.lower()} ({', '.join(self.headers.standard_query_cols[1:])})
                 VALUES {str(tuple(insert_values))}
@@ -118,13 +127,13 @@ class Db:
                 returned_data = cur.fetchone()
                 returned_id = returned_data[0]
                 returned_on_hand = returned_data[1]
-                self.conn.commit()
+                conn.commit()
                 message_container = [ipw.HTML(f'<b>Project standard added! On hand: {returned_on_hand}</b>')]
         return message_container, returned_id
 
     def add_insert_to_projects(self, proj_type, table, project, new_proj, reagent_data):
-        with self.conn:
-            cur = self.conn.cursor()
+        with self.pool.connection() as conn:
+            cur = conn.cursor()
             if proj_type == 'New':
                 proj_name = new_proj[0].value
                 insert_query = f"""
@@ -142,7 +151,7 @@ class Db:
                     proj_id = None
                 else:
                     proj_id = cur.fetchone()[0]
-                    self.conn.commit()
+                    conn.commit()
             else:
                 proj_id = project
             if not proj_id:
@@ -176,45 +185,58 @@ class Db:
                         returned_id = ""
                     else:
                         returned_id = cur.fetchone()[0]
-                        self.conn.commit()
+                        conn.commit()
                         message_container = [ipw.HTML(f'{table} added/updated!</b>')]
         return message_container, proj_id, returned_id
 
     def delete_data(self, table, data):
-        with self.conn:
-            cur = self.conn.cursor()
-            pk_id = self.headers.project_query_cols[0] if table == 'Projects' else self.headers.reagent_query_cols[0] \
-                if table == 'Reagents' else self.headers.consumable_query_cols[0] \
-                if table == 'Consumables' else self.headers.standard_query_cols[0] \
-                if table == 'Project_Standards' else ""
-
-            row_to_delete = []
-            for Hbox in data:
-                if Hbox.children[-1].value:
-                    delete_list = tuple([box.value for box in Hbox.children[:-1]])
-                    row_to_delete.append(delete_list)
-            for row in row_to_delete:
-                insert_query = f"""
-                    DELETE FROM {table}
-                    WHERE {pk_id} = {row[0]}
-                """
-                try:
-                    cur.execute(insert_query)
-                except (Exception, pg2.DatabaseError) as error:
-                    message_split = error.args[0].split('DETAIL:')
-                    message_container = [ipw.HTML('ERROR:')] + [
-                        ipw.HTML(f'{message}') for message in message_split
-                    ]
-                else:
-                    self.conn.commit()
-                    message_container = [
-                        ipw.HTML(f'Sorry! Still under construction ¯\_(ツ)_/¯ </b>')]
+        pk_id = self.headers.project_query_cols[0] if table == 'Projects' else self.headers.reagent_query_cols[0] \
+            if table == 'Reagents' else self.headers.consumable_query_cols[0] \
+            if table == 'Consumables' else self.headers.standard_query_cols[0] \
+            if table == 'Project_Standards' else ""
+
+        # Every checked row in one statement and one transaction, reported row by row
+        row_to_delete = [row[0] for row in checked_rows(data)]
+        if not row_to_delete:
+            return [ipw.HTML('No rows checked to delete.')]
+        try:
+            with self.pool.connection() as conn:
+                deleted = delete_rows(conn.cursor(), table, pk_id, row_to_delete)
+        except (Exception, pg2.DatabaseError) as error:
+            message_split = str(error).split('DETAIL:')
+            message_container = [ipw.HTML('ERROR: no rows were deleted.')] + [
+                ipw.HTML(f'{message}') for message in message_split
+            ]
+        else:
+            message_container = [ipw.HTML(f'<b>{len(deleted)} row(s) deleted.</b>')] + [
+                ipw.HTML(f'{pk_id} {key}: deleted') for key in deleted
+            ] + [
+                ipw.HTML(f'{pk_id} {key}: not found') for key in missing_keys(row_to_delete, deleted)
+            ]
         return message_container
 
-    def query_call(self, query):
-        with self.conn:
-            cur = self.conn.cursor()
-            cur.execute(query)
+    def import_file(self, table, file_name, content, add_on_hand):
+        # Whole file in one transaction, see db_control.bulk_import
+        try:
+            with self.pool.connection() as conn:
+                result = bulk_import(conn, table, io.BytesIO(content), file_name, add_on_hand)
+        except (Exception, pg2.DatabaseError) as error:
+            message_split = str(error).split('DETAIL:')
+            message_container = [ipw.HTML('ERROR:')] + [
+                ipw.HTML(f'{message}') for message in message_split
+            ]
+        else:
+            message_container = [ipw.HTML(f'<b>Import done! {result.summary()}</b>')] + [
+                ipw.HTML(f'Line {line}: {reason}') for line, reason in result.rejected[:REJECTS_SHOWN]
+            ]
+            if len(result.rejected) > REJECTS_SHOWN:
+                message_container.append(ipw.HTML(f'...and {len(result.rejected) - REJECTS_SHOWN} more rejected rows'))
+        return message_container
+
+    def query_call(self, query, params=None):
+        with self.pool.connection() as conn:
+            cur = conn.cursor()
+            cur.execute(query, params)
             if 'SELECT' in query:
                 data = cur.fetchall()
                 return data
@@ -235,6 +257,10 @@ class InputForm:
             self.params = config(filename='../database.ini', section='postgresql')
         finally:
             self.db = Db(self.params)
+        # Queries started from widget callbacks run on the kernel's event loop, so the form stays responsive
+        self.async_db = AsyncDb(self.params)
+        self.runner = QueryRunner()
+        self.processor = None
 
         self.start_menu = ipw.Dropdown(
             description='Choose option:',
@@ -259,8 +285,8 @@ class InputForm:
             disabled=True
         )
 
-        # Project choices
-        self.proj_names = self.db.choose_project()
+        # Project choices, filled in once the project query is back
+        self.proj_names = project_dict([])
         self.project_choice = ipw.Dropdown(
             description='Choose project:',
             options=self.proj_names,
@@ -279,6 +305,15 @@ class InputForm:
         self.out_display = ipw.Output()
 
         self.initialize_input_section()
+        self.load_projects()
+
+    def load_projects(self):
+        # A newer request cancels one still running
+        self.runner.schedule('projects', self.async_db.query, PROJECTS_QUERY, on_done=self.show_projects)
+
+    def show_projects(self, data_table):
+        self.proj_names = project_dict(data_table)
+        self.project_choice.options = self.proj_names
 
     def initialize_input_section(self):
         """
@@ -294,6 +329,7 @@ class InputForm:
             input_wdgt_container,
             ipw.HTML('<br>'),
             # self.capture_inputs_button,
+            self.runner.status,
             self.out_display
         ])
         input_wdgt_container.children = [
@@ -315,8 +351,7 @@ class InputForm:
                     self.project_choice.value = self.proj_names['...']
                     self.project_choice.disabled = True
                 elif table == "Projects" and p_type == "Existing":
-                    self.proj_names = self.db.choose_project()
-                    self.project_choice.options = self.proj_names
+                    self.load_projects()
                     self.project_choice.disabled = False
                 elif table == "Project_Standards":
                     self.proj_type.value = '...'
@@ -333,11 +368,13 @@ class InputForm:
                 self.project_choice.value = self.proj_names['...']
                 self.project_choice.disabled = True
 
-        ipw.interactive(enable_dropdowns,
-                        option=self.start_menu,
-                        table=self.table_choice,
-                        p_type=self.proj_type,
-                        project=self.project_choice)
+        # Dropdown choices apply right away; the callback only reruns when one of its inputs really changed
+        self.input_graph = ReactiveGraph(wait=0)
+        self.input_graph.bind(
+            option=self.start_menu, table=self.table_choice, p_type=self.proj_type, project=self.project_choice
+        )
+        self.input_graph.node('dropdowns', ['option', 'table', 'p_type', 'project'], enable_dropdowns)
+        self.input_graph.refresh()
 
         display(input_section_container)
 
@@ -345,6 +382,8 @@ class InputForm:
         pass_checks = False
         if '...' in [self.start_menu.value, self.table_choice.value]:
             message = ipw.HTML('Please choose both a start option and table choice!')
+        elif self.start_menu.value == 'Import' and self.table_choice.value.lower() not in IMPORT_TABLES:
+            message = ipw.HTML('Import works for Reagents and Consumables only!')
         elif self.table_choice.value in ["Projects", "Project_Standards"] and self.start_menu.value == "Add":
             if self.table_choice.value == "Projects" and self.proj_type.value == '...':
                 message = ipw.HTML('Please choose new or existing!')
@@ -372,13 +411,19 @@ class InputForm:
                 p_type=self.proj_type.value,
                 project=self.project_choice.value
             )
+            # Lookups of the previous choices would only overwrite the new output
+            if self.processor is not None:
+                self.processor.cancel_queries()
             with self.out_display:
                 self.out_display.clear_output()
-                Processor(**input_choices)
+                self.processor = Processor(**input_choices, runner=self.runner)
 
 
 class Processor:
-    def __init__(self, option, table, p_type, project):
+    # Keys of the queries a Processor runs on the shared QueryRunner
+    QUERY_KEYS = ('page', 'project_reagents')
+
+    def __init__(self, option, table, p_type, project, runner=None):
         self.headers = Headers()
         try:
             self.params = config()
@@ -386,20 +431,39 @@ class Processor:
             self.params = config(filename='../database.ini', section='postgresql')
         finally:
             self.db = Db(self.params)
+        self.async_db = AsyncDb(self.params)
+        self.runner = runner if runner is not None else QueryRunner()
 
         self.option = option
         self.table = table
         self.p_type = p_type
         self.project = project
         self.table_output = ipw.Output()
+        self.current_reagents_box = ipw.VBox()
+        self.add_reagents_box = ipw.VBox()
 
         self.proj_name = []
         self.current_reagents = []
         self.add_reagents = []
         self.data_table = []
         self.query_header = None
+        self.insert_header = None
         self.message_container = []
 
+        # Keyset pagination state, the id each page starts after
+        self.use_grid = DataGrid is not None and self.option == 'View'
+        self.page_size = GRID_PAGE_SIZE if self.use_grid else PAGE_SIZE
+        self.page_starts = [None]
+        self.page_rows = []
+        self.has_next = False
+        self.table_container = ipw.VBox()
+        self.page_label = ipw.HTML()
+        self.prev_button = ipw.Button(description='Previous', disabled=True)
+        self.prev_button.on_click(self.previous_page)
+        self.next_button = ipw.Button(description='Next', disabled=True)
+        self.next_button.on_click(self.next_page)
+        self.page_controls = ipw.HBox([])
+
         self.updates_button = ipw.Button(
             description='Update',
             button_style='info',
@@ -415,20 +479,27 @@ class Processor:
             if self.table == "Projects" and self.p_type == 'New':
                 self.proj_name, self.add_reagents = self.new_proj_name()
             elif self.table == "Projects" and self.p_type == 'Existing':
-                self.current_reagents, self.add_reagents = self.add_data_to_proj()
+                self.load_project_reagents()
             else:
                 self.data_table = self.add_data()
-        elif self.option in ['View', 'Update']:
+        elif self.option == 'Import':
+            self.data_table = self.import_form()
+        elif self.option in ['View', 'Update', 'Delete']:
             self.query_header, insert_header = self.get_query_header()
             self.data_table = self.update_data(insert_header)
+            self.page_controls.children = [self.prev_button, self.next_button, self.page_label]
+        self.table_container.children = self.data_table
+        self.current_reagents_box.children = self.current_reagents
+        self.add_reagents_box.children = self.add_reagents
 
         output_section_container = ipw.VBox([
             ipw.HTML("<h3>Output Section</h3>"),
             ipw.HTML("<hr style='background-color:black;'>"),
             ipw.VBox(self.proj_name),
-            ipw.VBox(self.current_reagents),
-            ipw.VBox(self.add_reagents),
-            ipw.VBox(self.data_table),
+            self.current_reagents_box,
+            self.add_reagents_box,
+            self.table_container,
+            self.page_controls,
 
             # add_reagents_container,
             ipw.HTML('<br>'),
@@ -467,6 +538,22 @@ class Processor:
         ]
         return output_table_container
 
+    def import_form(self):
+        # CSV or Excel file with the same headers as the Add form (or the column names), one row per item
+        self.upload = ipw.FileUpload(accept='.csv,.xlsx', multiple=False, description='Choose file')
+        self.add_on_hand = ipw.Checkbox(
+            value=True,
+            description='Add On Hand to the stock of items already in the table',
+            indent=False
+        )
+        self.updates_button.description = 'Import'
+        return [
+            ipw.HTML(f"Columns: {', '.join(header for column, header in IMPORT_TABLES[self.table.lower()])}. "
+                     "Rows with a known Vendor + Category Number update that item."),
+            self.upload,
+            self.add_on_hand
+        ]
+
     def new_proj_name(self):
         display(ipw.HTML('Call worked'))
         proj_name_container = [
@@ -514,17 +601,44 @@ class Processor:
         ]
         return proj_name_container, reagents_container
 
-    def add_data_to_proj(self):
+    def cancel_queries(self):
+        for key in self.QUERY_KEYS:
+            self.runner.cancel(key)
+
+    def load_project_reagents(self):
+        self.runner.schedule('project_reagents', self.add_data_to_proj, on_done=self.show_project_reagents)
+
+    def show_project_reagents(self, reagent_containers):
+        self.current_reagents, self.add_reagents = reagent_containers
+        self.current_reagents_box.children = self.current_reagents
+        self.add_reagents_box.children = self.add_reagents
+
+    async def add_data_to_proj(self):
         # Addition of reagents to an existing project
         # Selects current reagents from the existing project
-        select_query = f"""
+        existing_query = """
         SELECT reagents.reagent_id, reagent, on_hand, project_reagents.assay_id, project_reagents.desired_conc 
         FROM reagents
         INNER JOIN project_reagents
         ON project_reagents.reagent_id = reagents.reagent_id
-        WHERE project_reagents.proj_id = {self.project}            
+        WHERE project_reagents.proj_id = %s
+        """
+        # Selects remaining reagents that are NOT currently in the existing project that user can choose and add
+        select_query = """
+            SELECT reagents.reagent_id, reagent, on_hand
+            FROM   reagents
+            WHERE  NOT EXISTS (
+               SELECT project_reagents.proj_id, project_reagents.reagent_id
+               FROM   project_reagents
+               WHERE  project_reagents.reagent_id = reagents.reagent_id 
+               AND project_reagents.proj_id = %s
+               );     
         """
-        existing_table = self.db.query_call(select_query)
+        # The two lookups don't depend on each other, so they run at the same time on separate connections
+        existing_table, data_table = await self.async_db.gather(
+            (existing_query, (self.project,)),
+            (select_query, (self.project,))
+        )
 
         existing_table.insert(0, ['Reagent_id', 'Reagent', 'On Hand', 'Assay', 'Desired Conc'])
         current_reagents_container = [
@@ -550,18 +664,6 @@ class Processor:
             ]) for row_item in existing_table
         ]
 
-        # Selects remaining reagents that are NOT currently in the existing project that user can choose and add
-        select_query = f"""
-            SELECT reagents.reagent_id, reagent, on_hand
-            FROM   reagents
-            WHERE  NOT EXISTS (
-               SELECT project_reagents.proj_id, project_reagents.reagent_id
-               FROM   project_reagents
-               WHERE  project_reagents.reagent_id = reagents.reagent_id 
-               AND project_reagents.proj_id = {self.project}
-               );     
-        """
-        data_table = self.db.query_call(select_query)
         data_table.insert(0, ['Reagent_id', 'Reagent', 'On Hand'])
         conv_data = []
         for row in data_table[:1]:
@@ -596,17 +698,63 @@ class Processor:
         return current_reagents_container, add_reagents_container
 
     def update_data(self, insert_header):
+        self.insert_header = insert_header
+        self.page_starts = [None]
+        # The first page fills in once it is back
+        self.show_page()
+        return self.data_table
+
+    async def fetch_page(self):
+        # One page ordered on the id column, starting after the last id of the previous page
+        key_col = self.query_header.split(',')[0].strip()
+        after = self.page_starts[-1]
+        where_clause = f"WHERE {key_col} > %s" if after is not None else ""
+        select_query_data = f"""
+            SELECT {self.query_header} FROM {self.table.lower()}
+            {where_clause}
+            ORDER BY {key_col}
+            LIMIT %s
+            """
+        params = (after, self.page_size + 1) if after is not None else (self.page_size + 1,)
+        return await self.async_db.query(select_query_data, params)
+
+    def load_page(self, data_table):
+        self.has_next = len(data_table) > self.page_size
+        self.page_rows = data_table[:self.page_size]
+        first_row = (len(self.page_starts) - 1) * self.page_size
+        self.page_label.value = f"Rows {first_row + 1 if self.page_rows else 0}-{first_row + len(self.page_rows)}"
+        self.prev_button.disabled = len(self.page_starts) == 1
+        self.next_button.disabled = not self.has_next
+        if self.use_grid:
+            grid_data = pd.DataFrame(self.page_rows, columns=self.insert_header)
+            return [DataGrid(grid_data, selection_mode='cell', layout=ipw.Layout(height='500px'))]
+        return self.build_rows([self.insert_header] + self.page_rows)
+
+    def show_page(self):
+        # Previous can be clicked again before a page is back, the older request is cancelled
+        self.runner.schedule('page', self.fetch_page, on_done=self.show_rows)
+
+    def show_rows(self, data_table):
+        self.data_table = self.load_page(data_table)
+        self.table_container.children = self.data_table
+
+    def next_page(self, event):
+        # Next needs the current page's last id, so it waits until that page is shown
+        if self.has_next and self.page_rows and not self.runner.busy('page'):
+            self.page_starts.append(self.page_rows[-1][0])
+            self.show_page()
+
+    def previous_page(self, event):
+        if len(self.page_starts) > 1:
+            self.page_starts.pop()
+            self.show_page()
+
+    def build_rows(self, data_table):
         if self.option == 'View':
             toggle = True
         else:
             toggle = False
 
-        select_query_data = f"""
-            SELECT {self.query_header} FROM {self.table.lower()}
-            """
-
-        data_table = self.db.query_call(select_query_data)
-        data_table.insert(0, insert_header)
         conv_data = []
         for row in data_table[:1]:
             row = list(row) + ['Update'] if self.option == 'Update' \
@@ -694,6 +842,23 @@ class Processor:
                 self.table,
                 self.data_table[1:],
             )
+            display(ipw.VBox(message_container))
+
+        elif self.option == 'Import':
+            # ipywidgets 8 gives a tuple of files, 7 a dict keyed on the file name
+            uploads = self.upload.value
+            files = list(uploads.values()) if isinstance(uploads, dict) else list(uploads)
+            if not files:
+                message_container = [ipw.HTML('Please choose a file to import!')]
+            else:
+                upload = files[0]
+                message_container = self.db.import_file(
+                    self.table,
+                    upload.get('name') or upload['metadata']['name'],
+                    bytes(upload['content']),
+                    self.add_on_hand.value
+                )
+            display(ipw.VBox(message_container))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,217 @@
+import bisect
+import datetime as dt
+import json
+import os
+import re
+import sys
+import threading
+import time
+from pathlib import Path
+import psycopg2 as pg2
+from psycopg2 import extensions as pg2_extensions
+
+# Upper bounds (ms) of the duration histogram buckets, the last bucket is everything slower
+HISTOGRAM_BOUNDS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+SLOW_QUERY_MS = 200
+# Kept with the user's other Protocol-Builder files, not in whatever folder the notebook was started from
+SLOW_QUERY_LOG = Path.home().joinpath("Protocol-Builder", "logs", "slow_queries.log")
+FINGERPRINT_CACHE_SIZE = 1024
+# Frames kept per caller, e.g. query_call < fetch_page < load_page shows which form action ran a query
+CALLER_DEPTH = 3
+
+# Modules skipped when looking for the code that ran a statement
+INTERNAL_FILES = (__file__, os.sep + 'psycopg2' + os.sep, os.sep + 'contextlib.py')
+
+STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+NUMBER_LITERAL = re.compile(r"(?<![\w.])-?\d+(?:\.\d+)?(?:[eE][-+]?\d+)?\b")
+VALUES_LIST = re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)(?:\s*,\s*\(\s*\?(?:\s*,\s*\?)*\s*\))+")
+IN_LIST = re.compile(r"\bIN\s*\(\s*\?(?:\s*,\s*\?)*\s*\)", re.IGNORECASE)
+WHITESPACE = re.compile(r"\s+")
+
+
+def fingerprint(query):
+    """
+    Statement with its literals replaced by ?, so the same query with different values counts as one.
+    Multi-row VALUES and IN lists collapse to a single entry, so execute_values pages of any size match too.
+    """
+    if isinstance(query, bytes):
+        query = query.decode('utf-8', 'replace')
+    query = STRING_LITERAL.sub('?', query)
+    query = NUMBER_LITERAL.sub('?', query)
+    query = WHITESPACE.sub(' ', query).strip()
+    query = VALUES_LIST.sub('(...)', query)
+    return IN_LIST.sub('IN (...)', query)
+
+
+class QueryStats:
+    """
+    Per fingerprint counters for every statement run through an InstrumentedCursor: calls, rows, total and max
+    time, a duration histogram and the code locations that ran it. Statements slower than slow_ms are appended
+    to the slow query log as JSON lines. With explain=True a slow statement is also run again as EXPLAIN ANALYZE
+    (inside a savepoint that is rolled back, so writes are not applied twice) and the plan is kept with it.
+    """
+    def __init__(self, slow_ms=SLOW_QUERY_MS, slow_log=SLOW_QUERY_LOG):
+        self.enabled = True
+        self.slow_ms = slow_ms
+        self.slow_log = slow_log
+        self.explain = False
+        self.stats = {}
+        self.plans = {}
+        self.fingerprints = {}
+        self.lock = threading.Lock()
+
+    def fingerprint(self, query):
+        statement = self.fingerprints.get(query)
+        if statement is None:
+            statement = fingerprint(query)
+            if len(self.fingerprints) >= FINGERPRINT_CACHE_SIZE:
+                self.fingerprints.clear()
+            self.fingerprints[query] = statement
+        return statement
+
+    def record(self, query, duration_ms, rowcount, caller):
+        statement = self.fingerprint(query)
+        with self.lock:
+            stats = self.stats.get(statement)
+            if stats is None:
+                stats = dict(
+                    calls=0, rows=0, total_ms=0.0, max_ms=0.0,
+                    histogram=[0] * (len(HISTOGRAM_BOUNDS_MS) + 1), callers={}
+                )
+                self.stats[statement] = stats
+            stats['calls'] += 1
+            stats['rows'] += max(rowcount, 0)
+            stats['total_ms'] += duration_ms
+            stats['max_ms'] = max(stats['max_ms'], duration_ms)
+            stats['histogram'][bisect.bisect_left(HISTOGRAM_BOUNDS_MS, duration_ms)] += 1
+            stats['callers'][caller] = stats['callers'].get(caller, 0) + 1
+        return statement
+
+    def is_slow(self, duration_ms):
+        return self.slow_ms is not None and duration_ms >= self.slow_ms
+
+    def log_slow(self, statement, query, duration_ms, rowcount, caller, plan=None):
+        if self.slow_log is None:
+            return
+        if isinstance(query, bytes):
+            query = query.decode('utf-8', 'replace')
+        entry = dict(
+            time=dt.datetime.now().isoformat(timespec='seconds'), duration_ms=round(duration_ms, 3),
+            rowcount=rowcount, caller=caller, fingerprint=statement, query=query
+        )
+        if plan is not None:
+            entry['plan'] = plan
+        with self.lock:
+            os.makedirs(os.path.dirname(self.slow_log) or '.', exist_ok=True)
+            with open(self.slow_log, 'a') as log_file:
+                log_file.write(json.dumps(entry, default=str) + '\n')
+
+    def report(self, top=20, sort='total_ms'):
+        # (fingerprint, stats) of the `top` statements by total time (or calls, max_ms, rows)
+        with self.lock:
+            items = [(statement, dict(stats, callers=dict(stats['callers']))) for statement, stats in self.stats.items()]
+        for statement, stats in items:
+            stats['mean_ms'] = stats['total_ms'] / stats['calls']
+        return sorted(items, key=lambda item: item[1][sort], reverse=True)[:top]
+
+    def print_report(self, top=20, sort='total_ms', file=None):
+        file = file or sys.stdout
+        labels = [f"<{bound}" for bound in HISTOGRAM_BOUNDS_MS] + [f">={HISTOGRAM_BOUNDS_MS[-1]}"]
+        for statement, stats in self.report(top, sort):
+            print(
+                f"{stats['calls']:>7} calls {stats['total_ms']:>10.1f} ms total {stats['mean_ms']:>8.2f} ms mean "
+                f"{stats['max_ms']:>8.2f} ms max {stats['rows']:>8} rows  {statement[:120]}", file=file
+            )
+            histogram = ", ".join(f"{label}ms: {count}" for label, count in zip(labels, stats['histogram']) if count)
+            print(f"        {histogram}", file=file)
+            for caller, calls in sorted(stats['callers'].items(), key=lambda item: item[1], reverse=True)[:3]:
+                print(f"        {calls:>5}x {caller}", file=file)
+
+    def reset(self):
+        with self.lock:
+            self.stats.clear()
+            self.plans.clear()
+
+
+def find_caller(depth=CALLER_DEPTH):
+    frames = []
+    frame = sys._getframe(2)
+    while frame is not None and len(frames) < depth:
+        file_name = frame.f_code.co_filename
+        if not any(internal in file_name for internal in INTERNAL_FILES):
+            frames.append(f"{frame.f_code.co_name} ({os.path.basename(file_name)}:{frame.f_lineno})")
+        frame = frame.f_back
+    return " < ".join(frames) or "unknown"
+
+
+def is_select(query):
+    if isinstance(query, bytes):
+        query = query.decode('utf-8', 'replace')
+    return query.lstrip().lower().startswith(('select', 'with'))
+
+
+class InstrumentedCursor(pg2_extensions.cursor):
+    """
+    psycopg2 cursor that reports every execute/executemany to QUERY_STATS. DbPool connections use it as their
+    cursor_factory, so every Db and Protocol query goes through it, execute_values pages included.
+    """
+    def execute(self, query, vars=None):
+        if not QUERY_STATS.enabled:
+            return super().execute(query, vars)
+        start = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            self.record(query, vars, (time.perf_counter() - start) * 1000)
+
+    def executemany(self, query, vars_list):
+        if not QUERY_STATS.enabled:
+            return super().executemany(query, vars_list)
+        start = time.perf_counter()
+        try:
+            return super().executemany(query, vars_list)
+        finally:
+            self.record(query, None, (time.perf_counter() - start) * 1000)
+
+    def record(self, query, vars, duration_ms):
+        caller = find_caller()
+        statement = QUERY_STATS.record(query, duration_ms, self.rowcount, caller)
+        if QUERY_STATS.is_slow(duration_ms):
+            plan = self.explain_analyze(query, vars) if QUERY_STATS.explain else None
+            if plan is not None:
+                QUERY_STATS.plans[statement] = plan
+            QUERY_STATS.log_slow(statement, self.query or query, duration_ms, self.rowcount, caller, plan)
+
+    def explain_analyze(self, query, vars):
+        """
+        Plan of a slow statement from EXPLAIN ANALYZE, or None when it can't be captured. Inside a transaction it
+        runs in a savepoint that is always rolled back, so a write is not applied twice and a failing EXPLAIN
+        doesn't abort the caller's transaction. Outside one (autocommit) only reads are explained.
+        """
+        # Named (server-side) cursors can't run a second statement, and an aborted transaction can't either
+        conn = self.connection
+        if self.name is not None or conn.get_transaction_status() == pg2_extensions.TRANSACTION_STATUS_INERROR:
+            return None
+        if conn.autocommit and not is_select(query):
+            return None
+        explain_prefix = "EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) "
+        explain_query = (explain_prefix.encode() if isinstance(query, bytes) else explain_prefix) + query
+        with conn.cursor(cursor_factory=pg2_extensions.cursor) as explain_cursor:
+            if conn.autocommit:
+                try:
+                    explain_cursor.execute(explain_query, vars)
+                    return explain_cursor.fetchone()[0]
+                except pg2.Error:
+                    return None
+            explain_cursor.execute("SAVEPOINT explain_capture")
+            try:
+                explain_cursor.execute(explain_query, vars)
+                return explain_cursor.fetchone()[0]
+            except pg2.Error:
+                return None
+            finally:
+                explain_cursor.execute("ROLLBACK TO SAVEPOINT explain_capture")
+
+
+# Shared by every DbPool connection in the process
+QUERY_STATS = QueryStats()
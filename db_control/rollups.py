@@ -0,0 +1,143 @@
+import argparse
+from psycopg2.extras import execute_values
+from config import config
+from db_control.db_pool import get_pool
+
+# Usage tables rolled up per kind, with the id column of the item used
+USE_TABLES = dict(
+    reagent=('project_use_reagents', 'reagent_id'),
+    consumable=('project_use_consumables', 'item_id'),
+    standard=('project_use_standards', 'standard_id')
+)
+# Days of usage the burn rate is averaged over
+BURN_RATE_DAYS = 30
+ROLLUP_TABLES = ('inventory_use_daily', 'inventory_use_monthly')
+
+ROLLUP_DDL = f"""
+    CREATE TABLE IF NOT EXISTS inventory_use_daily (
+        kind TEXT NOT NULL,
+        item_id INTEGER NOT NULL,
+        proj_id INTEGER NOT NULL,
+        day DATE NOT NULL,
+        amt_used NUMERIC NOT NULL DEFAULT 0,
+        uses INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (kind, item_id, proj_id, day)
+    );
+
+    CREATE TABLE IF NOT EXISTS inventory_use_monthly (
+        kind TEXT NOT NULL,
+        item_id INTEGER NOT NULL,
+        proj_id INTEGER NOT NULL,
+        month DATE NOT NULL,
+        amt_used NUMERIC NOT NULL DEFAULT 0,
+        uses INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (kind, item_id, proj_id, month)
+    );
+
+    CREATE INDEX IF NOT EXISTS inventory_use_daily_day ON inventory_use_daily (kind, day);
+
+    CREATE OR REPLACE VIEW reagent_burn_rate AS
+    SELECT reagents.reagent_id, reagent, on_hand,
+    COALESCE(SUM(daily.amt_used), 0) / {BURN_RATE_DAYS} AS daily_burn,
+    CASE
+        WHEN SUM(daily.amt_used) > 0 THEN ROUND(on_hand / (SUM(daily.amt_used) / {BURN_RATE_DAYS}), 1)
+    END AS days_remaining
+    FROM reagents
+    LEFT JOIN inventory_use_daily AS daily
+    ON daily.kind = 'reagent' AND daily.item_id = reagents.reagent_id
+    AND daily.day > CURRENT_DATE - {BURN_RATE_DAYS}
+    GROUP BY reagents.reagent_id, reagent, on_hand;
+"""
+
+# Adds a batch of usage rows to both rollups. Rows are grouped first since one upsert can't touch a key twice.
+ROLLUP_UPSERT = """
+    WITH use_rows AS (
+        SELECT use_rows.kind, use_rows.item_id::integer AS item_id, use_rows.proj_id::integer AS proj_id,
+        use_rows.day::date AS day, use_rows.amt_used::numeric AS amt_used
+        FROM (VALUES %s) AS use_rows (kind, item_id, proj_id, amt_used, day)
+    ),
+    daily AS (
+        INSERT INTO inventory_use_daily (kind, item_id, proj_id, day, amt_used, uses)
+        SELECT kind, item_id, proj_id, day, SUM(amt_used), COUNT(*)
+        FROM use_rows
+        GROUP BY kind, item_id, proj_id, day
+        ON CONFLICT (kind, item_id, proj_id, day) DO UPDATE
+        SET amt_used = inventory_use_daily.amt_used + EXCLUDED.amt_used,
+        uses = inventory_use_daily.uses + EXCLUDED.uses
+    )
+    INSERT INTO inventory_use_monthly (kind, item_id, proj_id, month, amt_used, uses)
+    SELECT kind, item_id, proj_id, date_trunc('month', day)::date, SUM(amt_used), COUNT(*)
+    FROM use_rows
+    GROUP BY kind, item_id, proj_id, date_trunc('month', day)::date
+    ON CONFLICT (kind, item_id, proj_id, month) DO UPDATE
+    SET amt_used = inventory_use_monthly.amt_used + EXCLUDED.amt_used,
+    uses = inventory_use_monthly.uses + EXCLUDED.uses
+"""
+
+
+def ensure_rollups(cur):
+    """
+    Creates the rollups on a database that doesn't have them yet and fills them from the usage tables, in the
+    caller's transaction. Returns True when it built them, the rebuild then already counted every usage row
+    inserted so far in that transaction.
+    """
+    # A catalog lookup each time rather than a cached flag, a capture that built them can still roll back
+    cur.execute("SELECT " + ", ".join("to_regclass(%s)" for table in ROLLUP_TABLES), ROLLUP_TABLES)
+    if all(cur.fetchone()):
+        return False
+    create_rollups(cur.connection)
+    rebuild_rollups(cur.connection)
+    return True
+
+
+def add_use_rollups(cur, kind, use_rows):
+    """
+    Adds (item_id, proj_id, amt_used, date_used) rows to the daily and monthly rollups. Call it on the cursor
+    that inserted the same rows into the project_use table, after the insert, so both commit or roll back
+    together. The rollups are set up on first use if `python -m db_control.rollups` was never run.
+    """
+    if kind not in USE_TABLES:
+        raise KeyError(f"Unknown usage kind {kind}")
+    if ensure_rollups(cur):
+        return
+    if use_rows:
+        execute_values(cur, ROLLUP_UPSERT, [(kind,) + tuple(row) for row in use_rows])
+
+
+def create_rollups(conn):
+    with conn.cursor() as cur:
+        cur.execute(ROLLUP_DDL)
+
+
+def rebuild_rollups(conn):
+    # Recomputes both rollups from the usage tables, for the first load or after editing usage rows by hand
+    with conn.cursor() as cur:
+        cur.execute("TRUNCATE inventory_use_daily, inventory_use_monthly")
+        for kind, (use_table, id_col) in USE_TABLES.items():
+            cur.execute(f"""
+                INSERT INTO inventory_use_daily (kind, item_id, proj_id, day, amt_used, uses)
+                SELECT %s, {id_col}, proj_id, date_used::date, SUM(amt_used), COUNT(*)
+                FROM {use_table}
+                GROUP BY {id_col}, proj_id, date_used::date
+            """, (kind,))
+        cur.execute("""
+            INSERT INTO inventory_use_monthly (kind, item_id, proj_id, month, amt_used, uses)
+            SELECT kind, item_id, proj_id, date_trunc('month', day)::date, SUM(amt_used), SUM(uses)
+            FROM inventory_use_daily
+            GROUP BY kind, item_id, proj_id, date_trunc('month', day)::date
+        """)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Create or rebuild the inventory usage rollups.")
+    parser.add_argument("--rebuild", action="store_true", help="recompute the rollups from the usage tables")
+    args = parser.parse_args(argv)
+
+    with get_pool(config()).connection() as conn:
+        create_rollups(conn)
+        if args.rebuild:
+            rebuild_rollups(conn)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,192 @@
+import argparse
+import datetime as dt
+import json
+import os
+import shutil
+import time
+from decimal import Decimal
+from config import config
+from db_control.db_pool import get_pool
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+# Run history tables and the date column each one is partitioned and watermarked on
+EXPORT_TABLES = dict(
+    project_runs='run_date',
+    project_use_reagents='date_used',
+    project_use_consumables='date_used',
+    project_use_standards='date_used'
+)
+CHUNK_ROWS = 5000
+WATERMARK_FILE = '_watermarks.json'
+
+# Postgres type oids -> arrow types, anything else is exported as text
+ARROW_TYPES = {
+    16: 'bool',
+    20: 'int64',
+    21: 'int64',
+    23: 'int64',
+    700: 'float64',
+    701: 'float64',
+    1700: 'float64',
+    1082: 'date32',
+    1114: 'timestamp',
+}
+
+
+def arrow_type(type_code):
+    type_name = ARROW_TYPES.get(type_code, 'string')
+    if type_name == 'timestamp':
+        return pa.timestamp('us')
+    return getattr(pa, type_name)()
+
+
+def arrow_value(value, value_type):
+    if value is None:
+        return None
+    if isinstance(value, Decimal):
+        return float(value)
+    if value_type == pa.string() and not isinstance(value, str):
+        return str(value)
+    return value
+
+
+class RunHistoryExporter:
+    """
+    Streams the run history tables to Parquet, partitioned as <table>/proj_id=<id>/month=<YYYY-MM>/. Rows are read
+    through a server-side cursor CHUNK_ROWS at a time in date order, and a month's writers are closed as soon as the
+    rows move past it, so memory stays bounded by one chunk plus the open writers of about one month. Only complete days are exported (rows up to yesterday): the watermark is the last exported day
+    and the next run starts after it.
+    """
+    def __init__(self, output_dir, params=None, chunk_rows=CHUNK_ROWS):
+        if pa is None:
+            raise ImportError("pyarrow is required to export run history to Parquet")
+        self.output_dir = output_dir
+        self.pool = get_pool(params if params is not None else config())
+        self.chunk_rows = chunk_rows
+        self.watermark_path = os.path.join(output_dir, WATERMARK_FILE)
+        self.watermarks = self.read_watermarks()
+
+    def read_watermarks(self):
+        if not os.path.exists(self.watermark_path):
+            return {}
+        with open(self.watermark_path) as watermark_file:
+            return json.load(watermark_file)
+
+    def write_watermarks(self):
+        os.makedirs(self.output_dir, exist_ok=True)
+        temp_path = f"{self.watermark_path}.tmp"
+        with open(temp_path, 'w') as watermark_file:
+            json.dump(self.watermarks, watermark_file, indent=4, sort_keys=True)
+        os.replace(temp_path, self.watermark_path)
+
+    def export_all(self, full=False, until=None):
+        until = until or dt.date.today()
+        return {table: self.export_table(table, full=full, until=until) for table in EXPORT_TABLES}
+
+    def export_table(self, table, full=False, until=None):
+        """
+        Exports rows of `table` dated after the watermark and before `until` (today by default).
+        full=True drops the table's earlier export and starts over. Returns the number of rows written.
+        """
+        until = until or dt.date.today()
+        date_col = EXPORT_TABLES[table]
+        table_dir = os.path.join(self.output_dir, table)
+        if full:
+            shutil.rmtree(table_dir, ignore_errors=True)
+            self.watermarks.pop(table, None)
+        after = self.watermarks.get(table)
+
+        where_clause = f"{date_col} < %s"
+        params = [until]
+        if after is not None:
+            where_clause = f"{date_col} > %s AND {where_clause}"
+            params.insert(0, after)
+        query = f"""
+            SELECT * FROM {table}
+            WHERE {where_clause}
+            ORDER BY {date_col}
+        """
+
+        part_name = f"part-{until:%Y%m%d}-{time.time_ns()}.parquet"
+        writers = {}
+        # Paths of the partition files already closed
+        finished = []
+        total_rows = 0
+        try:
+            with self.pool.connection() as conn:
+                with conn.cursor(name=f"export_{table}") as cur:
+                    cur.itersize = self.chunk_rows
+                    cur.execute(query, params)
+                    while True:
+                        rows = cur.fetchmany(self.chunk_rows)
+                        if not rows:
+                            break
+                        columns = [column.name for column in cur.description]
+                        schema = pa.schema([
+                            (column.name, arrow_type(column.type_code)) for column in cur.description
+                        ])
+                        self.write_chunk(table_dir, part_name, writers, finished, columns, schema, date_col, rows)
+                        total_rows += len(rows)
+        except Exception:
+            # A failed export leaves no partial files behind, the next run exports the same rows again
+            for writer in writers.values():
+                writer.close()
+                finished.append(writer.where)
+            for file_path in finished:
+                os.remove(file_path)
+            raise
+        for writer in writers.values():
+            writer.close()
+
+        # Only move the watermark once every partition file is complete
+        self.watermarks[table] = (until - dt.timedelta(days=1)).isoformat()
+        self.write_watermarks()
+        return total_rows
+
+    def write_chunk(self, table_dir, part_name, writers, finished, columns, schema, date_col, rows):
+        proj_index = columns.index('proj_id')
+        date_index = columns.index(date_col)
+        # Rows come in date order, so no later chunk has rows for a month before this chunk's first one
+        first_month = str(rows[0][date_index])[:7]
+        for partition in [partition for partition in writers if partition[1] < first_month]:
+            writer = writers.pop(partition)
+            writer.close()
+            finished.append(writer.where)
+        partitions = {}
+        for row in rows:
+            partition = (row[proj_index], str(row[date_index])[:7])
+            partitions.setdefault(partition, []).append(row)
+
+        for (proj_id, month), partition_rows in partitions.items():
+            writer = writers.get((proj_id, month))
+            if writer is None:
+                partition_dir = os.path.join(table_dir, f"proj_id={proj_id}", f"month={month}")
+                os.makedirs(partition_dir, exist_ok=True)
+                writer = pq.ParquetWriter(os.path.join(partition_dir, part_name), schema)
+                writers[(proj_id, month)] = writer
+            arrays = [
+                pa.array([arrow_value(row[index], field.type) for row in partition_rows], type=field.type)
+                for index, field in enumerate(schema)
+            ]
+            writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Export run history tables to partitioned Parquet.")
+    parser.add_argument("output_dir", help="folder for the Parquet partitions and the watermark file")
+    parser.add_argument("--full", action="store_true", help="drop earlier exports and export everything again")
+    args = parser.parse_args(argv)
+
+    exporter = RunHistoryExporter(args.output_dir)
+    for table, rows in exporter.export_all(full=args.full).items():
+        print(f"{table}: {rows} rows")
+
+
+if __name__ == "__main__":
+    main()
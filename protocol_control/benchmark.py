@@ -0,0 +1,203 @@
+import argparse
+import contextlib
+import copy
+import io
+import json
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from protocol_control.protocol_engine import ExcelData, ProtocolEngine
+from protocol_control.protocol_form_v3 import Outputs
+from protocol_control.result_cache import RESULT_CACHE
+from protocol_control.session import ProtocolSession
+from protocol_control.template_builder import TemplateBuilder, Templates
+
+REPEAT = 5
+# A stage fails the comparison when its median is this many times the baseline median...
+REGRESSION_RATIO = 1.25
+# ...and slower by more than this many seconds, so sub-millisecond noise never fails a run
+REGRESSION_FLOOR = 0.002
+
+# Project and scheme from the bundled inventory workbook
+BENCH_PROJECT = dict(project="Akita", project_name_id=1, project_scheme=1)
+
+BASE_INPUTS = dict(
+    proj_id="bench", proj_file_option="", source=3, replicates="n + 2",
+    pd_vols=dict(pd_1_vol=90, pd_2_vol=90, pd_3_vol=90, pd_4_vol=90),
+    pd_spikes=dict(pd_1_spike=10, pd_2_spike=10, pd_3_spike=10, pd_4_spike=10),
+    dbi_vol=200, dbii_vol=90, dil_vols=dict(dil_vol_1=5, dil_vol_2=10, dil_vol_3=15, dil_vol_4=20),
+    cell_resus=200, standard_wells=2, standard_plates=0, standard_vol=0, run_notes="",
+    standard_stock=dict(standard_stock_conc=0.0, standard_stock_mw=0),
+    standard_concs={f"standard_conc_{num}": 0.0 for num in range(1, 7)},
+    standard_folds={f"standard_fold_{num}": 0.0 for num in range(1, 6)},
+)
+
+STANDARD_INPUTS = dict(
+    standard_plates=2, standard_vol=20,
+    standard_stock=dict(standard_stock_conc=1.5, standard_stock_mw=150000),
+    standard_concs={f"standard_conc_{num}": 100.0 / 3 ** (num - 1) for num in range(1, 7)},
+    standard_folds={f"standard_fold_{num}": 3.0 for num in range(1, 6)},
+)
+
+
+def synthetic_inputs():
+    """
+    (name, input_dict) cases covering SSF and Fermentation runs, 4 and 8 point dilutions and 0-4 predilution
+    plates. Every other case also has a standard curve.
+    """
+    cases = []
+    for proj_type, type_name in (("SSF_LS", "ssf"), ("Fermentation", "ferm")):
+        for points in (4, 8):
+            for total_pd in range(5):
+                input_dict = copy.deepcopy(BASE_INPUTS)
+                input_dict.update(BENCH_PROJECT, proj_type=proj_type, points=points, pd=total_pd)
+                name = f"{type_name}-{points}pt-pd{total_pd}"
+                if total_pd % 2:
+                    input_dict.update(copy.deepcopy(STANDARD_INPUTS))
+                    name += "-std"
+                cases.append((name, input_dict))
+    return cases
+
+
+class Benchmark:
+    """
+    Times the protocol hot paths: ExcelData.import_data (cold and cached), ProtocolEngine.run,
+    Outputs.run_outputs, Templates.fetch_template and TemplateBuilder with both writers. Each stage runs
+    `repeat` times for the timings and once more under tracemalloc for the peak memory, so tracing never
+    slows the timed runs. Result caches are cleared before every call so the calculations are really run.
+    """
+    def __init__(self, repeat=REPEAT, stages=None):
+        self.repeat = repeat
+        self.stages = stages
+        self.output_dir = tempfile.mkdtemp(prefix="protocol-bench-")
+        self.cases = synthetic_inputs()
+        self.results = {}
+
+    def run(self):
+        try:
+            self.run_stages()
+        finally:
+            shutil.rmtree(self.output_dir, ignore_errors=True)
+        return self.results
+
+    def run_stages(self):
+        # Warm up imports and the shared workbook cache so the first stage isn't charged for them
+        ExcelData()
+        self.measure("import_data_cold", self.import_data_cold)
+        self.measure("import_data_cached", ExcelData)
+        for proj_type in ("SSF_LS", "Fermentation"):
+            template = Templates(BENCH_PROJECT["project"], proj_type)
+            self.measure(f"fetch_template[{proj_type}]", template.fetch_template)
+
+        engine = ProtocolEngine(use_cache=False)
+        session = ProtocolSession()
+        with contextlib.redirect_stdout(io.StringIO()):
+            outputs = Outputs(session)
+        for name, input_dict in self.cases:
+            result = engine.run(input_dict)
+            self.measure(f"engine_run[{name}]", engine.run, input_dict)
+            session.capture(input_dict)
+            self.measure(f"run_outputs[{name}]", self.run_outputs, outputs)
+            self.measure(
+                f"write_to_excel[{name}]", TemplateBuilder, input_dict, result.output_dict,
+                writer='openpyxl', output_dir=self.output_dir
+            )
+            self.measure(
+                f"patch_excel[{name}]", TemplateBuilder, input_dict, result.output_dict,
+                writer='xml', output_dir=self.output_dir
+            )
+
+    @staticmethod
+    def import_data_cold():
+        ExcelData.clear_cache()
+        return ExcelData()
+
+    @staticmethod
+    def run_outputs(outputs):
+        RESULT_CACHE.clear()
+        # Outside a notebook display() prints the widget reprs
+        with contextlib.redirect_stdout(io.StringIO()):
+            outputs.run_outputs(None)
+
+    def measure(self, name, func, *args, **kwargs):
+        stage = name.split("[")[0]
+        if self.stages and stage not in self.stages:
+            return
+        times = []
+        for repeat in range(self.repeat):
+            start = time.perf_counter()
+            func(*args, **kwargs)
+            times.append(time.perf_counter() - start)
+
+        tracemalloc.start()
+        try:
+            func(*args, **kwargs)
+            current, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+        self.results[name] = dict(
+            median=statistics.median(times),
+            min=min(times),
+            max=max(times),
+            peak_kb=round(peak / 1024, 1)
+        )
+
+
+def compare(results, baseline, ratio=REGRESSION_RATIO, floor=REGRESSION_FLOOR):
+    # (name, baseline median, new median) of every stage that got slower than the allowed ratio
+    regressions = []
+    for name, result in results.items():
+        before = baseline.get(name)
+        if before is None:
+            continue
+        if result["median"] > before["median"] * ratio and result["median"] - before["median"] > floor:
+            regressions.append((name, before["median"], result["median"]))
+    return regressions
+
+
+def print_results(results, baseline=None):
+    print(f"{'stage':<44}{'median ms':>11}{'min ms':>10}{'peak KiB':>11}{'vs base':>9}")
+    for name, result in results.items():
+        change = ""
+        if baseline and name in baseline:
+            change = f"{result['median'] / baseline[name]['median']:.2f}x"
+        print(
+            f"{name:<44}{result['median'] * 1000:>11.2f}{result['min'] * 1000:>10.2f}"
+            f"{result['peak_kb']:>11.1f}{change:>9}"
+        )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the protocol calculation and template output paths.")
+    parser.add_argument("-r", "--repeat", type=int, default=REPEAT, help="timed runs per stage")
+    parser.add_argument("--stage", action="append", help="only run this stage (repeatable), e.g. engine_run")
+    parser.add_argument("--save", help="write the results to this JSON file, e.g. as a new baseline")
+    parser.add_argument("--compare", help="baseline JSON file; exits with 1 when a stage regressed")
+    parser.add_argument("--ratio", type=float, default=REGRESSION_RATIO, help="allowed slowdown vs the baseline")
+    args = parser.parse_args(argv)
+
+    results = Benchmark(args.repeat, args.stage).run()
+    baseline = None
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+    print_results(results, baseline)
+
+    if args.save:
+        with open(args.save, 'w') as results_file:
+            json.dump(results, results_file, indent=4)
+
+    if baseline is not None:
+        regressions = compare(results, baseline, args.ratio)
+        for name, before, after in regressions:
+            print(f"REGRESSION {name}: {before * 1000:.2f} ms -> {after * 1000:.2f} ms", file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,162 @@
+import argparse
+import sys
+import numpy as np
+import pandas as pd
+from protocol_control.protocol_cli import load_inputs
+from protocol_control.protocol_engine import ProtocolEngine
+
+# Excel caps sheet names at 31 characters
+SHEET_NAME_LIMIT = 31
+
+
+class CampaignPlan:
+    """
+    Result of CampaignPlanner.plan. runs has one row per run with its plate counts and the volumes it would need
+    on its own; preps has one row per (project, scheme) with the pooled volumes; reagents maps each prep group to
+    the reagent records for its pooled assay solution.
+    """
+    def __init__(self, runs, preps, reagents):
+        self.runs = runs
+        self.preps = preps
+        self.reagents = reagents
+
+    def savings(self):
+        # mL saved by pooling, compared with preparing every run on its own
+        separate = self.runs[['assay_req', 'dbi_vol_total', 'dbii_vol_total']].sum()
+        pooled = self.preps[['assay_req', 'dbi_vol_total', 'dbii_vol_total']].sum()
+        return (separate - pooled).to_dict()
+
+    def write_prep_sheet(self, output_file):
+        summary = pd.DataFrame([
+            dict(item=f"Saved by pooling: {column} (mL)", value=value) for column, value in self.savings().items()
+        ])
+        with pd.ExcelWriter(output_file, engine='openpyxl') as writer:
+            self.preps.to_excel(writer, sheet_name='Prep', index=False)
+            self.runs.to_excel(writer, sheet_name='Runs', index=False)
+            summary.to_excel(writer, sheet_name='Summary', index=False)
+            for (project, scheme), reagent_records in self.reagents.items():
+                sheet_name = f"{project} s{scheme}"[:SHEET_NAME_LIMIT]
+                reagent_table = pd.DataFrame(reagent_records[1:], columns=reagent_records[0])
+                reagent_table.to_excel(writer, sheet_name=sheet_name, index=False)
+        return output_file
+
+
+class CampaignPlanner:
+    """
+    Plans many runs at once. Plate counts and volumes for every run are worked out in one numpy pass, then runs
+    that share a project and scheme are pooled: one assay solution and one DBI/DBII preparation per group, so the
+    fixed Tempest prime volume (tempest_comp_three) and the 1 mL rounding are paid once per group instead of once
+    per run. The per-run numbers match ProtocolEngine.
+    """
+    def __init__(self, engine=None):
+        self.engine = engine if engine is not None else ProtocolEngine()
+
+    def plan(self, input_dicts):
+        engine = self.engine
+        runs = self.run_table(input_dicts)
+
+        group_keys = list(zip(runs['project'], runs['project_scheme']))
+        groups = list(dict.fromkeys(group_keys))
+        group_index = np.array([groups.index(key) for key in group_keys])
+
+        def group_sum(column):
+            return np.bincount(group_index, weights=runs[column].to_numpy(dtype=float), minlength=len(groups))
+
+        assay_rxn = group_sum('assay_rxn')
+        assay_dead = np.round(group_sum('assay_plate_dead') + engine.tempest_3, 3)
+        assay_req = np.floor(assay_rxn + assay_dead) + 1
+        dbi_vol_total = np.floor(group_sum('dbi_source_vol')) + 1 + np.ceil(group_sum('dbi_pd_vol'))
+        dbii_vol_total = np.floor(group_sum('dbii_source_vol')) + 1
+
+        preps = pd.DataFrame(dict(
+            project=[project for project, scheme in groups],
+            project_scheme=[scheme for project, scheme in groups],
+            runs=np.bincount(group_index, minlength=len(groups)),
+            total_proxiplates=group_sum('total_proxiplates').astype(int),
+            total_greiner=group_sum('total_greiner').astype(int),
+            total_pd=group_sum('total_pd').astype(int),
+            assay_rxn=assay_rxn,
+            assay_dead=assay_dead,
+            assay_req=assay_req,
+            dbi_vol_total=dbi_vol_total.astype(int),
+            dbii_vol_total=dbii_vol_total.astype(int),
+            standard_total_stock=group_sum('standard_total_stock'),
+            standard_total_dbi=group_sum('standard_total_dbi')
+        ))
+
+        reagents = {}
+        for (project, scheme), group_assay_req in zip(groups, assay_req):
+            reagent_dict = engine.get_reagents(project, scheme)
+            reagent_records, assay_tables = engine.calculate_reagents(reagent_dict, float(group_assay_req))
+            reagents[(project, scheme)] = reagent_records
+
+        return CampaignPlan(runs.drop(columns=['dbi_source_vol', 'dbi_pd_vol', 'dbii_source_vol']), preps, reagents)
+
+    def run_table(self, input_dicts):
+        engine = self.engine
+        source = np.array([run['source'] for run in input_dicts])
+        # Plate counts come from the engine itself so the plan can't drift from the printed protocols
+        plates = [engine.calculate_plates(run) for run in input_dicts]
+        base_plates = np.array([run_plates['total_greiner'] for run_plates in plates])
+        proxiplates = np.array([run_plates['total_proxiplates'] for run_plates in plates])
+
+        assay_rxn = engine.proxi_vols * engine.proxi_wells * proxiplates / engine.ml_ul_conv
+        assay_plate_dead = engine.proxi_vols * proxiplates * engine.tempest_1 * engine.tempest_2 / engine.ml_ul_conv
+        assay_dead = np.round(assay_plate_dead + engine.tempest_3, 3)
+
+        pd_vol = np.array([sum(run['pd_vols'].values()) for run in input_dicts])
+        dbi_vol = np.array([run['dbi_vol'] for run in input_dicts])
+        dbii_vol = np.array([run['dbii_vol'] for run in input_dicts])
+        dbi_source_vol = source * dbi_vol * engine.source_wells / engine.ml_ul_conv
+        dbi_pd_vol = pd_vol * source * engine.source_wells / engine.ml_ul_conv
+        dbii_source_vol = base_plates * dbii_vol * engine.proxi_wells / engine.ml_ul_conv
+
+        standard_total_stock = np.zeros(len(input_dicts))
+        standard_total_dbi = np.zeros(len(input_dicts))
+        for index, run in enumerate(input_dicts):
+            if run['standard_plates'] > 0:
+                standard_data, standard_solution = engine.calculate_standards(run)
+                standard_total_stock[index] = standard_solution['standard_total_stock']
+                standard_total_dbi[index] = standard_solution['standard_total_dbi']
+
+        return pd.DataFrame(dict(
+            proj_id=[run['proj_id'] for run in input_dicts],
+            project=[run['project'] for run in input_dicts],
+            project_scheme=[run['project_scheme'] for run in input_dicts],
+            total_proxiplates=proxiplates.astype(int),
+            total_greiner=base_plates.astype(int),
+            total_pd=np.array([run_plates['total_pd'] for run_plates in plates]),
+            assay_rxn=assay_rxn,
+            assay_plate_dead=assay_plate_dead,
+            assay_dead=assay_dead,
+            assay_req=np.floor(assay_rxn + assay_dead) + 1,
+            dbi_vol_total=(np.floor(dbi_source_vol) + 1 + np.ceil(dbi_pd_vol)).astype(int),
+            dbii_vol_total=(np.floor(dbii_source_vol) + 1).astype(int),
+            dbi_source_vol=dbi_source_vol,
+            dbi_pd_vol=dbi_pd_vol,
+            dbii_source_vol=dbii_source_vol,
+            standard_total_stock=standard_total_stock,
+            standard_total_dbi=standard_total_dbi
+        ))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Pool the preparations of many HiPrBind runs into one prep sheet.")
+    parser.add_argument("inputs", help="directory of captured input .json files, or a JSONL file of them")
+    parser.add_argument("-o", "--output", default="campaign_prep.xlsx", help="prep sheet to write")
+    args = parser.parse_args(argv)
+
+    runs, failed = load_inputs(args.inputs)
+    for label, error in failed:
+        print(f"FAILED {label}\n{error}", file=sys.stderr)
+    runs = [input_dict for label, input_dict in runs]
+    plan = CampaignPlanner().plan(runs)
+    plan.write_prep_sheet(args.output)
+    print(f"{len(runs)} runs in {len(plan.preps)} prep groups, written to {args.output}")
+    for column, saved in plan.savings().items():
+        print(f"  {column}: {saved:g} mL saved")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,86 @@
+import numpy as np
+from config import FixedHiPrBindCalcs
+
+
+class DilutionSolver:
+    """
+    Vectorized serial dilution solver. Row 0 of a run is the main source plate, rows 1-4 are the predilution plates.
+    Folds are the running product of the starting concentration and (1 + dbii / dil_vol) for every point, so all
+    plates of a run (and all runs of a batch) are solved with a single numpy.cumprod.
+    """
+    def __init__(self):
+        self.proxi_well_vol = FixedHiPrBindCalcs().proxi_well_vol
+        self.max_pd = 4
+        self.pd_points = 8
+
+    def batch_arrays(self, input_dicts):
+        # Starting concentration per plate (n_runs, 5) and dilution factor per point (n_runs, 5, 8), NaN padded
+        dil_vols = np.array([list(run['dil_vols'].values()) for run in input_dicts], dtype=float)
+        pd_vols = np.array([list(run['pd_vols'].values()) for run in input_dicts], dtype=float)
+        pd_spikes = np.array([list(run['pd_spikes'].values()) for run in input_dicts], dtype=float)
+        dbi_vol = np.array([run['dbi_vol'] for run in input_dicts], dtype=float)
+        dbii_vol = np.array([run['dbii_vol'] for run in input_dicts], dtype=float)
+        cell_resus = np.array([run['cell_resus'] for run in input_dicts], dtype=float)
+        total_pd = np.array([run['pd'] for run in input_dicts])
+        points = np.array([run['points'] for run in input_dicts])
+
+        plate_index = np.arange(1, 1 + self.max_pd)
+        point_index = np.arange(self.pd_points)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            dil_factors = np.tile(1 + dbii_vol[:, np.newaxis] / dil_vols, 2)
+            cell_conc = dbi_vol / cell_resus
+            pd_conc = cell_conc[:, np.newaxis] * (pd_vols / pd_spikes + 1)
+
+        used_pd = plate_index[np.newaxis, :] <= total_pd[:, np.newaxis]
+        start_conc = np.column_stack([cell_conc, np.where(used_pd, pd_conc, np.nan)])
+        # Main plate uses 4 or 8 points, predilution plates always run the full 8
+        used_points = np.concatenate([
+            (point_index[np.newaxis, :] < points[:, np.newaxis])[:, np.newaxis, :],
+            np.repeat(used_pd[:, :, np.newaxis], self.pd_points, axis=2)
+        ], axis=1)
+        factors = np.where(used_points, dil_factors[:, np.newaxis, :], np.nan)
+        return start_conc, factors
+
+    def solve_arrays(self, start_conc, factors):
+        # Prepend the starting concentration so cumprod multiplies in the same order as the original loop
+        steps = np.concatenate([start_conc[..., np.newaxis], factors], axis=-1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            folds = np.cumprod(steps, axis=-1)[..., 1:]
+            calced_vols = self.proxi_well_vol / folds
+        return folds, calced_vols
+
+    def solve(self, input_dict):
+        folds, calced_vols = self.solve_batch([input_dict])
+        return folds[0], calced_vols[0]
+
+    def solve_batch(self, input_dicts):
+        """
+        Solves many runs at once. Returns folds and calced volumes as (n_runs, n_plates, n_points) arrays, with
+        unused plates and points set to NaN.
+        """
+        start_conc, factors = self.batch_arrays(input_dicts)
+        return self.solve_arrays(start_conc, factors)
+
+    def check_inputs(self, input_dict, check_spikes=False):
+        # Keep the single run path failing loudly on a zero volume like the loop version did
+        used_spikes = list(input_dict['pd_spikes'].values())[:input_dict['pd']] if check_spikes else []
+        if (input_dict['cell_resus'] == 0 or input_dict['dbi_vol'] == 0 or 0 in input_dict['dil_vols'].values()
+                or 0 in used_spikes):
+            raise ZeroDivisionError("Cell pellet, DBI, dilution and spike volumes must be non-zero")
+
+    def calculate_volumes(self, input_dict):
+        self.check_inputs(input_dict)
+        folds, calced_vols = self.solve(input_dict)
+        points = input_dict['points']
+        return calced_vols[0, :points].tolist(), folds[0, :points].tolist()
+
+    def calculate_pd_volumes(self, input_dict):
+        self.check_inputs(input_dict, check_spikes=True)
+        folds, calced_vols = self.solve(input_dict)
+        pd_data = {}
+        for plate in range(1, input_dict['pd'] + 1):
+            pd_data[f'pd_{plate}'] = dict(
+                pd_folds=folds[plate].tolist(),
+                pd_calced_vols=calced_vols[plate].tolist()
+            )
+        return pd_data
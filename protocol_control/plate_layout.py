@@ -0,0 +1,307 @@
+import argparse
+import os
+import sys
+import numpy as np
+import pandas as pd
+from config import FixedHiPrBindCalcs
+from protocol_control.protocol_cli import load_inputs
+from protocol_control.protocol_engine import ProtocolEngine, greiners_per_source
+
+# Labware kinds, stored as small ints in the transfer array
+SOURCE, PREDILUTION, GREINER, PROXIPLATE, STANDARD_RACK, STANDARD_PLATE = range(6)
+PLATE_KINDS = np.array(['Source', 'Predilution', 'Greiner', 'ProxiPlate', 'Standard', 'Standard ProxiPlate'])
+PLATE_TYPES = np.array(['96w', '96w', '384w', '384w', 'tubes', '384w'])
+PLATE_WELLS = np.array([96, 96, 384, 384, 96, 384])
+
+# Transfer steps, in the order they are run on the bench
+PREDILUTE, DILUTE, STAMP, STANDARDS = range(4)
+STEP_NAMES = ['predilution', 'serial_dilution', 'stamp', 'standards']
+
+STANDARD_POINTS = 6
+# Greiner quadrants, a 384w plate holds four 96w plates' worth of wells
+QUADRANTS = 4
+
+TRANSFER_DTYPE = np.dtype([
+    ('run', np.uint32),
+    ('step', np.uint8),
+    ('src_kind', np.uint8),
+    ('src_plate', np.uint16),
+    ('src_well', np.uint16),
+    ('dst_kind', np.uint8),
+    ('dst_plate', np.uint16),
+    ('dst_well', np.uint16),
+    ('point', np.uint8),
+    ('replicate', np.uint8),
+    ('volume', np.float32),
+])
+
+
+def well_names(rows, cols):
+    return np.array([f"{chr(ord('A') + row)}{col + 1}" for row in range(rows) for col in range(cols)])
+
+
+WELL_NAMES_96 = well_names(8, 12)
+WELL_NAMES_384 = well_names(16, 24)
+
+
+def quadrant_wells(quadrant):
+    # 384w well index of every 96w well placed in the given quadrant (A1, A2, B1, B2 offsets)
+    rows, cols = np.divmod(np.arange(96), 12)
+    return (rows * 2 + quadrant // 2) * 24 + cols * 2 + quadrant % 2
+
+
+QUADRANT_WELLS = np.stack([quadrant_wells(quadrant) for quadrant in range(QUADRANTS)])
+
+
+def plate_key(runs, kinds, plates):
+    # One int64 per plate: run << 24 | kind << 16 | plate
+    return (runs.astype(np.int64) << 24) | (kinds.astype(np.int64) << 16) | plates.astype(np.int64)
+
+
+def transfer_block(count, **columns):
+    block = np.zeros(count, dtype=TRANSFER_DTYPE)
+    for name, value in columns.items():
+        block[name] = value
+    return block
+
+
+class PlateLayout:
+    """
+    Well-level layout of one or more runs as a single NumPy structured array (TRANSFER_DTYPE, 21 bytes a row),
+    one row per liquid transfer:
+    - predilution: every source well is spiked (pd_spike uL) into the same well of each predilution plate
+    - serial_dilution: point 0 comes from the source (or predilution) well, point n from point n - 1; points fill
+      the quadrants of the 384w Greiner plates ProtocolEngine.calculate_plates allocates (one per source or
+      predilution plate, two for Fermentation), four points per plate, dil_vol uL each. A run with more points
+      than those plates hold raises a ValueError, see check_points
+    - stamp: every Greiner well goes to the same ProxiPlate well, plus the replicate ProxiPlates
+    - standards: each of the 6 standard concentrations goes to standard_wells wells of every standard plate
+    Plates are numbered from 0 within a run and labware kind.
+    """
+    def __init__(self, input_dicts):
+        fixed_calcs = FixedHiPrBindCalcs()
+        self.source_wells = fixed_calcs.source_wells
+        self.proxi_wells = fixed_calcs.proxi_wells
+        self.proxi_well_vol = fixed_calcs.proxi_well_vol
+        self.labels = self.run_labels(input_dicts)
+        self.transfers = np.concatenate(
+            [self.run_transfers(index, run) for index, run in enumerate(input_dicts)]
+        ) if input_dicts else np.zeros(0, dtype=TRANSFER_DTYPE)
+
+    def run_transfers(self, run_index, run):
+        source = int(run['source'])
+        total_pd = int(run['pd'])
+        wells = np.arange(self.source_wells)
+        dil_vols = np.array(list(run['dil_vols'].values()), dtype=np.float32)
+        pd_spikes = np.array(list(run['pd_spikes'].values()), dtype=np.float32)
+        blocks = []
+
+        # Predilution plate index: source plate * total_pd + (pd - 1)
+        if total_pd:
+            plate, pd_index, well = np.meshgrid(np.arange(source), np.arange(total_pd), wells, indexing='ij')
+            blocks.append(transfer_block(
+                plate.size, run=run_index, step=PREDILUTE,
+                src_kind=SOURCE, src_plate=plate.ravel(), src_well=well.ravel(),
+                dst_kind=PREDILUTION, dst_plate=(plate * total_pd + pd_index).ravel(), dst_well=well.ravel(),
+                volume=pd_spikes[pd_index.ravel()]
+            ))
+
+        # Layer 0 is the source plate itself with the run's points, layers 1..pd are the predilution plates, which
+        # fill every quadrant. Each layer gets the Greiner plates the protocol allocates for it
+        layer_points = self.check_points(run)
+        layer_greiners = greiners_per_source(run['proj_type'])
+        greiner_count = 0
+        for layer in range(1 + total_pd):
+            points = int(run['points']) if layer == 0 else layer_points
+            plate, point, well = np.meshgrid(np.arange(source), np.arange(points), wells, indexing='ij')
+            plate, point, well = plate.ravel(), point.ravel(), well.ravel()
+            greiner = greiner_count + plate * layer_greiners + point // QUADRANTS
+            greiner_well = QUADRANT_WELLS[point % QUADRANTS, well]
+            previous = point > 0
+            src_kind = np.where(previous, GREINER, SOURCE if layer == 0 else PREDILUTION)
+            first_plate = plate if layer == 0 else plate * total_pd + layer - 1
+            src_plate = np.where(previous, greiner_count + plate * layer_greiners + (point - 1) // QUADRANTS, first_plate)
+            src_well = np.where(previous, QUADRANT_WELLS[(point - 1) % QUADRANTS, well], well)
+            blocks.append(transfer_block(
+                plate.size, run=run_index, step=DILUTE,
+                src_kind=src_kind, src_plate=src_plate, src_well=src_well,
+                dst_kind=GREINER, dst_plate=greiner, dst_well=greiner_well,
+                point=point, volume=dil_vols[point % len(dil_vols)]
+            ))
+            greiner_count += source * layer_greiners
+
+        # Greiner g goes to ProxiPlate g, replicate plates follow after the last Greiner copy
+        greiner_plates = np.arange(greiner_count)
+        replicate_sources = self.replicate_sources(run['replicates'], greiner_count)
+        stamp_sources = np.concatenate([greiner_plates, replicate_sources])
+        # Every Greiner plate is copied at most once, so the replicate number is 0 for the first copy and 1 after
+        replicates = np.concatenate([np.zeros(greiner_count, dtype=int), np.ones(replicate_sources.size, dtype=int)])
+        if stamp_sources.size:
+            proxi_wells = np.arange(self.proxi_wells)
+            stamp_plate = np.repeat(stamp_sources, self.proxi_wells)
+            blocks.append(transfer_block(
+                stamp_plate.size, run=run_index, step=STAMP,
+                src_kind=GREINER, src_plate=stamp_plate, src_well=np.tile(proxi_wells, stamp_sources.size),
+                dst_kind=PROXIPLATE, dst_plate=np.repeat(np.arange(stamp_sources.size), self.proxi_wells),
+                dst_well=np.tile(proxi_wells, stamp_sources.size),
+                replicate=np.repeat(replicates, self.proxi_wells), volume=self.proxi_well_vol
+            ))
+
+        standard_plates = int(run['standard_plates'])
+        if standard_plates > 0:
+            standard_wells = int(run['standard_wells'])
+            plate, point, replicate = np.meshgrid(
+                np.arange(standard_plates), np.arange(STANDARD_POINTS), np.arange(standard_wells), indexing='ij'
+            )
+            blocks.append(transfer_block(
+                plate.size, run=run_index, step=STANDARDS,
+                src_kind=STANDARD_RACK, src_plate=0, src_well=point.ravel(),
+                dst_kind=STANDARD_PLATE, dst_plate=plate.ravel(),
+                dst_well=(point * standard_wells + replicate).ravel(),
+                point=point.ravel(), replicate=replicate.ravel(), volume=run['standard_vol']
+            ))
+        return np.concatenate(blocks) if blocks else np.zeros(0, dtype=TRANSFER_DTYPE)
+
+    @staticmethod
+    def check_points(run):
+        # Points one source plate's Greiner plates hold; more would need plates the protocol doesn't allocate
+        layer_points = greiners_per_source(run['proj_type']) * QUADRANTS
+        if int(run['points']) > layer_points:
+            raise ValueError(
+                f"{run.get('proj_id')}: {run['points']} points don't fit the {layer_points // QUADRANTS} Greiner "
+                f"plate(s) per source plate a {run['proj_type']} run gets ({layer_points} points at most)"
+            )
+        return layer_points
+
+    @staticmethod
+    def run_labels(input_dicts):
+        # Plate name prefix per run; runs sharing a proj_id get their run number added so plate names stay unique
+        proj_ids = [run.get('proj_id') for run in input_dicts]
+        labels = []
+        for index, proj_id in enumerate(proj_ids):
+            if not proj_id:
+                labels.append(f"run{index}")
+            elif proj_ids.count(proj_id) > 1:
+                labels.append(f"{proj_id} run{index}")
+            else:
+                labels.append(proj_id)
+        return labels
+
+    @staticmethod
+    def replicate_sources(replicates, greiner_count):
+        # Same replicate rules as ProtocolEngine.calculate_plates
+        if greiner_count == 0:
+            return np.zeros(0, dtype=int)
+        if replicates == 'n + 1':
+            return np.array([0])
+        if replicates == 'n + 2':
+            return np.array([0]) if greiner_count == 1 else np.array([0, 1])
+        if replicates == 'n * 2':
+            return np.arange(greiner_count)
+        return np.zeros(0, dtype=int)
+
+    def plate_counts(self):
+        # Distinct plates per (run index, labware kind), from the transfer array
+        transfers = self.transfers
+        plate_keys = np.unique(np.concatenate([
+            plate_key(transfers['run'], transfers['src_kind'], transfers['src_plate']),
+            plate_key(transfers['run'], transfers['dst_kind'], transfers['dst_plate'])
+        ]))
+        kind_keys, counts = np.unique(plate_keys >> 16, return_counts=True)
+        return {
+            (int(kind_key >> 8), str(PLATE_KINDS[kind_key & 0xFF])): int(count)
+            for kind_key, count in zip(kind_keys, counts)
+        }
+
+    def check_plate_counts(self, input_dicts, engine=None):
+        # The picklists must use the same Greiner and ProxiPlate counts as the protocol that was printed
+        engine = engine or ProtocolEngine(use_cache=False)
+        counts = self.plate_counts()
+        for index, run in enumerate(input_dicts):
+            plates = engine.calculate_plates(run)
+            for kind, total in (('Greiner', plates['total_greiner']), ('ProxiPlate', plates['total_proxiplates'])):
+                found = counts.get((index, kind), 0)
+                if found != total:
+                    raise AssertionError(
+                        f"{self.labels[index]}: layout has {found} {kind} plates, the protocol has {total}"
+                    )
+
+    def picklist(self, steps=None):
+        """
+        Picklist DataFrame in the usual liquid handler column layout. steps limits it to some of
+        STEP_NAMES, e.g. ['stamp'].
+        """
+        transfers = self.transfers
+        if steps is not None:
+            transfers = transfers[np.isin(transfers['step'], [STEP_NAMES.index(step) for step in steps])]
+        return pd.DataFrame({
+            'Source Plate Name': self.plate_names(transfers['run'], transfers['src_kind'], transfers['src_plate']),
+            'Source Plate Type': PLATE_TYPES[transfers['src_kind']],
+            'Source Well': self.well_names(transfers['src_kind'], transfers['src_well']),
+            'Destination Plate Name': self.plate_names(transfers['run'], transfers['dst_kind'], transfers['dst_plate']),
+            'Destination Plate Type': PLATE_TYPES[transfers['dst_kind']],
+            'Destination Well': self.well_names(transfers['dst_kind'], transfers['dst_well']),
+            'Transfer Volume': transfers['volume'],
+            'Step': np.array(STEP_NAMES)[transfers['step']],
+            'Point': transfers['point'] + 1,
+            'Replicate': transfers['replicate'],
+        })
+
+    def plate_names(self, runs, kinds, plates):
+        # Names are built once per distinct plate and then gathered, not once per transfer
+        unique_keys, inverse = np.unique(plate_key(runs, kinds, plates), return_inverse=True)
+        names = np.array([
+            f"{self.labels[key >> 24]} {PLATE_KINDS[(key >> 16) & 0xFF]} {(key & 0xFFFF) + 1}" for key in unique_keys
+        ], dtype=object)
+        return names[inverse]
+
+    @staticmethod
+    def well_names(kinds, wells):
+        names = np.empty(len(wells), dtype=object)
+        is_384 = PLATE_WELLS[kinds] == 384
+        names[is_384] = WELL_NAMES_384[wells[is_384]]
+        names[~is_384] = WELL_NAMES_96[wells[~is_384]]
+        return names
+
+    def write_picklists(self, output_dir):
+        # One CSV per step, each step is a separate run on the liquid handler
+        os.makedirs(output_dir, exist_ok=True)
+        written = []
+        for step, step_name in enumerate(STEP_NAMES):
+            if not np.any(self.transfers['step'] == step):
+                continue
+            file_path = os.path.join(output_dir, f"{step_name}.csv")
+            self.picklist([step_name]).to_csv(file_path, index=False)
+            written.append(file_path)
+        return written
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Write well-level liquid handler picklists for HiPrBind runs.")
+    parser.add_argument("inputs", help="directory of captured input .json files, or a JSONL file of them")
+    parser.add_argument("-o", "--output-dir", default="picklists", help="folder for the picklist CSV files")
+    args = parser.parse_args(argv)
+
+    runs, failed = load_inputs(args.inputs)
+    for label, error in failed:
+        print(f"FAILED {label}\n{error}", file=sys.stderr)
+    checked = []
+    for label, input_dict in runs:
+        try:
+            PlateLayout.check_points(input_dict)
+        except ValueError as error:
+            failed.append((label, error))
+            print(f"FAILED {label}\n{error}", file=sys.stderr)
+        else:
+            checked.append(input_dict)
+    runs = checked
+    layout = PlateLayout(runs)
+    layout.check_plate_counts(runs)
+    print(f"{len(layout.transfers)} transfers ({layout.transfers.nbytes / 1e6:.1f} MB) for {len(runs)} runs")
+    for file_path in layout.write_picklists(args.output_dir):
+        print(f"  {file_path}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
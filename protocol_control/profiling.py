@@ -0,0 +1,163 @@
+import json
+import os
+import threading
+import time
+import tracemalloc
+from collections import deque
+
+try:
+    import ipywidgets as ipw
+except ImportError:
+    ipw = None
+
+# Stage records kept, the oldest are dropped first
+PROFILE_CAPACITY = 2000
+PANEL_ROWS = 50
+
+
+class NullStage:
+    # Returned while profiling is off, so an instrumented block costs one attribute check and an empty with
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+NULL_STAGE = NullStage()
+
+
+class Stage:
+    def __init__(self, profiler, name, args):
+        self.profiler = profiler
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.memory = self.profiler.trace_memory and tracemalloc.is_tracing()
+        self.start_memory = tracemalloc.get_traced_memory()[0] if self.memory else 0
+        self.start_cpu = time.thread_time_ns()
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        end = time.perf_counter_ns()
+        record = dict(
+            name=self.name,
+            start_us=(self.start - self.profiler.origin) / 1000,
+            wall_ms=(end - self.start) / 1e6,
+            cpu_ms=(time.thread_time_ns() - self.start_cpu) / 1e6,
+            alloc_kb=(tracemalloc.get_traced_memory()[0] - self.start_memory) / 1024 if self.memory else None,
+            thread=threading.get_ident(),
+            error=exc_type.__name__ if exc_type is not None else None,
+            args=self.args
+        )
+        self.profiler.records.append(record)
+        return False
+
+
+class StageProfiler:
+    """
+    Opt-in timing of the protocol stages. Instrumented code wraps each stage in `with PROFILER.stage(name):`;
+    while disabled that is a no-op. When enabled every stage records wall time, CPU time of its thread and,
+    with memory=True, the net memory it allocated (tracemalloc, which slows everything down noticeably).
+    Records go to a ring buffer of `capacity` entries and can be exported as Chrome trace JSON
+    (chrome://tracing or https://ui.perfetto.dev).
+    """
+    def __init__(self, capacity=PROFILE_CAPACITY):
+        self.enabled = False
+        self.trace_memory = False
+        self.records = deque(maxlen=capacity)
+        self.origin = time.perf_counter_ns()
+        self.started_tracemalloc = False
+
+    def enable(self, memory=False):
+        self.trace_memory = memory
+        if memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.started_tracemalloc = True
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+        if self.started_tracemalloc:
+            tracemalloc.stop()
+            self.started_tracemalloc = False
+        self.trace_memory = False
+
+    def clear(self):
+        self.records.clear()
+
+    def stage(self, name, **args):
+        if not self.enabled:
+            return NULL_STAGE
+        return Stage(self, name, args)
+
+    def summary(self):
+        # Per stage: calls, total and mean wall time, total CPU time; slowest stages first
+        totals = {}
+        for record in list(self.records):
+            total = totals.setdefault(record['name'], dict(calls=0, wall_ms=0.0, cpu_ms=0.0))
+            total['calls'] += 1
+            total['wall_ms'] += record['wall_ms']
+            total['cpu_ms'] += record['cpu_ms']
+        for total in totals.values():
+            total['mean_ms'] = total['wall_ms'] / total['calls']
+        return dict(sorted(totals.items(), key=lambda item: item[1]['wall_ms'], reverse=True))
+
+    def chrome_trace(self):
+        events = []
+        for record in list(self.records):
+            args = dict(record['args'], cpu_ms=round(record['cpu_ms'], 3))
+            if record['alloc_kb'] is not None:
+                args['alloc_kb'] = round(record['alloc_kb'], 1)
+            if record['error'] is not None:
+                args['error'] = record['error']
+            events.append(dict(
+                name=record['name'], cat='protocol', ph='X', pid=os.getpid(), tid=record['thread'],
+                ts=record['start_us'], dur=record['wall_ms'] * 1000, args=args
+            ))
+        return dict(traceEvents=events, displayTimeUnit='ms')
+
+    def export_chrome_trace(self, file_path):
+        with open(file_path, 'w') as trace_file:
+            json.dump(self.chrome_trace(), trace_file, default=str)
+        return file_path
+
+    def panel(self, rows=PANEL_ROWS):
+        """
+        Collapsed notebook panel with the per stage summary and the latest `rows` stage records.
+        """
+        if ipw is None:
+            raise ImportError("ipywidgets is required for the profiling panel")
+        summary_rows = "".join(
+            f"<tr><td>{name}</td><td>{total['calls']}</td><td>{total['wall_ms']:.2f}</td>"
+            f"<td>{total['mean_ms']:.2f}</td><td>{total['cpu_ms']:.2f}</td></tr>"
+            for name, total in self.summary().items()
+        )
+        record_rows = "".join(
+            f"<tr><td>{record['name']}</td><td>{record['wall_ms']:.2f}</td><td>{record['cpu_ms']:.2f}</td>"
+            f"<td>{format_kb(record['alloc_kb'])}</td></tr>"
+            for record in list(self.records)[-rows:]
+        )
+        panel = ipw.Accordion([ipw.VBox([
+            ipw.HTML(
+                "<table><tr><th>Stage</th><th>Calls</th><th>Total ms</th><th>Mean ms</th><th>CPU ms</th></tr>"
+                f"{summary_rows}</table>"
+            ),
+            ipw.HTML(
+                "<table><tr><th>Stage</th><th>Wall ms</th><th>CPU ms</th><th>Alloc KiB</th></tr>"
+                f"{record_rows}</table>"
+            ),
+        ])])
+        panel.set_title(0, "Profiling")
+        panel.selected_index = None
+        return panel
+
+
+def format_kb(alloc_kb):
+    return "" if alloc_kb is None else f"{alloc_kb:.1f}"
+
+
+# Shared by every instrumented stage in the process; PROFILER.enable() in a notebook cell turns it on
+PROFILER = StageProfiler()
@@ -0,0 +1,125 @@
+import argparse
+import glob
+import json
+import os
+import sys
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from protocol_control.protocol_engine import ProtocolEngine
+from protocol_control.result_cache import RESULT_CACHE
+from protocol_control.template_builder import TemplateBuilder
+
+# One engine per worker process, the inventory sheet is loaded once per process and shared by all its runs
+ENGINE = None
+
+
+def load_inputs(source):
+    """
+    Captured input dicts (captured_data.json schema) from a directory of .json files or a JSONL file.
+    Returns (runs, failed): runs is a list of (label, input_dict), the label points back to the file (and line)
+    of the run; failed lists (label, error) for files or lines that aren't valid JSON, so one bad run doesn't
+    stop the batch.
+    """
+    runs = []
+    failed = []
+    if os.path.isdir(source):
+        for file_path in sorted(glob.glob(os.path.join(source, "*.json"))):
+            with open(file_path) as json_file:
+                try:
+                    runs.append((file_path, json.load(json_file)))
+                except json.JSONDecodeError as error:
+                    failed.append((file_path, f"Invalid JSON: {error}\n"))
+    else:
+        with open(source) as jsonl_file:
+            for line_number, line in enumerate(jsonl_file, start=1):
+                if line.strip():
+                    label = f"{source}:{line_number}"
+                    try:
+                        runs.append((label, json.loads(line)))
+                    except json.JSONDecodeError as error:
+                        failed.append((label, f"Invalid JSON: {error}\n"))
+    return runs, failed
+
+
+def init_worker(cache_dir=None):
+    global ENGINE
+    # Workers share computed protocols through the disk tier of the result cache
+    RESULT_CACHE.disk_dir = cache_dir
+    ENGINE = ProtocolEngine()
+
+
+def write_protocol(label, input_dict, output_dir, writer):
+    # Errors are returned as text so a failing run is reported and the rest of the campaign keeps going
+    try:
+        result = ENGINE.run(input_dict)
+        builder = TemplateBuilder(input_dict, result.output_dict, writer=writer, output_dir=output_dir)
+        return label, builder.output_file, None
+    except Exception:
+        return label, None, traceback.format_exc()
+
+
+def unique_targets(runs, output_dir=None):
+    """
+    Splits runs into the ones to write and (label, error) for runs that would overwrite the protocol file of an
+    earlier run in the batch; workers writing the same file at once would leave a corrupt workbook.
+    """
+    targets = {}
+    unique = []
+    clashes = []
+    for label, input_dict in runs:
+        try:
+            output_file = os.path.normcase(os.path.abspath(TemplateBuilder.output_path(input_dict, output_dir)))
+        except KeyError:
+            # Missing inputs are reported by the worker like any other failing run
+            unique.append((label, input_dict))
+            continue
+        first = targets.setdefault(output_file, label)
+        if first == label:
+            unique.append((label, input_dict))
+        else:
+            clashes.append((label, f"Same protocol file as {first}: {output_file}\n"))
+    return unique, clashes
+
+
+def run_protocols(runs, output_dir=None, writer='xml', workers=None, cache_dir=None):
+    written = []
+    runs, failed = unique_targets(runs, output_dir)
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(cache_dir,)) as executor:
+        futures = [
+            executor.submit(write_protocol, label, input_dict, output_dir, writer) for label, input_dict in runs
+        ]
+        for future in as_completed(futures):
+            label, output_file, error = future.result()
+            if error is None:
+                written.append((label, output_file))
+            else:
+                failed.append((label, error))
+    return written, failed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Write HiPrBind protocols for many captured input dicts at once.")
+    parser.add_argument("inputs", help="directory of captured_data.json style files, or a JSONL file of them")
+    parser.add_argument("-o", "--output-dir", default="outputs", help="folder for the SSF/Ferm run folders")
+    parser.add_argument("-w", "--workers", type=int, default=None, help="worker processes (default: cpu count)")
+    parser.add_argument("--writer", choices=["xml", "openpyxl"], default="xml", help="how workbooks are written")
+    parser.add_argument("--cache-dir", default=None, help="folder to keep computed protocols in between runs")
+    args = parser.parse_args(argv)
+
+    runs, unreadable = load_inputs(args.inputs)
+    start = time.perf_counter()
+    written, failed = run_protocols(runs, args.output_dir, args.writer, args.workers, args.cache_dir)
+    elapsed = time.perf_counter() - start
+    failed = unreadable + failed
+
+    for label, error in failed:
+        print(f"FAILED {label}\n{error}", file=sys.stderr)
+    total = len(written) + len(failed)
+    rate = len(runs) / elapsed if elapsed else 0.0
+    print(f"{len(written)} written, {len(failed)} failed, {total} runs in {elapsed:.2f}s ({rate:.1f} runs/s)")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
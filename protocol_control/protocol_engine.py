@@ -0,0 +1,410 @@
+import json
+import os
+import threading
+import pandas as pd
+from config import FixedHiPrBindCalcs
+from protocol_control.dilution_solver import DilutionSolver
+from protocol_control.profiling import PROFILER
+from protocol_control.result_cache import RESULT_CACHE, result_key
+
+try:
+    import pyarrow as pa
+    from pyarrow import feather
+except ImportError:
+    pa = None
+    feather = None
+
+
+# Parsed inventory sheets shared by every ExcelData in the process,
+# keyed on (path, worksheet) -> (mtime, frame, lookup)
+REAGENT_DATA_CACHE = {}
+REAGENT_DATA_LOCK = threading.Lock()
+
+
+def greiners_per_source(proj_type):
+    # Greiner plates one source (or predilution) plate is diluted into, Fermentation runs take two
+    return 2 if proj_type == 'Fermentation' else 1
+
+
+class ExcelData:
+    def __init__(self):
+        # self.file_path = r"L:\High Throughput Screening\HiPrBind\HiPrBind Inventory Tracking.xlsx"
+        # self.file_path = Path.home().joinpath("Protocol-Builder", "templates", "HiPrBind Inventory Tracking.xlsx")
+        self.file_path = f"templates/HiPrBind Inventory Tracking.xlsx"
+        self.worksheet = 'Project Specific Reagents'
+        self.snapshot_path = f"{os.path.splitext(self.file_path)[0]} - {self.worksheet}.feather"
+        self.reagent_lookup = {}
+        # Identifies the workbook contents the data was read from, part of the protocol result cache key
+        self.version = None
+        self.reagent_data = self.import_data()
+
+    def import_data(self):
+        # The workbook is only parsed again when its modified time changes; callers share the same frame
+        cache_key = (os.path.abspath(self.file_path), self.worksheet)
+        mtime = os.path.getmtime(self.file_path)
+        self.version = [*cache_key, mtime]
+        with REAGENT_DATA_LOCK:
+            cached = REAGENT_DATA_CACHE.get(cache_key)
+            if cached is not None and cached[0] == mtime:
+                self.reagent_lookup = cached[2]
+                return cached[1]
+            reagent_data = self.read_snapshot(mtime)
+            if reagent_data is None:
+                reagent_data = pd.read_excel(self.file_path, sheet_name=self.worksheet, index_col=[0], skiprows=1)
+                self.write_snapshot(reagent_data)
+            self.reagent_lookup = self.build_lookup(reagent_data)
+            REAGENT_DATA_CACHE[cache_key] = (mtime, reagent_data, self.reagent_lookup)
+        return reagent_data
+
+    def build_lookup(self, reagent_data):
+        """
+        Splits the sheet once per project so the get_* lookups below are dict reads instead of re-filtering the
+        whole frame. reagents is keyed on (project, scheme); (project, 0) holds the scheme 0 rows that every other
+        scheme falls back to.
+        """
+        lookup = dict(projects={}, schemes={}, reagents={}, standards={})
+        is_standard = reagent_data["Reagent"].str.contains('standard', case=False).to_numpy(dtype=bool)
+        is_standard_exact = reagent_data["Reagent"].str.contains('standard').to_numpy(dtype=bool)
+        project_positions = reagent_data.groupby(level=0, sort=False).indices
+        # Keep sheet order, project ids in get_projects are positions in this list
+        for project in reagent_data.index.unique():
+            positions = project_positions[project]
+            project_data = reagent_data.iloc[positions]
+            project_standard = is_standard[positions]
+            project_standard_exact = is_standard_exact[positions]
+            lookup['schemes'][project] = list(project_data[~project_standard_exact]["Scheme"])
+            lookup['standards'][project] = project_data[project_standard]
+
+            reagent_data_wo_standard = project_data[~project_standard].sort_values("Assay")
+            scheme_list = [int(num) for num in list(project_data["Scheme"].unique()) if num > 0]
+            lookup['projects'][project] = scheme_list
+            for scheme in [0] + scheme_list:
+                reagent_data_scheme = reagent_data_wo_standard.loc[reagent_data_wo_standard["Scheme"].isin([0, scheme])]
+                lookup['reagents'][(project, scheme)] = dict(
+                    reagent_data=reagent_data_scheme,
+                    reagent_records=reagent_data_scheme.to_dict(orient='records')
+                )
+        return lookup
+
+    def get_reagent_lookup(self, project, scheme):
+        reagent_lookup = self.reagent_lookup['reagents']
+        if project not in self.reagent_lookup['projects']:
+            raise KeyError(project)
+        return reagent_lookup.get((project, scheme), reagent_lookup[(project, 0)])
+
+    def read_snapshot(self, mtime):
+        # Feather sidecar is memory-mapped instead of parsing the xlsx, as long as it is newer than the workbook
+        if feather is None or not os.path.exists(self.snapshot_path) or os.path.getmtime(self.snapshot_path) < mtime:
+            return None
+        try:
+            table = feather.read_table(self.snapshot_path, memory_map=True)
+        except (OSError, pa.ArrowInvalid):
+            return None
+        metadata = json.loads(table.schema.metadata[b'excel_data'])
+        reagent_data = table.to_pandas()
+        # Mixed type columns (e.g. numbers and notes in one column) were stored as JSON text
+        for column in metadata['json_columns']:
+            reagent_data[column] = pd.Series(
+                [json.loads(value) for value in reagent_data[column]], index=reagent_data.index, dtype=object
+            )
+        return reagent_data.set_index(metadata['index_col'])
+
+    def write_snapshot(self, reagent_data):
+        if feather is None:
+            return
+        # The snapshot is only a speed-up: cells that don't survive JSON (e.g. a date among text) or Arrow mean
+        # no snapshot, and the workbook is parsed again next time
+        snapshot_data = reagent_data.reset_index()
+        json_columns = [column for column in reagent_data.columns if reagent_data[column].dtype == object]
+        try:
+            for column in json_columns:
+                snapshot_data[column] = [json.dumps(value) for value in snapshot_data[column]]
+            metadata = dict(index_col=reagent_data.index.name, json_columns=json_columns)
+            table = pa.Table.from_pandas(snapshot_data, preserve_index=False)
+            table = table.replace_schema_metadata({**table.schema.metadata, b'excel_data': json.dumps(metadata)})
+        except (TypeError, ValueError, pa.ArrowException):
+            return
+        try:
+            feather.write_feather(table, self.snapshot_path)
+        except OSError:
+            # Read-only share; keep going with the parsed workbook
+            pass
+
+    @staticmethod
+    def clear_cache():
+        with REAGENT_DATA_LOCK:
+            REAGENT_DATA_CACHE.clear()
+
+    def get_projects(self):
+        project_list = list(self.reagent_lookup['projects'])
+        project_dict = {value: project_list.index(value) + 1 for value in project_list}
+        scheme_dict = {}
+        for project, value in project_dict.items():
+            scheme_dict[value] = list(self.reagent_lookup['projects'][project])
+        project_dict["..."] = 0
+        scheme_dict[0] = []
+        return project_dict, scheme_dict
+
+    def get_scheme(self, project):
+        scheme_list = list(self.reagent_lookup['schemes'][project])
+        return scheme_list
+
+    def get_reagent_data(self, project, scheme):
+        reagent_data_scheme = self.get_reagent_lookup(project, scheme)['reagent_data']
+        return reagent_data_scheme
+
+    def get_reagent_records(self, project, scheme):
+        reagent_records = self.get_reagent_lookup(project, scheme)['reagent_records']
+        return reagent_records
+
+    def get_standard_data(self, project):
+        reagent_data_w_standard = self.reagent_lookup['standards'][project]
+        return reagent_data_w_standard
+
+
+class ProtocolResult:
+    """
+    Plain container for a computed protocol. output_dict has the same layout the Outputs form builds, so it can
+    be handed straight to TemplateBuilder.
+    """
+    def __init__(self, inputs):
+        self.inputs = inputs
+        self.output_dict = {}
+        self.reagent_records = []
+
+
+class ProtocolEngine:
+    """
+    Headless protocol calculator. Takes the captured_data.json input dict and returns a ProtocolResult without
+    building any widgets, so protocols can be computed from a script or worker process. The widget classes in
+    protocol_form_v3 are views over these methods.
+    """
+    def __init__(self, excel_data=None, use_cache=True):
+        fixed_calcs = FixedHiPrBindCalcs()
+        self.proxi_wells = fixed_calcs.proxi_wells
+        self.source_wells = fixed_calcs.source_wells
+        self.proxi_vols = fixed_calcs.proxi_well_vol
+        self.ml_ul_conv = fixed_calcs.ml_ul_conv
+        self.tempest_1 = fixed_calcs.tempest_comp_one
+        self.tempest_2 = fixed_calcs.tempest_comp_two
+        self.tempest_3 = fixed_calcs.tempest_comp_three
+        self.standard_buffer_amount = fixed_calcs.standard_buffer_amount
+        self.excel_data = excel_data
+        self.dilution_solver = DilutionSolver()
+        self.cache = RESULT_CACHE if use_cache else None
+
+    def get_excel_data(self):
+        # Workbook is only read when reagents are needed, and then reused for every run of this engine
+        if self.excel_data is None:
+            self.excel_data = ExcelData()
+        return self.excel_data
+
+    def run(self, input_dict):
+        # Runs that only differ in labels (proj_id, notes) share one cached result
+        if self.cache is None:
+            return self.compute(input_dict)
+        with PROFILER.stage("ExcelReagents.read_inventory"):
+            inventory_version = self.get_excel_data().version
+        with PROFILER.stage("ProtocolEngine.cache_lookup"):
+            key = result_key(input_dict, inventory_version)
+            cached = self.cache.get(key)
+        if cached is not None:
+            result = ProtocolResult(input_dict)
+            result.output_dict, result.reagent_records = cached
+            return result
+        result = self.compute(input_dict)
+        self.cache.put(key, result.output_dict, result.reagent_records)
+        return result
+
+    def compute(self, input_dict):
+        # Stage names follow the form classes each calculation belongs to
+        result = ProtocolResult(input_dict)
+        output_dict = result.output_dict
+        with PROFILER.stage("TotalPlates.calculate"):
+            output_dict.update(self.calculate_plates(input_dict))
+
+        if input_dict["standard_plates"] > 0:
+            with PROFILER.stage("StandardData.calculate"):
+                standard_data, standard_solution = self.calculate_standards(input_dict)
+            output_dict['standard_solution'] = standard_solution
+            output_dict['standard_data'] = standard_data
+
+        with PROFILER.stage("Assays.calculate"):
+            output_dict.update(self.calculate_assay(output_dict['total_proxiplates']))
+        with PROFILER.stage("DilutionBuffer.calculate"):
+            output_dict.update(self.calculate_dilution_buffers(input_dict, output_dict['total_greiner']))
+
+        with PROFILER.stage("ExcelReagents.read_inventory"):
+            reagent_dict = self.get_reagents(input_dict['project'], input_dict['project_scheme'])
+        with PROFILER.stage("ExcelReagents.calculate"):
+            result.reagent_records, reagent_details = self.calculate_reagents(reagent_dict, output_dict['assay_req'])
+        output_dict['reagent_details'] = reagent_details
+        output_dict['assays'] = reagent_details
+
+        with PROFILER.stage("VolumeCalculations.calculate_volumes"):
+            calced_vols, folds = self.calculate_volumes(input_dict)
+        output_dict['calced_vols'] = calced_vols
+        output_dict['folds'] = folds
+
+        if input_dict['proj_type'] == 'Fermentation':
+            with PROFILER.stage("VolumeCalculations.calculate_pd_volumes"):
+                output_dict['pd_vols_data'] = self.calculate_pd_volumes(input_dict)
+
+        return result
+
+    def run_batch(self, input_dicts):
+        return [self.run(input_dict) for input_dict in input_dicts]
+
+    def calculate_plates(self, input_dict):
+        source = input_dict["source"]
+        replicates = input_dict["replicates"]
+        proj_type = input_dict["proj_type"]
+        total_pd = int(input_dict["pd"])
+
+        total_proxiplates = source * greiners_per_source(proj_type) * (1 + total_pd)
+
+        total_greiner = int(total_proxiplates)
+        total_pd *= source
+
+        if replicates == 'n + 2':
+            if total_proxiplates == 1:
+                total_proxiplates += 1
+            else:
+                total_proxiplates += 2
+        elif replicates == 'n + 1':
+            total_proxiplates += 1
+        elif replicates == 'n * 2':
+            total_proxiplates *= 2
+
+        plate_details = dict(
+            total_pd=int(total_pd),
+            total_greiner=total_greiner,
+            total_proxiplates=int(total_proxiplates)
+        )
+        return plate_details
+
+    def calculate_assay(self, proxiplates):
+        assay_rxn = float((self.proxi_vols * self.proxi_wells * proxiplates) / self.ml_ul_conv)
+        assay_dead = float(round((self.proxi_vols * proxiplates * self.tempest_1 * self.tempest_2) /
+                                 self.ml_ul_conv + self.tempest_3, 3))
+        assay_req = float(int((assay_rxn + assay_dead)) + 1)
+        assay_details = dict(
+            assay_rxn=assay_rxn,
+            assay_dead=assay_dead,
+            assay_req=assay_req
+        )
+        return assay_details
+
+    def calculate_dilution_buffers(self, input_dict, greiner):
+        source = input_dict['source']
+        pd_vols = input_dict['pd_vols']
+        dbi_vol = input_dict['dbi_vol']
+        dbii_vol = input_dict['dbii_vol']
+        total_pd_vol = sum([vol for vol in pd_vols.values()])
+        # temp
+        standard_scheme_total_dbi = 0
+
+        pd_total_vol = -(-((total_pd_vol * int(source) * self.source_wells) / self.ml_ul_conv) // 1)
+
+        dbi_vol_total = (int((int(source) * dbi_vol * self.source_wells) / self.ml_ul_conv) + 1) \
+            + pd_total_vol + standard_scheme_total_dbi
+        dbii_vol_total = int((int(greiner) * dbii_vol * self.proxi_wells) / self.ml_ul_conv) + 1
+        db_details = dict(
+            dbi_vol_total=int(dbi_vol_total),
+            dbii_vol_total=int(dbii_vol_total)
+        )
+        return db_details
+
+    def calculate_standards(self, input_dict):
+        standard_plates = input_dict["standard_plates"]
+        standard_wells = input_dict["standard_wells"]
+        standard_vol = input_dict["standard_vol"]
+        all_folds = input_dict["standard_folds"]
+        fold_1 = all_folds["standard_fold_1"]
+        conc_1 = input_dict["standard_concs"]["standard_conc_1"]
+        standard_stock_conc = input_dict["standard_stock"]["standard_stock_conc"]
+        standard_stock_mw = input_dict["standard_stock"]["standard_stock_mw"]
+
+        standard_base_wvol = standard_plates * standard_wells * standard_vol + self.standard_buffer_amount
+        standard_total_vol = int(standard_base_wvol * (1 / (fold_1 - 1) + 1))
+        standard_stock_nm = (standard_stock_conc / standard_stock_mw) * 1000000000
+        standard_total_stock = float(round((conc_1 * standard_total_vol) / standard_stock_nm, 2))
+        standard_total_dbi = float(round(standard_total_vol - standard_total_stock, 2))
+
+        well_labels = [f"Well {num}" for num in range(2, 7)]
+        transfer_vols = [str(round(standard_base_wvol / (fold - 1), 0)) for fold in all_folds.values()]
+        dbi_pre_vols = [standard_base_wvol for repeat in range(0, 5)]
+
+        standard_data = [well_labels, dbi_pre_vols, transfer_vols]
+        standard_solution = dict(
+            standard_total_vol=standard_total_vol,
+            standard_total_stock=standard_total_stock,
+            standard_total_dbi=standard_total_dbi
+        )
+        return standard_data, standard_solution
+
+    def get_reagents(self, project, scheme):
+        reagent_dict = self.get_excel_data().get_reagent_records(project, scheme)
+        return reagent_dict
+
+    def calculate_reagents(self, reagent_dict, assay_req):
+        reagent_records = [["Reagent", "Assay", "Cat_Num", "Conc. (ug/uL)", 'Desired conc. (nM)', 'Needed vol (uL)']]
+
+        for reagent in FixedHiPrBindCalcs().excel_reagents:
+            conc_ug_ul = reagent[-1]
+            desired_conc = reagent[-2]
+            needed_vol = round(assay_req * desired_conc / conc_ug_ul * 1000, 2)
+            reagent_records.append(reagent + [needed_vol])
+
+        for reagent in reagent_dict:
+            try:
+                int(reagent["Conc. (ug/uL)"])
+            except ValueError:
+                pass
+            else:
+                reagent_name = reagent["Reagent"]
+                assay_num = int(reagent["Assay"])
+                desired_conc = reagent['Desired conc. (nM)']
+                cat_num = reagent["Cat. No./Code"]
+
+                if 'bead' in reagent["Reagent"]:
+                    conc_ug_ul = reagent["Conc. (ug/uL)"]
+                    needed_vol = round((desired_conc / conc_ug_ul) * 1000 * assay_req, 2)
+                    reagent_record = [reagent_name, assay_num, cat_num, conc_ug_ul, desired_conc, needed_vol]
+
+                else:
+                    conc_nm = reagent['Conc. (nM)']
+                    needed_vol = round(desired_conc * (assay_req * 1000 / conc_nm), 2)
+                    reagent_record = [reagent_name, assay_num, cat_num, conc_nm, desired_conc, needed_vol]
+
+                reagent_records.append(reagent_record)
+
+        assay_details = self.prepare_reagent_tables(reagent_dict, reagent_records, assay_req)
+        return reagent_records, assay_details
+
+    def prepare_reagent_tables(self, reagent_dict, reagent_records, assay_req):
+        assay_list = list(
+            set(
+                [int(reagent["Assay"]) for reagent in reagent_dict if not isinstance(reagent["Assay"], dict)]
+            )
+        )
+        assay_table_dict = {}
+        for assay in assay_list:
+            assay_table_dict[f"Assay {assay}"] = [row for row in reagent_records[1:] if row[1] == assay]
+            assay_table_dict[f"Assay {assay}"].insert(0, reagent_records[0])
+            assay_totals = ["", "", "", "", "Total Assay (mL):", assay_req * 1000]
+            dbii_totals = ["", "", "", "", f"DBII for assay {assay} (mL):", round(assay_req - (sum(
+                [float(row[-1]) for row in reagent_records[1:] if row[1] == assay]
+            ) / 1000), 3) * 1000]
+            assay_table_dict[f"Assay {assay}"].extend([dbii_totals])
+            assay_table_dict[f"Assay {assay}"].extend([assay_totals])
+
+        return assay_table_dict
+
+    def calculate_volumes(self, input_dict):
+        calced_vols, folds = self.dilution_solver.calculate_volumes(input_dict)
+        return calced_vols, folds
+
+    def calculate_pd_volumes(self, input_dict):
+        pd_data = self.dilution_solver.calculate_pd_volumes(input_dict)
+        return pd_data
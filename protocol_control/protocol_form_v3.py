@@ -1,12 +1,13 @@
-import json
-import os
 from pathlib import Path
-import pandas as pd
 import ipywidgets as ipw
-from openpyxl import load_workbook
 from IPython.display import display
 # from db_control.db_restructure import Db
-from config import config, Headers, FixedHiPrBindCalcs
+from config import config, Headers
+from protocol_control.protocol_engine import ExcelData, ProtocolEngine
+from protocol_control.profiling import PROFILER
+from protocol_control.reactive import ReactiveGraph
+from protocol_control.session import SESSION
+from protocol_control.template_builder import TemplateBuilder
 
 
 # class DbQuery(Db):
@@ -14,47 +15,10 @@ from config import config, Headers, FixedHiPrBindCalcs
 #         super().__init__(params)
 
 
-class ExcelData:
-    def __init__(self):
-        # self.file_path = r"L:\High Throughput Screening\HiPrBind\HiPrBind Inventory Tracking.xlsx"
-        # self.file_path = Path.home().joinpath("Protocol-Builder", "templates", "HiPrBind Inventory Tracking.xlsx")
-        self.file_path = f"templates/HiPrBind Inventory Tracking.xlsx"
-        self.worksheet = 'Project Specific Reagents'
-        self.reagent_data = self.import_data()
-
-    def import_data(self):
-        reagent_data = pd.read_excel(self.file_path, sheet_name=self.worksheet, index_col=[0], skiprows=1)
-        return reagent_data
-
-    def get_projects(self):
-        project_list = list(self.reagent_data.index.unique())
-        project_dict = {value: project_list.index(value) + 1 for value in project_list}
-        scheme_dict = {}
-        for project, value in project_dict.items():
-            scheme_dict[value] = [int(num) for num in list(self.reagent_data.loc[project]["Scheme"].unique()) if num > 0]
-        project_dict["..."] = 0
-        scheme_dict[0] = []
-        return project_dict, scheme_dict
-
-    def get_scheme(self, project):
-        reagent_data = self.reagent_data.loc[project]
-        scheme_list = list(reagent_data[~reagent_data["Reagent"].str.contains('standard')]["Scheme"])
-        return scheme_list
-
-    def get_reagent_data(self, project, scheme):
-        reagent_data = self.reagent_data.loc[project].sort_values("Assay")
-        reagent_data_wo_standard = reagent_data[~reagent_data["Reagent"].str.contains('standard', case=False)]
-        reagent_data_scheme = reagent_data_wo_standard.loc[reagent_data_wo_standard["Scheme"].isin([0, scheme])]
-        return reagent_data_scheme
-
-    def get_standard_data(self, project):
-        reagent_data = self.reagent_data.loc[project]
-        reagent_data_w_standard = reagent_data[reagent_data["Reagent"].str.contains('standard', case=False)]
-        return reagent_data_w_standard
-
-
 class ProtocolForm:
-    def __init__(self):
+    def __init__(self, session=None):
+        # Captured inputs go to Outputs through the session instead of a file in the working directory
+        self.session = session if session is not None else SESSION
         self.proj_details = ProjectDetails()
         self.plate_details = PlateDetails()
         self.dil_details = DilutionDetails()
@@ -73,6 +37,12 @@ class ProtocolForm:
             button_style="info"
         )
         self.capture_inputs_button.on_click(self.capture_inputs)
+        self.save_inputs_button = ipw.Button(
+            description="Save Inputs",
+            button_style="info"
+        )
+        self.save_inputs_button.on_click(self.save_inputs)
+        self.save_message = ipw.HTML()
 
         self.add_standard_button = ipw.Button(
             description="Add Standard",
@@ -104,8 +74,9 @@ class ProtocolForm:
             ipw.HTML("<h5><b>Execution Notes:</b></h5>"),
             self.run_notes,
             ipw.HTML("<br>"),
-            self.capture_inputs_button,
+            ipw.HBox([self.capture_inputs_button, self.save_inputs_button]),
             self.display_message,
+            self.save_message,
             ])
         # display(self.outbox)
         display(form_display)
@@ -141,10 +112,26 @@ class ProtocolForm:
         self.data_dict["run_notes"] = self.run_notes.value
         # self.data_dict.update(proj_details_dict, plate_details_dict)
         # self.out_display.children = [ipw.HTML(f"{value}") for value in self.data_dict.values()]
-        with open('captured_data.json', 'w') as captured_data:
-            json.dump(self.data_dict, captured_data, indent=4)
+        self.session.capture(self.data_dict)
         # display(self.data_dict)
 
+    def save_inputs(self, event):
+        try:
+            future = self.session.save()
+        except KeyError:
+            self.save_message.value = "<b>Capture inputs before saving.</b>"
+            return
+        self.save_message.value = "<b>Saving inputs...</b>"
+        future.add_done_callback(self.show_saved)
+
+    def show_saved(self, future):
+        try:
+            file_path = future.result()
+        except OSError as error:
+            self.save_message.value = f"<b>Inputs not saved: {error}</b>"
+        else:
+            self.save_message.value = f"<b>Inputs saved to {file_path}</b>"
+
 
 class ProjectDetails:
     def __init__(self):
@@ -186,7 +173,11 @@ class ProjectDetails:
         def update_scheme(project):
             scheme_options = schemes[project]
             self.project_scheme.options = scheme_options
-        ipw.interactive(update_scheme, project=self.project_choice)
+        # Single dropdown, no need to wait for typing to pause
+        self.graph = ReactiveGraph(wait=0)
+        self.graph.bind(project=self.project_choice)
+        self.graph.node('scheme_options', ['project'], update_scheme)
+        self.graph.refresh()
 
     def proj_details(self):
         proj_details = ipw.VBox([
@@ -268,7 +259,10 @@ class PlateDetails:
             else:
                 self.predilution_display.children = []
 
-        ipw.interactive(get_predilution, pd_check=self.include_pd)
+        self.graph = ReactiveGraph(wait=0)
+        self.graph.bind(pd_check=self.include_pd)
+        self.graph.node('predilution_display', ['pd_check'], get_predilution)
+        self.graph.refresh()
 
     def plate_details(self):
         plate_details = ipw.VBox([
@@ -526,11 +520,11 @@ class StandardDetails:
 
 
 class Outputs:
-    def __init__(self):
+    def __init__(self, session=None):
         self.style = Headers().style
         self.out_display = ipw.Output()
         self.output_dict = {}
-        self.file = 'captured_data.json'
+        self.session = session if session is not None else SESSION
         self.inputs = None
         self.plate_display = None
         self.assay_display = None
@@ -547,52 +541,66 @@ class Outputs:
 
     def run_outputs(self, event):
         self.inputs = self.get_data_dict()
-        self.plate_display, plate_details = TotalPlates(self.inputs).calculate_plates()
+        if self.inputs is None:
+            with self.out_display:
+                self.out_display.clear_output()
+                display(ipw.HTML("<b>Capture inputs first.</b>"))
+            return
+        # Calculations come from the engine's result cache, the sections below only build the displays
+        with PROFILER.stage("Outputs.run_outputs", proj_id=self.inputs.get('proj_id')):
+            self.build_outputs()
+
+        self.output_section()
+
+    def build_outputs(self):
+        with PROFILER.stage("ProtocolEngine.run"):
+            result = ProtocolEngine().run(self.inputs)
+        results = result.output_dict
+        with PROFILER.stage("TotalPlates.setup_form"):
+            self.plate_display, plate_details = TotalPlates(self.inputs).calculate_plates(results)
         self.output_dict.update(plate_details)
 
         if self.inputs["standard_plates"] > 0:
-            self.standard_display, standard_data, standard_solution = StandardData(self.inputs).calculate_standards()
+            with PROFILER.stage("StandardData.setup_form"):
+                self.standard_display, standard_data, standard_solution = StandardData(
+                    self.inputs
+                ).calculate_standards(results['standard_data'], results['standard_solution'])
             self.output_dict['standard_solution'] = standard_solution
             self.output_dict['standard_data'] = standard_data
         else:
             self.standard_display = ipw.VBox([])
 
-        self.assay_display, assay_details = Assays().calculate_assay(self.output_dict)
+        with PROFILER.stage("Assays.setup_form"):
+            self.assay_display, assay_details = Assays().calculate_assay(self.output_dict, results)
         self.output_dict.update(assay_details)
 
-        self.db_display, db_details = DilutionBuffer().calculate_vols(self.inputs, self.output_dict)
+        with PROFILER.stage("DilutionBuffer.setup_form"):
+            self.db_display, db_details = DilutionBuffer().calculate_vols(self.inputs, self.output_dict, results)
         self.output_dict.update(db_details)
 
         # Temp comment
         # self.reagent_display, reagent_details = AssaySolutions(self.inputs, self.output_dict).get_reagent_details()
 
         # Temp use of excel data - no inventory
-        self.reagent_display, reagent_details = ExcelReagents(self.inputs, self.output_dict).calculate_data()
+        with PROFILER.stage("ExcelReagents.setup_form"):
+            self.reagent_display, reagent_details = ExcelReagents(self.inputs, self.output_dict).calculate_data(
+                result.reagent_records, results['reagent_details']
+            )
         self.output_dict['reagent_details'] = reagent_details
 
         self.output_dict['assays'] = reagent_details
         # self.output_dict['assay_db'] = assay_db
 
-        calced_vols, folds = VolumeCalculations(self.inputs).calculate_volumes()
-        self.output_dict['calced_vols'] = calced_vols
-        self.output_dict['folds'] = folds
+        self.output_dict['calced_vols'] = results['calced_vols']
+        self.output_dict['folds'] = results['folds']
 
         if self.inputs['proj_type'] == 'Fermentation':
-            pd_vols_data = VolumeCalculations(self.inputs).calculate_pd_volumes()
-            self.output_dict['pd_vols_data'] = pd_vols_data
+            self.output_dict['pd_vols_data'] = results['pd_vols_data']
 
         # display(self.output_dict)
 
-        self.output_section()
-
     def get_data_dict(self):
-        try:
-            with open(self.file) as captured_data:
-                input_data = json.load(captured_data)
-        except FileNotFoundError:
-            return None
-        else:
-            return input_data
+        return self.session.latest()
 
     def output_section(self):
         templatebuild_button = ipw.Button(description="Template", button_style='success')
@@ -608,11 +616,15 @@ class Outputs:
                 self.reagent_display,
                 templatebuild_button
             ])
+            if PROFILER.enabled:
+                output_form.children += (PROFILER.panel(),)
             display(output_form)
 
     def output_to_template(self, event):
         TemplateBuilder(self.inputs, self.output_dict)
         display(ipw.HTML("<b>Data output to template!</b>"))
+        if PROFILER.enabled:
+            display(PROFILER.panel())
 
 
 class TotalPlates:
@@ -636,33 +648,12 @@ class TotalPlates:
             disabled=True
         )
 
-    def calculate_plates(self):
-        source = self.inputs["source"]
-        replicates = self.inputs["replicates"]
-        proj_type = self.inputs["proj_type"]
-
-        self.total_pd.value = self.inputs["pd"]
-
-        if proj_type == 'Fermentation':
-            total_proxiplates = (source * 2) * (1 + self.total_pd.value)
-
-        else:
-            total_proxiplates = source * (1 + self.total_pd.value)
-
-        self.total_greiner.value = total_proxiplates
-        self.total_pd.value *= source
-
-        if replicates == 'n + 2':
-            if total_proxiplates == 1:
-                total_proxiplates += 1
-            else:
-                total_proxiplates += 2
-        elif replicates == 'n + 1':
-            total_proxiplates += 1
-        elif replicates == 'n * 2':
-            total_proxiplates *= 2
-
-        self.total_proxiplates.value = total_proxiplates
+    def calculate_plates(self, plate_details=None):
+        if plate_details is None:
+            plate_details = ProtocolEngine().calculate_plates(self.inputs)
+        self.total_pd.value = plate_details['total_pd']
+        self.total_greiner.value = plate_details['total_greiner']
+        self.total_proxiplates.value = plate_details['total_proxiplates']
         display_form = self.setup_form()
         plate_details = self.plate_details()
         return display_form, plate_details
@@ -690,26 +681,21 @@ class TotalPlates:
 class Assays:
     def __init__(self):
         self.style = Headers().style
-        self.proxi_wells = FixedHiPrBindCalcs().proxi_wells
-        self.proxi_vols = FixedHiPrBindCalcs().proxi_well_vol
-        self.ml_ul_conv = FixedHiPrBindCalcs().ml_ul_conv
-        self.tempest_1 = FixedHiPrBindCalcs().tempest_comp_one
-        self.tempest_2 = FixedHiPrBindCalcs().tempest_comp_two
-        self.tempest_3 = FixedHiPrBindCalcs().tempest_comp_three
         self.assay_rxn = ipw.FloatText(description='AS for rxn (mL): ', style=self.style, disabled=True)
         self.assay_dead = ipw.FloatText(description='AS dead vol (mL): ', style=self.style, disabled=True)
         self.assay_req = ipw.FloatText(description='AS needed (mL): ', style=self.style, disabled=True)
 
-    def calculate_assay(self, output_dict):
+    def calculate_assay(self, output_dict, assay_details=None):
         try:
             proxiplates = output_dict['total_proxiplates']
         except KeyError:
             pass
         else:
-            self.assay_rxn.value = (self.proxi_vols * self.proxi_wells * proxiplates) / self.ml_ul_conv
-            self.assay_dead.value = round((self.proxi_vols * proxiplates * self.tempest_1 * self.tempest_2) /\
-                                    self.ml_ul_conv + self.tempest_3, 3)
-            self.assay_req.value = int((self.assay_rxn.value + self.assay_dead.value)) + 1
+            if assay_details is None:
+                assay_details = ProtocolEngine().calculate_assay(proxiplates)
+            self.assay_rxn.value = assay_details['assay_rxn']
+            self.assay_dead.value = assay_details['assay_dead']
+            self.assay_req.value = assay_details['assay_req']
             display_form = self.setup_form()
             assay_details = self.capture_outputs()
             return display_form, assay_details
@@ -738,27 +724,14 @@ class Assays:
 class DilutionBuffer:
     def __init__(self):
         self.style = Headers().style
-        self.ml_ul_conv = FixedHiPrBindCalcs().ml_ul_conv
-        self.source_wells = FixedHiPrBindCalcs().source_wells
-        self.proxi_wells = FixedHiPrBindCalcs().proxi_wells
         self.dbi_vol_total = ipw.IntText(description="DBI (mL): ", style=self.style, disabled=True)
         self.dbii_vol_total = ipw.IntText(description="DBII (mL): ", style=self.style, disabled=True)
 
-    def calculate_vols(self, input_dict, output_dict):
-        source = input_dict['source']
-        pd_vols = input_dict['pd_vols']
-        dbi_vol = input_dict['dbi_vol']
-        dbii_vol = input_dict['dbii_vol']
-        greiner = output_dict['total_greiner']
-        total_pd_vol = sum([vol for vol in pd_vols.values()])
-        # temp
-        standard_scheme_total_dbi = 0
-
-        pd_total_vol = -(-((total_pd_vol * int(source) * self.source_wells) / self.ml_ul_conv) // 1)
-
-        self.dbi_vol_total.value = (int((int(source) * dbi_vol * self.source_wells) / self.ml_ul_conv) + 1)\
-                                + pd_total_vol + standard_scheme_total_dbi
-        self.dbii_vol_total.value = int((int(greiner) * dbii_vol * self.proxi_wells) / self.ml_ul_conv) + 1
+    def calculate_vols(self, input_dict, output_dict, db_details=None):
+        if db_details is None:
+            db_details = ProtocolEngine().calculate_dilution_buffers(input_dict, output_dict['total_greiner'])
+        self.dbi_vol_total.value = db_details['dbi_vol_total']
+        self.dbii_vol_total.value = db_details['dbii_vol_total']
         display_form = self.setup_form()
         db_details = self.capture_outputs()
         return display_form, db_details
@@ -786,49 +759,22 @@ class StandardData:
         self.style = Headers().style
         # self.params = config()
         # self.db = DbQuery(self.params)
-        self.standard_buffer_amount = FixedHiPrBindCalcs().standard_buffer_amount
-        self.ml_ul_conv = FixedHiPrBindCalcs().ml_ul_conv
         self.standard_total_vol = ipw.IntText(description="Total Standard Volume (uL):", style=self.style, disabled=True)
         self.standard_total_stock = ipw.FloatText(description="Total Stock Needed (uL): ", style=self.style, disabled=True)
         self.standard_total_dbi = ipw.FloatText(description="Total DBI needed (uL): ", style=self.style, disabled=True)
+        self.inputs = input_data
         self.proj_id = input_data["project_name_id"]
         self.project = input_data["project"]
         self.project_scheme = input_data["project_scheme"]
-        self.standard_plates = input_data["standard_plates"]
-        self.standard_wells = input_data["standard_wells"]
-        self.standard_vol = input_data["standard_vol"]
-        self.all_folds = input_data["standard_folds"]
-        self.fold_1 = input_data["standard_folds"]["standard_fold_1"]
-        self.conc_1 = input_data["standard_concs"]["standard_conc_1"]
-        self.standard_stock_conc = input_data["standard_stock"]["standard_stock_conc"]
-        self.standard_stock_mw = input_data["standard_stock"]["standard_stock_mw"]
-        self.standard_base_wvol = 0
-
-    def calculate_standards(self):
-        self.standard_base_wvol = self.standard_plates * self.standard_wells * self.standard_vol + self.standard_buffer_amount
-        self.standard_total_vol.value = self.standard_base_wvol * (1 / (self.fold_1 - 1) + 1)
-        # temp comment
-        # standard_id, standard_stock_conc = self.get_standard_details()
-        # excel standard
-        # standard_stock_nm = self.get_excel_standard()
-        standard_stock_nm = (self.standard_stock_conc / self.standard_stock_mw) * 1000000000
-        self.standard_total_stock.value = round((self.conc_1 * self.standard_total_vol.value) / standard_stock_nm, 2)
-        self.standard_total_dbi.value = round(self.standard_total_vol.value - self.standard_total_stock.value, 2)
-        standard_scheme_total_dbi = (self.standard_total_dbi.value + self.standard_base_wvol * 5) / self.ml_ul_conv
-
-        standard_details = dict(
-            standard_base_wvol=self.standard_base_wvol,
-            standard_total_vol=self.standard_total_vol,
-            standard_stock_conc=standard_stock_nm,
-            standard_total_stock=self.standard_total_stock.value,
-            standard_total_dbi=self.standard_total_dbi.value,
-            standard_scheme_total_dbi=standard_scheme_total_dbi,
-            # standard_transfer_vols=transfer_vols,
-            # standard_dbi_pre_vols=dbi_pre_vols,
-        )
 
-        display_form, standard_data = self.setup_form()
-        standard_solution = self.capture_outputs()
+    def calculate_standards(self, standard_data=None, standard_solution=None):
+        if standard_data is None or standard_solution is None:
+            standard_data, standard_solution = ProtocolEngine().calculate_standards(self.inputs)
+        self.standard_total_vol.value = standard_solution['standard_total_vol']
+        self.standard_total_stock.value = standard_solution['standard_total_stock']
+        self.standard_total_dbi.value = standard_solution['standard_total_dbi']
+
+        display_form = self.setup_form(standard_data)
         return display_form, standard_data, standard_solution
 
     # def get_excel_standard(self):
@@ -848,10 +794,8 @@ class StandardData:
     #
     #     return standard_id, standard_stock_conc
 
-    def setup_form(self):
-        well_labels = [f"Well {num}" for num in range(2, 7)]
-        transfer_vols = self.get_transfer_values()
-        dbi_pre_vols = self.get_dbi_pre_vols()
+    def setup_form(self, standard_data):
+        well_labels, dbi_pre_vols, transfer_vols = standard_data
         well_labels_display = self.create_display_box("", well_labels)
         dbi_vals_display = self.create_display_box("Add DBI (uL): ", dbi_pre_vols)
         transfer_vols_display = self.create_display_box("Transfer (uL): ", transfer_vols)
@@ -883,17 +827,7 @@ class StandardData:
                 ])
             ])
         ])
-        standard_data = [well_labels, dbi_pre_vols, transfer_vols]
-        return standard_scheme_display, standard_data
-
-    def get_transfer_values(self):
-        transfer_vols = [str(round(self.standard_base_wvol / (fold - 1), 0)) for fold in self.all_folds.values()]
-        return transfer_vols
-
-    def get_dbi_pre_vols(self):
-        # [self.standard_total_vol.value] +
-        dbi_pre_vols = [self.standard_base_wvol for repeat in range(0, 5)]
-        return dbi_pre_vols
+        return standard_scheme_display
 
     def create_display_box(self, label, value_list):
         standard_display_boxwidth = '12%'
@@ -910,14 +844,6 @@ class StandardData:
                                     for value in value_list])])
         return display_box
 
-    def capture_outputs(self):
-        standard_solution = dict(
-            standard_total_vol=self.standard_total_vol.value,
-            standard_total_stock=self.standard_total_stock.value,
-            standard_total_dbi=self.standard_total_dbi.value
-        )
-        return standard_solution
-
 
 class AssaySolutions:
     def __init__(self, input_dict, output_dict):
@@ -1015,6 +941,7 @@ class AssaySolutions:
 
 class VolumeCalculations:
     def __init__(self, input_dict):
+        self.inputs = input_dict
         self.dil_vols = input_dict['dil_vols']
         self.points = input_dict['points']
         self.cell_resus = input_dict['cell_resus']
@@ -1026,44 +953,11 @@ class VolumeCalculations:
         # self.proj_type = input_dict['proj_type']
 
     def calculate_volumes(self):
-        calced_vols = []
-        folds = []
-        pellet_conc = self.dbi_vol / self.cell_resus
-        if self.points == 4:
-            dil_vol_list = [dil_vol for dil_vol in self.dil_vols.values()]
-        elif self.points == 8:
-            dil_vol_list = [dil_vol for dil_vol in self.dil_vols.values()] * 2
-        for dil_vol in dil_vol_list:
-            dil_factor = 1 + self.dbii_vol / dil_vol
-            fold_factor = (pellet_conc * dil_factor)
-            folds.append(fold_factor)
-            calced_vol = 6 / fold_factor
-            calced_vols.append(calced_vol)
-            pellet_conc = fold_factor
-
+        calced_vols, folds = ProtocolEngine().calculate_volumes(self.inputs)
         return calced_vols, folds
 
     def calculate_pd_volumes(self):
-        pd_data = {}
-        initial_cell_conc = self.dbi_vol / self.cell_resus
-
-        for plate in range(1, self.total_pd + 1):
-            initial_pd_conc = self.pd_vols[f'pd_{plate}_vol'] / self.pd_spikes[f'pd_{plate}_spike'] + 1
-            initial_conc = initial_cell_conc * initial_pd_conc
-            calced_vols = []
-            folds = []
-            dil_vol_list = [dil_vol for dil_vol in self.dil_vols.values()] * 2
-            for dil_vol in dil_vol_list:
-                dil_factor = 1 + self.dbii_vol / dil_vol
-                fold_factor = (initial_conc * dil_factor)
-                folds.append(fold_factor)
-                calced_vol = 6 / fold_factor
-                calced_vols.append(calced_vol)
-                initial_conc = fold_factor
-            pd_data[f'pd_{plate}'] = dict(
-                pd_folds=folds,
-                pd_calced_vols=calced_vols
-            )
+        pd_data = ProtocolEngine().calculate_pd_volumes(self.inputs)
         return pd_data
 
 
@@ -1074,52 +968,18 @@ class ExcelReagents:
         self.project = input_dict['project']
         self.scheme = input_dict['project_scheme']
         self.style = Headers().style
-        self.reagents = FixedHiPrBindCalcs().excel_reagents
+        self.engine = ProtocolEngine()
         self.reagent_dict = self.get_reagents()
 
     def get_reagents(self):
-        reagent_data = ExcelData().get_reagent_data(self.project, self.scheme)
-        reagent_dict = reagent_data.to_dict(orient='records')
-
-        # self.calculate_data(reagent_dict)
+        reagent_dict = self.engine.get_reagents(self.project, self.scheme)
         return reagent_dict
 
-    def calculate_data(self):
-        assay_req = self.output_dict['assay_req']
-        reagent_records = [["Reagent", "Assay", "Cat_Num", "Conc. (ug/uL)", 'Desired conc. (nM)', 'Needed vol (uL)']]
-
-        for reagent in self.reagents:
-            conc_ug_ul = reagent[-1]
-            desired_conc = reagent[-2]
-            needed_vol = round(assay_req * desired_conc / conc_ug_ul * 1000, 2)
-            reagent.append(needed_vol)
-            reagent_records.append(reagent)
-
-        for reagent in self.reagent_dict:
-            try:
-                int(reagent["Conc. (ug/uL)"])
-            except ValueError:
-                pass
-            else:
-                reagent_name = reagent["Reagent"]
-                assay_num = int(reagent["Assay"])
-                desired_conc = reagent['Desired conc. (nM)']
-                cat_num = reagent["Cat. No./Code"]
-
-                if 'bead' in reagent["Reagent"]:
-                    conc_ug_ul = reagent["Conc. (ug/uL)"]
-                    needed_vol = round((desired_conc / conc_ug_ul) * 1000 * assay_req, 2)
-                    reagent_record = [reagent_name, assay_num, cat_num, conc_ug_ul, desired_conc, needed_vol]
-
-                else:
-                    conc_nm = reagent['Conc. (nM)']
-                    needed_vol = round(desired_conc * (assay_req * 1000 / conc_nm), 2)
-                    reagent_record = [reagent_name, assay_num, cat_num, conc_nm, desired_conc, needed_vol]
-
-                reagent_records.append(reagent_record)
-
+    def calculate_data(self, reagent_records=None, assay_details=None):
+        if reagent_records is None or assay_details is None:
+            assay_req = self.output_dict['assay_req']
+            reagent_records, assay_details = self.engine.calculate_reagents(self.reagent_dict, assay_req)
         reagent_display = self.setup_form(reagent_records)
-        assay_details = self.prepare_reagent_tables(reagent_records, assay_req)
         # return reagent_display, assay_details, assay_db
         return reagent_display, assay_details
 
@@ -1146,249 +1006,3 @@ class ExcelReagents:
             ])
 
         return display_form
-
-    def prepare_reagent_tables(self, reagent_records, assay_req):
-        assay_list = list(
-            set(
-                [int(reagent["Assay"]) for reagent in self.reagent_dict if not isinstance(reagent["Assay"], dict)]
-            )
-        )
-        assay_db = {}
-        assay_table_dict = {}
-        for assay in assay_list:
-            assay_table_dict[f"Assay {assay}"] = [row for row in reagent_records[1:] if row[1] == assay]
-            assay_table_dict[f"Assay {assay}"].insert(0, reagent_records[0])
-            assay_totals = ["", "", "", "", "Total Assay (mL):", assay_req * 1000]
-            dbii_totals = ["", "", "", "", f"DBII for assay {assay} (mL):", round(assay_req - (sum(
-                [float(row[-1]) for row in reagent_records[1:] if row[1] == assay]
-            ) / 1000), 3) * 1000]
-            assay_table_dict[f"Assay {assay}"].extend([dbii_totals])
-            assay_table_dict[f"Assay {assay}"].extend([assay_totals])
-            # assay_db[f"Assay {assay}"] = [[round(assay_req - (sum(
-            #     [float(row[-1]) for row in reagent_records[1:] if row[1] == assay]
-            # ) / 1000), 3)]]
-
-        # return assay_table_dict, assay_db
-        return assay_table_dict
-
-
-class TemplateBuilder:
-    def __init__(self, input_dict, output_dict):
-        self.input_dict = input_dict
-        self.output_dict = output_dict
-        self.project_name = input_dict["project"]
-        self.proj_id = input_dict["proj_id"]
-        self.proj_file_option = input_dict["proj_file_option"]
-        self.proj_type = input_dict["proj_type"]
-        self.project_scheme = input_dict["project_scheme"]
-        # self.output_folder = r"L:\High Throughput Screening\Personnel\Matthew Currie"
-        self.output_folder = r"outputs/"
-        # self.ssf_path = r"L:\High Throughput Screening\HiPrBind\SSF HPB runs"
-        self.ssf_path = r"outputs\SSF-HPB-runs"
-        self.ferm_path = r"outputs\Ferm-HPB-runs"
-        # self.ferm_path = r"L:\High Throughput Screening\HiPrBind\Ferm HPB runs"
-        self.parent_directory = f"{self.proj_id}_{self.project_name}_{self.proj_type}"
-        self.sub_directory = "Analysis"
-        # self.output_file = self.output_folder + r'\test_output.xlsx'
-        self.filename = self.make_outfile()
-        self.output_file = self.make_folders()
-        self.template = Templates(self.project_name, self.proj_type).fetch_template()
-
-        self.write_to_excel()
-
-    def make_outfile(self):
-        if self.proj_file_option:
-            filename = f"{self.proj_id}_protocol_{self.project_scheme}_{self.proj_file_option}.xlsx"
-        else:
-            filename = f"{self.proj_id}_protocol_{self.project_scheme}.xlsx"
-        return filename
-
-    def make_folders(self):
-        if self.proj_type == "Fermentation":
-            dir_path = os.path.join(self.ferm_path, self.parent_directory)
-        else:
-            dir_path = os.path.join(self.ssf_path, self.parent_directory)
-
-        output_file = os.path.join(dir_path, self.filename)
-        if not os.path.exists(dir_path):
-            os.mkdir(dir_path)
-            analysis_path = os.path.join(dir_path, self.sub_directory)
-            os.mkdir(analysis_path)
-
-        return output_file
-
-    def write_to_excel(self):
-        location_dict = self.template['location_dict']
-        wb = self.template['workbook']
-        ws = self.template['worksheet']
-        for in_key, in_value in self.input_dict.items():
-            if isinstance(in_value, dict):
-                for sub_key, sub_value in in_value.items():
-                    if sub_key in location_dict:
-                        ws[location_dict[sub_key]].value = sub_value
-            elif in_key in location_dict:
-                ws[location_dict[in_key]].value = in_value
-            else:
-                pass
-        for in_key, in_value in self.output_dict.items():
-            if in_key == "pd_vols_data":
-                start_row = location_dict[in_key][0]
-                data_start_row = start_row
-                for plate, plate_data in in_value.items():
-                    start_col = location_dict[in_key][1]
-                    for inner_data, inner_list in plate_data.items():
-                        data_start_row = start_row
-                        # ws.cell(row=start_row - 3, column=start_col).value = plate
-                        for value in inner_list:
-                            ws.cell(row=data_start_row, column=start_col).value = value
-                            data_start_row += 1
-                        start_col += 1
-                    start_row = data_start_row + 3
-
-            elif isinstance(in_value, list) and in_key in location_dict:
-                start_row = location_dict[in_key][0]
-                for row in in_value:
-                    start_col = location_dict[in_key][1]
-                    if isinstance(row, list) or isinstance(row, tuple):
-                        for value in row:
-                            ws.cell(row=start_row, column=start_col).value = value
-                            start_col += 1
-                    else:
-                        ws.cell(row=start_row, column=start_col).value = row
-                    start_row += 1
-            elif isinstance(in_value, dict) and in_key in location_dict:
-                start_row = location_dict[in_key][0]
-                start_col = location_dict[in_key][1]
-                for in_dict_key, in_dict_list in in_value.items():
-                    ws.cell(row=start_row, column=start_col).value = in_dict_key
-                    start_row += 1
-                    for row in in_dict_list:
-                        for value in row:
-                            ws.cell(row=start_row, column=start_col).value = value
-                            start_col += 1
-                        start_col = location_dict[in_key][1]
-                        start_row += 1
-                    start_row += 1
-
-            elif isinstance(in_value, dict):
-                for sub_key, sub_value in in_value.items():
-                    if sub_key in location_dict:
-                        ws[location_dict[sub_key]].value = sub_value
-            elif in_key in location_dict:
-                ws[location_dict[in_key]].value = in_value
-
-            else:
-                pass
-
-        wb.save(self.output_file)
-
-
-class Templates:
-    def __init__(self, project, proj_type):
-        self.project_name = project
-        self.proj_type = proj_type
-        self.template_dict = {}
-
-    def fetch_template(self):
-        if self.proj_type == "Fermentation":
-            location_dict = dict(
-                project="B1",
-                proj_id="B2",
-                proj_type="B3",
-                run_notes="A5",
-                source="A20",
-                total_greiner="A23",
-                total_proxiplates="A24",
-                pd="A21",
-                total_pd="A22",
-                cell_resus="C42",
-                dbi_vol="H42",
-                dbii_vol="E52",
-                dbi_vol_total="F20",
-                dbii_vol_total="F22",
-                dil_vol_1="D52",
-                dil_vol_2="D53",
-                dil_vol_3="D54",
-                dil_vol_4="D55",
-                pd_1_spike="C43",
-                pd_2_spike="C44",
-                pd_3_spike="C45",
-                pd_4_spike="C46",
-                pd_1_vol="H43",
-                pd_2_vol="H44",
-                pd_3_vol="H45",
-                pd_4_vol="H46",
-                standard_total_vol="F34",
-                standard_total_stock="F33",
-                standard_total_dbi="F32",
-                standard_stock_conc="C30",
-                standard_stock_mw="E30",
-                standard_conc_1="B32",
-                standard_conc_2="B33",
-                standard_conc_3="B34",
-                standard_conc_4="B35",
-                standard_conc_5="B36",
-                standard_conc_6="B37",
-                standard_data=(35, 9),
-                # reagent_details=(45, 2),
-                calced_vols=(52, 10),
-                folds=(52, 9),
-                assays=(62, 2),
-                pd_vols_data=(52, 13)
-            )
-            # wb = load_workbook(r"L:\High Throughput Screening\Personnel\Matthew Currie\Standard Protocol_FER_tabs.xlsx")
-            wb = load_workbook(r"templates/Standard Protocol_FER_tabs.xlsx")
-        else:
-            location_dict = dict(
-                project="B1",
-                proj_id="B2",
-                proj_type="B3",
-                run_notes="A5",
-                source="B19",
-                total_greiner="B20",
-                total_proxiplates="B21",
-                cell_resus="C36",
-                dbi_vol="G36",
-                dbii_vol="E39",
-                dbi_vol_total="J19",
-                dbii_vol_total="J21",
-                dil_vol_1="D39",
-                dil_vol_2="D40",
-                dil_vol_3="D41",
-                dil_vol_4="D42",
-                standard_total_vol="F28",
-                standard_total_stock="F27",
-                standard_total_dbi="F26",
-                standard_stock_conc="C24",
-                standard_stock_mw="E24",
-                standard_conc_1="B26",
-                standard_conc_2="B27",
-                standard_conc_3="B28",
-                standard_conc_4="B29",
-                standard_conc_5="B30",
-                standard_conc_6="B31",
-                standard_data=(29, 9),
-                # reagent_details=(45, 2),
-                calced_vols=(39, 11),
-                folds=(39, 10),
-                assays=(45, 2),
-                # assay_db=(22, 10)
-            )
-            self.template_dict['location_dict'] = location_dict
-
-            # wb = load_workbook(r"L:\High Throughput Screening\Personnel\Matthew Currie\Standard Protocol_SSF_tabs.xlsx")
-            wb = load_workbook(r"templates/Standard Protocol_SSF_tabs.xlsx")
-
-        self.template_dict['location_dict'] = location_dict
-        self.template_dict['workbook'] = wb
-        ws = wb['Run Info']
-        self.template_dict['worksheet'] = ws
-
-        return self.template_dict
-
-
-
-
-
-
-
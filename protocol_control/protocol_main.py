@@ -1,16 +1,87 @@
 import ipywidgets as ipw
 from IPython.display import display
 import pandas as pd
-import psycopg2 as pg2
+import numpy as np
+from psycopg2.extras import execute_values
 import datetime as dt
 from config import config
+from db_control.async_db import AsyncDb, QueryRunner
+from db_control.db_pool import get_pool
+from db_control.rollups import add_use_rollups
+from protocol_control.reactive import ReactiveGraph
 from protocol_control.template_output import TemplateOutput
 
 STYLE = {'description_width': 'initial'}
 PROJECT_LIST = ["...", "Akita", "Spaniel", "Dalmatian", "Xolo", "Xochaso"]
 
 PARAMS = config()
-CONN = pg2.connect(**PARAMS)
+# Shared connection pool, connects on the first query instead of at import
+DB_POOL = get_pool(PARAMS)
+
+
+def sql_value(value):
+    # numpy scalars from the DataFrames can't be adapted by psycopg2
+    return value.item() if isinstance(value, np.generic) else value
+
+
+def sql_rows(rows):
+    return [tuple(sql_value(value) for value in row) for row in rows]
+
+
+# Reagent and consumable stock after a run, for both assays and every consumable in one round trip.
+# Each half comes back as a json array of rows so the two tables keep their own column types.
+STOCK_PROJECTION_QUERY = """
+    WITH reagent_needs AS (
+        SELECT project_reagents.assay_id, reagents.reagent_id, reagent, concentration_ugul, on_hand,
+        project_reagents.desired_conc,
+        CASE
+            WHEN reagent ILIKE 'lysozyme%%' OR reagent ILIKE 'picogreen%%'
+                THEN %(assay_one_req)s::numeric * project_reagents.desired_conc / concentration_ugul * 1000
+            WHEN project_reagents.assay_id = 2
+                THEN (project_reagents.desired_conc / concentration_ugul) * 1000 * %(assay_two_req)s::numeric
+            WHEN project_reagents.assay_id = 1
+                THEN (project_reagents.desired_conc * %(assay_one_req)s::numeric * 1000) / concentration_nm
+        END AS needed
+        FROM project_reagents
+        INNER JOIN reagents
+        ON project_reagents.reagent_id = reagents.reagent_id
+        WHERE project_reagents.assay_id IN (1, 2) AND project_reagents.proj_id = %(proj_id)s
+    ),
+    consumable_needs AS (
+        -- Every requested item is kept, ones the project doesn't track have no id or stock
+        SELECT project_items.item_id, needs.item, project_items.on_hand,
+        project_items.on_hand - needs.needed AS remaining, needs.position
+        FROM unnest(%(items)s::text[], %(needed)s::int[]) WITH ORDINALITY AS needs (item, needed, position)
+        LEFT JOIN (
+            SELECT consumables.item_id, item, on_hand
+            FROM consumables
+            INNER JOIN project_consumables
+            ON consumables.item_id = project_consumables.item_id AND project_consumables.proj_id = %(proj_id)s
+        ) AS project_items
+        ON project_items.item = needs.item
+    )
+    SELECT
+    (
+        SELECT json_agg(json_build_array(
+            assay_id, reagent_id, reagent, concentration_ugul, on_hand, desired_conc,
+            ROUND(on_hand - needed, 2),
+            CASE WHEN ROUND(on_hand - needed, 2) < 0 THEN 'Not Enough Stock' ELSE 'In Stock' END,
+            ROUND(needed, 2)
+        ) ORDER BY assay_id, reagent_id)
+        FROM reagent_needs
+    ),
+    (
+        SELECT json_agg(json_build_array(
+            item_id, item, on_hand, remaining,
+            CASE
+                WHEN item_id IS NULL THEN 'Not in project'
+                WHEN remaining < 0 THEN 'Not Enough Stock'
+                ELSE 'In Stock'
+            END
+        ) ORDER BY position)
+        FROM consumable_needs
+    )
+"""
 
 
 class Protocol:
@@ -19,11 +90,15 @@ class Protocol:
     consumables) to inventory database.
     """
     def __init__(self):
-        # Postgres query
-        self.cur = CONN.cursor()
         # Run tracking info
         self.run_tracking_dict = {}
 
+        # Derived form values, only the parts downstream of a changed widget rerun once typing pauses
+        self.graph = ReactiveGraph()
+        # Stock lookups run on the kernel's event loop, the form stays usable while they are out
+        self.async_db = AsyncDb(PARAMS)
+        self.runner = QueryRunner()
+
         # Used for run logs and update queries
         self.all_reagents_df = pd.DataFrame()
         self.all_consumables_df = pd.DataFrame()
@@ -274,15 +349,20 @@ class Protocol:
         ])
 
     def show_form_display(self):
-        def proxi_display(source, replicates, predilution, pd1, pd2, pd3, pd4, dbi, standard_inc):
+        def show_predilution(predilution):
             # Show predilution options
             if predilution:
                 self.predilution_options_display.children = [self.pd_vol_display, self.pd_spike_display]
-            # Determine proxiplates and greiner plates
+
+        def count_predilution(pd1, pd2, pd3, pd4):
             self.pd_plates.value = 4 - [pd1, pd2, pd3, pd4].count(0)
-            total_num = source * (1 + self.pd_plates.value)
+            return self.pd_plates.value
+
+        def total_plates(source, replicates, pd_count):
+            # Determine proxiplates and greiner plates
+            total_num = source * (1 + pd_count)
             self.total_greiner.value = total_num
-            self.total_pd_plates.value = self.pd_plates.value * source
+            self.total_pd_plates.value = pd_count * source
 
             if replicates == 'n + 2':
                 if total_num == 1:
@@ -294,6 +374,7 @@ class Protocol:
 
             self.total_proxiplate.value = str(total_num)
 
+        def show_standard(standard_inc, source, dbi):
             # Show standard section
             if standard_inc:
                 self.standard_display.children = self.standard_info
@@ -301,22 +382,28 @@ class Protocol:
                 self.standard_vol.value = dbi
                 self.standard_output_display.children = self.standard_output_info
 
-        plate_num = ipw.interactive(proxi_display,
-                                    source=self.source_plates,
-                                    replicates=self.proxiplates,
-                                    predilution=self.predilution_plates,
-                                    pd1=self.pd_1_vol,
-                                    pd2=self.pd_2_vol,
-                                    pd3=self.pd_3_vol,
-                                    pd4=self.pd_4_vol,
-                                    dbi=self.dbi_vol,
-                                    standard_inc=self.standard_include)
+        self.graph.bind(
+            source=self.source_plates,
+            replicates=self.proxiplates,
+            predilution=self.predilution_plates,
+            pd1=self.pd_1_vol,
+            pd2=self.pd_2_vol,
+            pd3=self.pd_3_vol,
+            pd4=self.pd_4_vol,
+            dbi=self.dbi_vol,
+            standard_inc=self.standard_include
+        )
+        self.graph.node('predilution_display', ['predilution'], show_predilution)
+        self.graph.node('pd_count', ['pd1', 'pd2', 'pd3', 'pd4'], count_predilution)
+        self.graph.node('plate_totals', ['source', 'replicates', 'pd_count'], total_plates)
+        self.graph.node('standard_display', ['standard_inc', 'source', 'dbi'], show_standard)
+        self.graph.refresh()
         input_header = ipw.HTML("<h3>Create Protocol</h3>")
         display(input_header, self.form_display)
         # display(plate_num)
 
     def show_outputs(self):
-        def calcs(plates, greiner, source, pd1, pd2, pd3, pd4, dbi, dbii, pd_plates, proj_name, standard_inc, standard_plates, standard_wells, standard_vol, conc_1, conc_2, conc_3, conc_4, conc_5, conc_6):
+        def standard_scheme(proj_name, standard_inc, standard_plates, standard_wells, standard_vol, conc_1, conc_2, conc_3, conc_4, conc_5, conc_6):
             if standard_inc:
                 # # Standard output section
                 try:
@@ -338,13 +425,13 @@ class Protocol:
                         pass
                     else:
                         # proj_name = proj_name.lower()
-                        query = f"""
+                        query = """
                             SELECT standard_id, standard_name, stock_conc_nm, on_hand
                             FROM project_standards
-                            WHERE proj_id = {proj_name}
+                            WHERE proj_id = %s
                         """
-                        # Call query function to retrieve data from database
-                        query_data = self.query_call(query)
+                        # Call query function to retrieve data from database, each time so a new standard lot is used
+                        query_data = self.query_call(query, (proj_name,))
 
                         # Extract data from the query
                         standard_stock_conc = float(query_data[0][2])
@@ -417,9 +504,9 @@ class Protocol:
                                 standard_base_wvol_display
                             ])
                         ]
+            return self.standard_scheme_total_dbi
 
-            # Reset query dataframe
-            self.all_reagents_df = pd.DataFrame()
+        def assay_volumes(plates):
             # Assay solution calculations
             as_rxn_vol = (self.proxi_well_vol * self.proxi_wells * int(plates)) / self.ml_ul_conv
             self.assay_one_rxn.value = as_rxn_vol
@@ -435,139 +522,70 @@ class Protocol:
             self.assay_one_req.value = -(-((as_rxn_vol + as_dead_vol) // 1))
             self.assay_two_req.value = -(-((as_rxn_vol + as_dead_vol) // 1))
 
+        def dbi_total(source, pd1, pd2, pd3, pd4, dbi, standard_dbi):
             # Dilution Buffer calculations
             pd_total_vol = -(-((sum([pd1, pd2, pd3, pd4]) * int(source) * self.source_wells) / self.ml_ul_conv) // 1)
 
-            self.dbi_total.value = -(-((int(source) * dbi * self.source_wells) / self.ml_ul_conv) // 1) + pd_total_vol + self.standard_scheme_total_dbi
+            self.dbi_total.value = -(-((int(source) * dbi * self.source_wells) / self.ml_ul_conv) // 1) + pd_total_vol + standard_dbi
+
+        def dbii_total(greiner, dbii):
             self.dbii_total.value = -(-((int(greiner) * dbii * self.proxi_wells) / self.ml_ul_conv) // 1)
 
-            # Assay table calculations
+        def stock(proj_name, assay_one_req, assay_two_req, plates, greiner, pd_plates):
+            # Assay table calculations, the only node that queries the database
             if proj_name == "...":
                 pass
             else:
-                # proj_name = proj_name.lower()
-                # Used for visual display and manual updates
-                all_return_data = None
-
-                # Perhaps change range to include binding scheme?
-                for query in range(1, 3):
-                    as_query = f"""
-                    SELECT reagents.reagent_id, reagent, concentration_ugul, on_hand, project_reagents.desired_conc, 
-                    CASE 
-                        WHEN reagent ILIKE 'lysozyme%' THEN ROUND(on_hand - {self.assay_one_req.value} * project_reagents.desired_conc / concentration_ugul * 1000, 2)
-                        WHEN reagent ILIKE 'picogreen%' THEN ROUND(on_hand - {self.assay_one_req.value} * project_reagents.desired_conc / concentration_ugul * 1000, 2)
-                        WHEN project_reagents.assay_id = 2 THEN ROUND(on_hand - (project_reagents.desired_conc  / concentration_ugul) * 1000 * {self.assay_two_req.value}, 2) 
-                        WHEN project_reagents.assay_id = 1 THEN ROUND(on_hand - (project_reagents.desired_conc * {self.assay_one_req.value} * 1000) / concentration_nm, 2)
-                        END as ul_remaining,
-                    CASE 
-                        WHEN reagent ILIKE 'lysozyme%' AND ROUND(on_hand - {self.assay_one_req.value} * project_reagents.desired_conc / concentration_ugul * 1000, 2) < 0 THEN 'Not Enough Stock' 
-                        WHEN reagent ILIKE 'picogreen%' AND ROUND(on_hand - {self.assay_one_req.value} * project_reagents.desired_conc / concentration_ugul * 1000, 2) < 0 THEN 'Not Enough Stock' 
-                        WHEN project_reagents.assay_id = 2 AND ROUND(on_hand - (project_reagents.desired_conc  / concentration_ugul) * 1000 * {self.assay_two_req.value}, 2)  < 0 THEN 'Not Enough Stock' 
-                        WHEN project_reagents.assay_id = 1 AND ROUND(on_hand - (project_reagents.desired_conc * {self.assay_one_req.value} * 1000) / concentration_nm, 2) < 0 THEN 'Not Enough Stock' 
-                        ELSE 'In Stock'
-                        END as status,
-                    CASE 
-                        WHEN reagent ILIKE 'lysozyme%' THEN ROUND({self.assay_one_req.value} * project_reagents.desired_conc / concentration_ugul * 1000, 2)
-                        WHEN reagent ILIKE 'picogreen%' THEN ROUND({self.assay_one_req.value} * project_reagents.desired_conc / concentration_ugul * 1000, 2)
-                        WHEN project_reagents.assay_id = 2 THEN ROUND((project_reagents.desired_conc  / concentration_ugul) * 1000 * {self.assay_two_req.value}, 2) 
-                        WHEN project_reagents.assay_id = 1 THEN ROUND((project_reagents.desired_conc * {self.assay_one_req.value} * 1000) / concentration_nm, 2)
-                        END as ul_needed
-                    FROM project_reagents
-                    
-                    INNER JOIN reagents 
-                    ON project_reagents.reagent_id = reagents.reagent_id
-                    WHERE project_reagents.assay_id = {query} AND project_reagents.proj_id = {proj_name}
-                    """
-                    return_data = self.query_call(as_query)
-                    return_data.insert(0, ('ID', 'Reagent', 'Conc ug/ul', 'On Hand', 'Desired conc nM', 'Remaining uL', 'Status', 'Needed ul'))
-                    return_data_df = pd.DataFrame(return_data)
-                    return_data.insert(0, (f'Assay {query}',))
-                    if not all_return_data:
-                        all_return_data = return_data
-                        self.all_reagents_df = pd.concat([self.all_reagents_df, return_data_df])
-                    else:
-                        self.all_reagents_df = pd.concat([self.all_reagents_df, return_data_df.iloc[1:, :]])
-                        for item in return_data:
-                            all_return_data.append(item)
-
-                self.as_table_row.children = [
-                                 ipw.HBox([
-                                     ipw.HTML(value=f'<b>{str(row_item[i])}</b>',
-                                              layout=ipw.Layout(
-                                                  width='12%',
-                                                  border='solid'),
-                                              disabled=True) if row_item[i] == 'Assay 1' or row_item[i] == 'Assay 2'
-                                                                or row_item[0] == 'ID' else
-                                     ipw.Text(value=str(row_item[i]), layout=ipw.Layout(width='12%', border='0.5px solid'), disabled=True)
-                                     for i in range(0, len(row_item))
-                                 ]) for row_item in all_return_data]
-
-                # Update and show consumables
-                consumables_table = [['ID', 'Item', 'On hand', 'Remaining', 'Status']]
-                self.consumables_dict = {'384w proxiplates': plates,
-                                         '384w dilution plates clear': greiner,
-                                         '50mL dark conicals': 2,
-                                         '8w trough reservoir': 1,
-                                         '300mL reservoirs': 1,
-                                         '96w MT plates': pd_plates}
-                for key, value in self.consumables_dict.items():
-                    query = f"""
-                        SELECT consumables.item_id, item, on_hand,
-                        CASE
-                            WHEN item = '{key}' THEN on_hand - {int(value)}
-                        END AS remaining,       
-                        CASE
-                            WHEN item = '{key}' AND (on_hand - {int(value)}) < 0 THEN 'Not Enough Stock' ELSE 'In Stock'
-                        END AS status        
-                        FROM consumables
-                        INNER JOIN project_consumables
-                        ON consumables.item_id = project_consumables.item_id
-                        WHERE item = '{key}' AND project_consumables.proj_id = {proj_name}
-                        """
-                    data = self.query_call(query)
-                    consumables_table.append(data[0])
-                self.all_consumables_df = pd.DataFrame(consumables_table)
-                self.consumables_display.children = [
-                             ipw.HBox([
-                                 ipw.HTML(value=f'<b>{str(row_item[i])}</b>',
-                                          layout=ipw.Layout(
-                                              width='100%',
-                                              border='solid'),
-                                          disabled=True) if row_item[0] == 'ID' else
-                                 ipw.Text(value=str(row_item[i]), layout=ipw.Layout(width='100%', border='0.5px solid'), disabled=True)
-                                 for i in range(0, len(row_item))
-                             ]) for row_item in consumables_table]
-
-        calc_outputs = ipw.interactive(calcs,
-                                       plates=self.total_proxiplate,
-                                       greiner=self.total_greiner,
-                                       source=self.source_plates,
-                                       pd1=self.pd_1_vol,
-                                       pd2=self.pd_2_vol,
-                                       pd3=self.pd_3_vol,
-                                       pd4=self.pd_4_vol,
-                                       dbi=self.dbi_vol,
-                                       dbii=self.dbii_vol,
-                                       pd_plates=self.total_pd_plates,
-                                       proj_name=self.project_choice,
-                                       standard_inc=self.standard_include,
-                                       standard_plates=self.standard_plates,
-                                       standard_wells=self.standard_wells,
-                                       standard_vol=self.standard_vol,
-                                       conc_1=self.standard_conc_1,
-                                       conc_2=self.standard_conc_2,
-                                       conc_3=self.standard_conc_3,
-                                       conc_4=self.standard_conc_4,
-                                       conc_5=self.standard_conc_5,
-                                       conc_6=self.standard_conc_6
-                                       )
+                consumables_dict = {'384w proxiplates': plates,
+                                    '384w dilution plates clear': greiner,
+                                    '50mL dark conicals': 2,
+                                    '8w trough reservoir': 1,
+                                    '300mL reservoirs': 1,
+                                    '96w MT plates': pd_plates}
+                self.update_stock(proj_name, consumables_dict)
+
+        self.graph.bind(
+            plates=self.total_proxiplate,
+            greiner=self.total_greiner,
+            source=self.source_plates,
+            pd1=self.pd_1_vol,
+            pd2=self.pd_2_vol,
+            pd3=self.pd_3_vol,
+            pd4=self.pd_4_vol,
+            dbi=self.dbi_vol,
+            dbii=self.dbii_vol,
+            pd_plates=self.total_pd_plates,
+            proj_name=self.project_choice,
+            standard_inc=self.standard_include,
+            standard_plates=self.standard_plates,
+            standard_wells=self.standard_wells,
+            standard_vol=self.standard_vol,
+            conc_1=self.standard_conc_1,
+            conc_2=self.standard_conc_2,
+            conc_3=self.standard_conc_3,
+            conc_4=self.standard_conc_4,
+            conc_5=self.standard_conc_5,
+            conc_6=self.standard_conc_6,
+            assay_one_req=self.assay_one_req,
+            assay_two_req=self.assay_two_req
+        )
+        self.graph.node('standard_dbi', [
+            'proj_name', 'standard_inc', 'standard_plates', 'standard_wells', 'standard_vol',
+            'conc_1', 'conc_2', 'conc_3', 'conc_4', 'conc_5', 'conc_6'
+        ], standard_scheme)
+        self.graph.node('assay_volumes', ['plates'], assay_volumes)
+        self.graph.node('dbi_total', ['source', 'pd1', 'pd2', 'pd3', 'pd4', 'dbi', 'standard_dbi'], dbi_total)
+        self.graph.node('dbii_total', ['greiner', 'dbii'], dbii_total)
+        self.graph.node('stock', ['proj_name', 'assay_one_req', 'assay_two_req', 'plates', 'greiner', 'pd_plates'], stock)
+        self.graph.refresh()
 
         pxplate_header = ipw.HTML("<h3>Total Plates Needed</h3>")
         as_header = ipw.HTML("<h3>Assay Solution Needed</h3>")
         db_header = ipw.HTML("<h3>Dilution Buffer Needed</h3>")
         asii_table_header = ipw.HTML("<h3>Assay Solution</h3>")
         consumables_header = ipw.HTML("<h3>Consumables List</h3>")
-        display(pxplate_header,
+        display(self.runner.status,
+                pxplate_header,
                 self.total_plate_display,
                 as_header,
                 self.assay_display,
@@ -582,6 +600,61 @@ class Protocol:
                 self.capture_display,
                 )
 
+    def update_stock(self, proj_name, consumables_dict):
+        query_params = dict(
+            proj_id=proj_name,
+            assay_one_req=self.assay_one_req.value,
+            assay_two_req=self.assay_two_req.value,
+            items=list(consumables_dict),
+            needed=[int(value) for value in consumables_dict.values()]
+        )
+        # A newer change to the inputs cancels a projection that is still running
+        self.runner.schedule(
+            'stock', self.async_db.query, STOCK_PROJECTION_QUERY, query_params,
+            on_done=lambda query_data: self.show_stock(consumables_dict, *query_data[0])
+        )
+
+    def show_stock(self, consumables_dict, reagent_rows, consumable_rows):
+
+        # Used for visual display and manual updates
+        reagent_header = ('ID', 'Reagent', 'Conc ug/ul', 'On Hand', 'Desired conc nM', 'Remaining uL', 'Status', 'Needed ul')
+        all_return_data = []
+        reagent_table = [reagent_header]
+        for assay in range(1, 3):
+            assay_rows = [tuple(row[1:]) for row in reagent_rows or [] if row[0] == assay]
+            all_return_data += [(f'Assay {assay}',), reagent_header] + assay_rows
+            reagent_table += assay_rows
+        self.all_reagents_df = pd.DataFrame(reagent_table)
+
+        self.as_table_row.children = [
+                         ipw.HBox([
+                             ipw.HTML(value=f'<b>{str(row_item[i])}</b>',
+                                      layout=ipw.Layout(
+                                          width='12%',
+                                          border='solid'),
+                                      disabled=True) if row_item[i] == 'Assay 1' or row_item[i] == 'Assay 2'
+                                                        or row_item[0] == 'ID' else
+                             ipw.Text(value=str(row_item[i]), layout=ipw.Layout(width='12%', border='0.5px solid'), disabled=True)
+                             for i in range(0, len(row_item))
+                         ]) for row_item in all_return_data]
+
+        # Update and show consumables
+        self.consumables_dict = consumables_dict
+        consumables_table = [['ID', 'Item', 'On hand', 'Remaining', 'Status']] + [
+            list(row) for row in consumable_rows or []
+        ]
+        self.all_consumables_df = pd.DataFrame(consumables_table)
+        self.consumables_display.children = [
+                     ipw.HBox([
+                         ipw.HTML(value=f'<b>{str(row_item[i])}</b>',
+                                  layout=ipw.Layout(
+                                      width='100%',
+                                      border='solid'),
+                                  disabled=True) if row_item[0] == 'ID' else
+                         ipw.Text(value=str(row_item[i]), layout=ipw.Layout(width='100%', border='0.5px solid'), disabled=True)
+                         for i in range(0, len(row_item))
+                     ]) for row_item in consumables_table]
+
     def manual_edit(self, event):
         if self.disabled_buttons:
             self.total_proxiplate.disabled = False
@@ -642,68 +715,72 @@ class Protocol:
         this_date = dt.date.today()
         this_date = this_date.strftime("%Y-%m-%d")
 
-        # Stock Check
-        if 'Not Enough Stock' in self.all_reagents_df[[6]].squeeze().tolist() or 'Not Enough Stock' in self.all_consumables_df[[4]].squeeze().tolist():
+        # Stock Check, on the stock tables for the current inputs
+        self.graph.flush()
+        if self.runner.busy('stock'):
+            display(ipw.HTML('Stock levels are still loading, try again in a moment.'))
+        elif 'Not Enough Stock' in self.all_reagents_df[[6]].squeeze().tolist() or 'Not Enough Stock' in self.all_consumables_df[[4]].squeeze().tolist():
             display(ipw.HTML('Not Enough Stock'))
             pass
+        elif 'Not in project' in self.all_consumables_df[[4]].squeeze().tolist():
+            display(ipw.HTML('Some consumables are not in this project, add them to it before capturing the run.'))
         else:
-            with CONN:
+            # Every write below is one round trip per table with bound parameters, all in a single transaction
+            proj_id = sql_value(self.project_choice.value)
+            with DB_POOL.connection() as conn:
+                cur = conn.cursor()
                 # Update inventory tables
-                # Create list of reagents to update
-                update_reagents_tuple = self.all_reagents_df[[1, 5]].apply(tuple, axis=1).squeeze().tolist()
-                for item in update_reagents_tuple[1:]:
-                    update_item = item[0]
-                    update_val = item[1]
-                    update_query = f"""
-                        UPDATE reagents
-                        SET on_hand = {update_val}
-                        WHERE reagent = '{update_item}'
-                    """
-                    self.query_call(update_query)
+                # Create list of reagents to update (row 0 of the tables is the header)
+                update_reagents_tuple = sql_rows(self.all_reagents_df[[1, 5]].values[1:])
+                execute_values(cur, """
+                    UPDATE reagents
+                    SET on_hand = update_data.on_hand
+                    FROM (VALUES %s) AS update_data (reagent, on_hand)
+                    WHERE reagents.reagent = update_data.reagent
+                """, update_reagents_tuple)
 
                 # Update project_use_reagents table in inventory tracker
-                update_reagent_use_tuple = self.all_reagents_df[[0, 7]].apply(tuple, axis=1).squeeze().tolist()
-                for item in update_reagent_use_tuple[1:]:
-                    insert_reagent = item[0]
-                    insert_val = item[1]
-                    insert_query = f"""
-                        INSERT INTO project_use_reagents (reagent_id, proj_id, amt_used, date_used)
-                        VALUES ({insert_reagent}, {self.project_choice.value}, {insert_val}, '{this_date}')
-                    """
-                    self.query_call(insert_query)
+                update_reagent_use_tuple = sql_rows(self.all_reagents_df[[0, 7]].values[1:])
+                reagent_use_rows = [
+                    (reagent_id, proj_id, amt_used, this_date) for reagent_id, amt_used in update_reagent_use_tuple
+                ]
+                execute_values(cur, """
+                    INSERT INTO project_use_reagents (reagent_id, proj_id, amt_used, date_used)
+                    VALUES %s
+                """, reagent_use_rows)
+                # Daily and monthly usage rollups move with the usage rows, in the same transaction
+                add_use_rollups(cur, 'reagent', reagent_use_rows)
 
                 # Create list of consumables to update
-                update_consumables_table = self.all_consumables_df[[1, 3]].apply(tuple, axis=1).squeeze().tolist()
-                for item in update_consumables_table[1:]:
-                    update_item = item[0]
-                    update_val = item[1]
-                    update_query = f"""
-                        UPDATE consumables
-                        SET on_hand = {update_val}
-                        WHERE item = '{update_item}'
-                    """
-                    self.query_call(update_query)
+                update_consumables_table = sql_rows(self.all_consumables_df[[1, 3]].values[1:])
+                execute_values(cur, """
+                    UPDATE consumables
+                    SET on_hand = update_data.on_hand
+                    FROM (VALUES %s) AS update_data (item, on_hand)
+                    WHERE consumables.item = update_data.item
+                """, update_consumables_table)
 
                 # Update project_use_consumables table in inventory tracker
                 self.all_consumables_df[5] = self.all_consumables_df[2].apply(lambda x: x if isinstance(x, int) else 0) - \
                                                  self.all_consumables_df[3].apply(lambda x: x if isinstance(x, int) else 0)
-                update_consumables_use_tuple = self.all_consumables_df[[0, 5]].apply(tuple, axis=1).squeeze().tolist()
-                for item in update_consumables_use_tuple[1:]:
-                    insert_item = item[0]
-                    insert_val = item[1]
-                    insert_query = f"""
-                        INSERT INTO project_use_consumables (item_id, proj_id, amt_used, date_used)
-                        VALUES ({insert_item}, {self.project_choice.value}, {insert_val}, '{this_date}')
-                    """
-                    self.query_call(insert_query)
+                update_consumables_use_tuple = sql_rows(self.all_consumables_df[[0, 5]].values[1:])
+                consumable_use_rows = [
+                    (item_id, proj_id, amt_used, this_date) for item_id, amt_used in update_consumables_use_tuple
+                ]
+                execute_values(cur, """
+                    INSERT INTO project_use_consumables (item_id, proj_id, amt_used, date_used)
+                    VALUES %s
+                """, consumable_use_rows)
+                add_use_rollups(cur, 'consumable', consumable_use_rows)
 
                 # Update project_use_standards table in inventory tracking db
                 if self.standard_include.value:
-                    insert_query = f"""
+                    standard_use_rows = sql_rows([(self.standard_id, proj_id, self.standard_total_stock.value, this_date)])
+                    cur.execute("""
                         INSERT INTO project_use_standards (standard_id, proj_id, amt_used, date_used)
-                        VALUES ({self.standard_id}, {self.project_choice.value}, {self.standard_total_stock.value}, '{this_date}')
-                    """
-                    self.query_call(insert_query)
+                        VALUES (%s, %s, %s, %s)
+                    """, standard_use_rows[0])
+                    add_use_rollups(cur, 'standard', standard_use_rows)
 
                 # Update to project_runs table in inventory tracking db
                 self.run_tracking_dict = dict(
@@ -777,13 +854,13 @@ class Protocol:
                             query_cols.append(inner_key)
                             query_data.append(inner_value)
                 query_cols = tuple(query_cols)
-                query_data = tuple(query_data)
-                # Query to log run information for future reference
+                query_data = sql_rows([query_data])[0]
+                # Query to log run information for future reference, column names come from run_tracking_dict
                 query = f"""
                     INSERT INTO project_runs ({', '.join(query_cols)})
-                    VALUES {query_data}
+                    VALUES ({', '.join(['%s'] * len(query_cols))})
                 """
-                self.query_call(query)
+                cur.execute(query, query_data)
                 # display(query_cols, query_data, this_date)
 
     def protocol_template(self, event):
@@ -817,13 +894,16 @@ class Protocol:
         )
         TemplateOutput(parser_dict)
 
-    def query_call(self, query):
-        self.cur.execute(query)
+    def query_call(self, query, params=None, conn=None):
+        # Runs on the caller's connection as part of its transaction, or on a pooled one committed right away
+        if conn is None:
+            with DB_POOL.connection() as conn:
+                return self.query_call(query, params, conn)
+        cur = conn.cursor()
+        cur.execute(query, params)
         if "SELECT" in query:
-            data = self.cur.fetchall()
+            data = cur.fetchall()
             return data
-        elif "INSERT" in query or "UPDATE" in query:
-            CONN.commit()
 
     def show_df(self):
         if not self.all_reagents_df.empty:
@@ -0,0 +1,198 @@
+import threading
+
+# Seconds a form waits after the last change before running a debounced update
+DEBOUNCE_WAIT = 0.3
+
+
+class Debouncer:
+    """
+    Runs only the last scheduled call once no new call came in for `wait` seconds. flush() runs a pending call
+    right away, or waits for the timer thread to finish one it already started, for buttons that need the result
+    to be current.
+    """
+    def __init__(self, wait=DEBOUNCE_WAIT):
+        self.wait = wait
+        self.timer = None
+        self.pending = None
+        # Threads running a taken call, flush() waits for them
+        self.active = set()
+        self.lock = threading.Condition()
+
+    def __call__(self, func, *args, **kwargs):
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+            self.pending = (func, args, kwargs)
+            self.timer = threading.Timer(self.wait, self.run_pending)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def run_pending(self):
+        with self.lock:
+            pending = self.pending
+            self.pending = None
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            if pending is None:
+                return
+            self.active.add(threading.get_ident())
+        try:
+            func, args, kwargs = pending
+            func(*args, **kwargs)
+        finally:
+            with self.lock:
+                self.active.discard(threading.get_ident())
+                self.lock.notify_all()
+
+    def flush(self):
+        self.run_pending()
+        with self.lock:
+            # A call made from inside the running one can't wait for itself
+            self.lock.wait_for(lambda: not self.active - {threading.get_ident()})
+
+    def cancel(self):
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+            self.timer = None
+            self.pending = None
+
+
+class ReactiveGraph:
+    """
+    Small dataflow layer for the interactive forms. Widgets are registered as sources and every derived value
+    is a node that declares the names it reads. A change only reruns the nodes downstream of it, and a node that
+    comes out the same as before stops the propagation. Widget changes inside the debounce window are applied
+    together in one update; wait=0 updates right away.
+    """
+    def __init__(self, wait=DEBOUNCE_WAIT):
+        self.sources = {}
+        self.nodes = {}
+        # Nodes in the order they were declared, a node can only read names declared before it
+        self.order = []
+        self.values = {}
+        self.changed = set()
+        self.running = False
+        # Thread running update(), flush() from another thread waits for it
+        self.update_thread = None
+        self.lock = threading.Condition()
+        self.debounce = Debouncer(wait) if wait else None
+
+    def source(self, name, widget):
+        if name in self.sources:
+            if self.sources[name] is not widget:
+                raise KeyError(f"Source {name} is already bound to another widget")
+            return
+        self.sources[name] = widget
+        self.values[name] = widget.value
+        widget.observe(lambda change: self.invalidate(name), names='value')
+
+    def bind(self, **widgets):
+        for name, widget in widgets.items():
+            self.source(name, widget)
+
+    def node(self, name, inputs, func):
+        missing = [input_name for input_name in inputs if input_name not in self.sources and input_name not in self.nodes]
+        if missing:
+            raise KeyError(f"Node {name} reads undeclared inputs: {', '.join(missing)}")
+        if name not in self.nodes:
+            self.order.append(name)
+        self.nodes[name] = (func, list(inputs))
+        with self.lock:
+            self.changed.add(name)
+
+    def get(self, name):
+        return self.values[name]
+
+    def invalidate(self, name):
+        with self.lock:
+            self.changed.add(name)
+            if self.running:
+                # Picked up by the update that is already running, e.g. a node writing to a source widget
+                return
+        if self.debounce is None:
+            self.update()
+        else:
+            self.debounce(self.update)
+
+    def refresh(self):
+        # Computes newly declared nodes (and anything pending) right away
+        if self.debounce is not None:
+            self.debounce.cancel()
+        self.update()
+
+    def flush(self):
+        # On return every change made so far is applied, including one an update on another thread is applying
+        if self.debounce is not None:
+            self.debounce.flush()
+        with self.lock:
+            self.lock.wait_for(lambda: not self.running or self.update_thread == threading.get_ident())
+            pending = bool(self.changed) and not self.running
+        if pending:
+            self.update()
+
+    def update(self):
+        with self.lock:
+            if self.running:
+                return
+            self.running = True
+            self.update_thread = threading.get_ident()
+        try:
+            while True:
+                with self.lock:
+                    changed = self.changed
+                    self.changed = set()
+                    if not changed:
+                        self.stop_running()
+                        return
+                for name in changed & set(self.sources):
+                    value = self.sources[name].value
+                    if same_value(self.values[name], value):
+                        changed.discard(name)
+                    self.values[name] = value
+                self.propagate(changed)
+        except Exception:
+            with self.lock:
+                self.stop_running()
+            raise
+
+    def stop_running(self):
+        # Called with the lock held
+        self.running = False
+        self.update_thread = None
+        self.lock.notify_all()
+
+    def propagate(self, changed):
+        stale = set(changed)
+        for index, name in enumerate(self.order):
+            func, inputs = self.nodes[name]
+            if name not in stale and stale.isdisjoint(inputs):
+                continue
+            value = func(*[self.values[input_name] for input_name in inputs])
+            if name not in self.values or not same_value(self.values[name], value):
+                self.values[name] = value
+                stale.add(name)
+            self.absorb_writes(index, stale)
+
+    def absorb_writes(self, index, stale):
+        # Source widgets a node just wrote to are picked up in this pass when only later nodes read them,
+        # otherwise they wait for the next pass so the earlier readers rerun too
+        visited = self.order[:index + 1]
+        with self.lock:
+            written = [name for name in self.changed if name in self.sources]
+            for name in written:
+                if any(name in self.nodes[node_name][1] for node_name in visited):
+                    continue
+                self.changed.discard(name)
+                value = self.sources[name].value
+                if not same_value(self.values[name], value):
+                    self.values[name] = value
+                    stale.add(name)
+
+
+def same_value(old, new):
+    try:
+        return bool(old is new or old == new)
+    except (TypeError, ValueError):
+        return False
@@ -0,0 +1,114 @@
+import copy
+import hashlib
+import json
+import os
+import pickle
+import threading
+from collections import OrderedDict
+
+# Input fields that only label a run and never change the calculated protocol
+IGNORED_FIELDS = ('proj_id', 'run_notes', 'proj_file_option')
+# Bump when a calculation changes, so entries already on disk stop matching
+RESULT_CACHE_VERSION = 1
+MAX_ENTRIES = 256
+
+
+def result_key(input_dict, inventory_version):
+    """
+    Content hash of a run: every calculation-relevant input field plus the inventory snapshot the reagents were
+    read from. Keys are sorted so the same inputs hash the same no matter how the dict was built.
+    """
+    key_data = dict(
+        inputs={field: value for field, value in input_dict.items() if field not in IGNORED_FIELDS},
+        inventory=inventory_version,
+        version=RESULT_CACHE_VERSION
+    )
+    key_json = json.dumps(key_data, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha256(key_json.encode()).hexdigest()
+
+
+class ResultCache:
+    """
+    LRU cache of computed protocols, (output_dict, reagent_records) by result_key. With a disk_dir, entries are
+    also pickled to <disk_dir>/<key>.pkl so worker processes and later sessions share them; a disk hit is moved
+    back into memory. Callers get copies, so editing a returned output_dict never changes the cached one.
+    """
+    def __init__(self, max_entries=MAX_ENTRIES, disk_dir=None):
+        self.max_entries = max_entries
+        self.disk_dir = disk_dir
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+        if entry is None:
+            entry = self.read_disk(key)
+            if entry is not None:
+                self.put_memory(key, entry)
+        with self.lock:
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return copy.deepcopy(entry)
+
+    def put(self, key, output_dict, reagent_records):
+        entry = copy.deepcopy((output_dict, reagent_records))
+        self.put_memory(key, entry)
+        self.write_disk(key, entry)
+
+    def put_memory(self, key, entry):
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def disk_path(self, key):
+        return os.path.join(self.disk_dir, f"{key}.pkl")
+
+    def read_disk(self, key):
+        if self.disk_dir is None:
+            return None
+        try:
+            with open(self.disk_path(key), 'rb') as cache_file:
+                return pickle.load(cache_file)
+        except FileNotFoundError:
+            return None
+        except (OSError, pickle.UnpicklingError, EOFError):
+            # Unreadable entry, e.g. cut short by a crash; it is computed and written again
+            return None
+
+    def write_disk(self, key, entry):
+        if self.disk_dir is None:
+            return
+        # Written under a temp name first so a reader never sees half an entry
+        temp_path = f"{self.disk_path(key)}.{os.getpid()}.tmp"
+        try:
+            os.makedirs(self.disk_dir, exist_ok=True)
+            with open(temp_path, 'wb') as cache_file:
+                pickle.dump(entry, cache_file, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temp_path, self.disk_path(key))
+        except OSError:
+            # Read-only share; the memory tier still works
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    def clear(self, disk=False):
+        with self.lock:
+            self.entries.clear()
+            self.hits = 0
+            self.misses = 0
+        if disk and self.disk_dir is not None and os.path.isdir(self.disk_dir):
+            for file_name in os.listdir(self.disk_dir):
+                if file_name.endswith('.pkl'):
+                    os.remove(os.path.join(self.disk_dir, file_name))
+
+
+# Shared by every ProtocolEngine in the process
+RESULT_CACHE = ResultCache()
@@ -0,0 +1,96 @@
+import copy
+import datetime as dt
+import getpass
+import json
+import os
+import re
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+# Captured versions kept in memory per session, older ones are only on disk if they were saved
+SESSION_HISTORY = 20
+SESSION_STORE = Path.home().joinpath("Protocol-Builder", "sessions")
+
+# One background writer for every session in the process, saves never hold up the form
+SAVE_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix="session-save")
+
+
+class ProtocolSession:
+    """
+    Hands captured inputs from ProtocolForm to Outputs inside the kernel, in place of captured_data.json.
+    Every capture is a new numbered version. save() writes a version to the user's store in the background
+    (<store>/<user>/<timestamp>-v<version>.json, the same input dict layout protocol_cli reads).
+    """
+    def __init__(self, store_dir=SESSION_STORE, user=None):
+        self.user = user or getpass.getuser()
+        self.store_dir = os.path.join(store_dir, safe_name(self.user))
+        self.history = deque(maxlen=SESSION_HISTORY)
+        self.version = 0
+        self.lock = threading.Lock()
+
+    def capture(self, input_dict):
+        with self.lock:
+            self.version += 1
+            self.history.append((self.version, copy.deepcopy(input_dict)))
+            return self.version
+
+    def latest(self):
+        # A copy, so the caller can't change what was captured
+        with self.lock:
+            if not self.history:
+                return None
+            return copy.deepcopy(self.history[-1][1])
+
+    def get(self, version):
+        with self.lock:
+            for captured_version, input_dict in self.history:
+                if captured_version == version:
+                    return copy.deepcopy(input_dict)
+        raise KeyError(f"Version {version} is not in this session")
+
+    def save(self, version=None):
+        """
+        Writes a captured version (the latest by default) to the store without blocking.
+        Returns a Future with the saved file path.
+        """
+        with self.lock:
+            if not self.history:
+                raise KeyError("Nothing captured to save")
+            if version is None:
+                version = self.history[-1][0]
+        input_dict = self.get(version)
+        saved_at = dt.datetime.now()
+        return SAVE_EXECUTOR.submit(self.write_snapshot, version, input_dict, saved_at)
+
+    def write_snapshot(self, version, input_dict, saved_at):
+        os.makedirs(self.store_dir, exist_ok=True)
+        file_path = os.path.join(self.store_dir, f"{saved_at:%Y%m%d-%H%M%S}-v{version}.json")
+        # Renamed into place so a crash never leaves half a snapshot in the store
+        temp_path = f"{file_path}.tmp"
+        with open(temp_path, 'w') as snapshot_file:
+            json.dump(input_dict, snapshot_file, indent=4)
+        os.replace(temp_path, file_path)
+        return file_path
+
+    def load(self, file_path):
+        # Captures a saved snapshot again, e.g. to rerun the outputs of an earlier session
+        with open(file_path) as snapshot_file:
+            return self.capture(json.load(snapshot_file))
+
+    def snapshots(self):
+        if not os.path.isdir(self.store_dir):
+            return []
+        return sorted(
+            os.path.join(self.store_dir, file_name) for file_name in os.listdir(self.store_dir)
+            if file_name.endswith('.json')
+        )
+
+
+def safe_name(name):
+    return re.sub(r'[^\w.-]', '_', name)
+
+
+# Default session shared by the forms of one kernel, so ProtocolForm() and Outputs() still pair up on their own
+SESSION = ProtocolSession()
@@ -0,0 +1,312 @@
+import os
+import threading
+from contextlib import contextmanager
+from openpyxl import load_workbook
+from openpyxl.utils.cell import coordinate_to_tuple
+from protocol_control.profiling import PROFILER
+from protocol_control.xlsx_patcher import PATCHER_CACHE
+
+LOCATION_CELLS = {}
+
+
+class TemplateBuilder:
+    def __init__(self, input_dict, output_dict, writer='openpyxl', output_dir=None):
+        self.input_dict = input_dict
+        self.output_dict = output_dict
+        self.project_name = input_dict["project"]
+        self.proj_id = input_dict["proj_id"]
+        self.proj_file_option = input_dict["proj_file_option"]
+        self.proj_type = input_dict["proj_type"]
+        self.project_scheme = input_dict["project_scheme"]
+        self.sub_directory = "Analysis"
+        self.output_file = self.output_path(input_dict, output_dir)
+        self.filename = os.path.basename(self.output_file)
+        self.make_folders()
+
+        with PROFILER.stage("TemplateBuilder", proj_id=self.proj_id, writer=writer):
+            if writer == 'xml':
+                # Patches the template's archive directly, no openpyxl load or save
+                self.patch_excel()
+            else:
+                with Templates(self.project_name, self.proj_type).checkout_template() as template:
+                    self.template = template
+                    with PROFILER.stage("TemplateBuilder.write_to_excel"):
+                        self.write_to_excel()
+
+    @staticmethod
+    def output_path(input_dict, output_dir=None):
+        # Where the protocol of input_dict is written, callers can check a batch for clashes before building
+        # output_folder = r"L:\High Throughput Screening\Personnel\Matthew Currie"
+        # ssf_path = r"L:\High Throughput Screening\HiPrBind\SSF HPB runs"
+        # ferm_path = r"L:\High Throughput Screening\HiPrBind\Ferm HPB runs"
+        ssf_path = r"outputs\SSF-HPB-runs"
+        ferm_path = r"outputs\Ferm-HPB-runs"
+        if output_dir is not None:
+            ssf_path = os.path.join(output_dir, "SSF-HPB-runs")
+            ferm_path = os.path.join(output_dir, "Ferm-HPB-runs")
+        proj_id = input_dict["proj_id"]
+        proj_type = input_dict["proj_type"]
+        parent_directory = f"{proj_id}_{input_dict['project']}_{proj_type}"
+        if input_dict["proj_file_option"]:
+            filename = f"{proj_id}_protocol_{input_dict['project_scheme']}_{input_dict['proj_file_option']}.xlsx"
+        else:
+            filename = f"{proj_id}_protocol_{input_dict['project_scheme']}.xlsx"
+        dir_path = os.path.join(ferm_path if proj_type == "Fermentation" else ssf_path, parent_directory)
+        return os.path.join(dir_path, filename)
+
+    def make_folders(self):
+        dir_path = os.path.dirname(self.output_file)
+        if not os.path.exists(dir_path):
+            # Runs of one project can be written by several processes at once
+            analysis_path = os.path.join(dir_path, self.sub_directory)
+            os.makedirs(analysis_path, exist_ok=True)
+
+    def collect_cells(self, location_dict):
+        # Ordered ((row, column), value) writes for the Run Info sheet, shared by both writers
+        location_cells = get_location_cells(location_dict)
+        cell_writes = []
+        for in_key, in_value in self.input_dict.items():
+            if isinstance(in_value, dict):
+                for sub_key, sub_value in in_value.items():
+                    if sub_key in location_dict:
+                        cell_writes.append((location_cells[sub_key], sub_value))
+            elif in_key in location_dict:
+                cell_writes.append((location_cells[in_key], in_value))
+            else:
+                pass
+        for in_key, in_value in self.output_dict.items():
+            if in_key == "pd_vols_data":
+                start_row = location_dict[in_key][0]
+                data_start_row = start_row
+                for plate, plate_data in in_value.items():
+                    start_col = location_dict[in_key][1]
+                    for inner_data, inner_list in plate_data.items():
+                        data_start_row = start_row
+                        # ws.cell(row=start_row - 3, column=start_col).value = plate
+                        for value in inner_list:
+                            cell_writes.append(((data_start_row, start_col), value))
+                            data_start_row += 1
+                        start_col += 1
+                    start_row = data_start_row + 3
+
+            elif isinstance(in_value, list) and in_key in location_dict:
+                start_row = location_dict[in_key][0]
+                for row in in_value:
+                    start_col = location_dict[in_key][1]
+                    if isinstance(row, list) or isinstance(row, tuple):
+                        for value in row:
+                            cell_writes.append(((start_row, start_col), value))
+                            start_col += 1
+                    else:
+                        cell_writes.append(((start_row, start_col), row))
+                    start_row += 1
+            elif isinstance(in_value, dict) and in_key in location_dict:
+                start_row = location_dict[in_key][0]
+                start_col = location_dict[in_key][1]
+                for in_dict_key, in_dict_list in in_value.items():
+                    cell_writes.append(((start_row, start_col), in_dict_key))
+                    start_row += 1
+                    for row in in_dict_list:
+                        for value in row:
+                            cell_writes.append(((start_row, start_col), value))
+                            start_col += 1
+                        start_col = location_dict[in_key][1]
+                        start_row += 1
+                    start_row += 1
+
+            elif isinstance(in_value, dict):
+                for sub_key, sub_value in in_value.items():
+                    if sub_key in location_dict:
+                        cell_writes.append((location_cells[sub_key], sub_value))
+            elif in_key in location_dict:
+                cell_writes.append((location_cells[in_key], in_value))
+
+            else:
+                pass
+
+        return cell_writes
+
+    def write_to_excel(self):
+        ws = self.template['worksheet']
+        for (row, column), value in self.collect_cells(self.template['location_dict']):
+            ws.cell(row=row, column=column).value = value
+        self.template['workbook'].save(self.output_file)
+
+    def patch_excel(self):
+        location_dict, template_file = Templates(self.project_name, self.proj_type).get_template_details()
+        cell_writes = self.collect_cells(location_dict)
+        PATCHER_CACHE.get(template_file, 'Run Info').write(cell_writes, self.output_file)
+
+
+def get_location_cells(location_dict):
+    # (row, column) of every location, string coordinates are only converted once per template layout
+    cache_key = tuple(location_dict.items())
+    location_cells = LOCATION_CELLS.get(cache_key)
+    if location_cells is None:
+        location_cells = {
+            key: coordinate_to_tuple(location) if isinstance(location, str) else location
+            for key, location in location_dict.items()
+        }
+        LOCATION_CELLS[cache_key] = location_cells
+    return location_cells
+
+
+class Templates:
+    def __init__(self, project, proj_type):
+        self.project_name = project
+        self.proj_type = proj_type
+        self.template_dict = {}
+
+    def fetch_template(self):
+        location_dict, template_file = self.get_template_details()
+        wb = load_workbook(template_file)
+        self.template_dict['location_dict'] = location_dict
+        self.template_dict['workbook'] = wb
+        ws = wb['Run Info']
+        self.template_dict['worksheet'] = ws
+
+        return self.template_dict
+
+    def checkout_template(self):
+        # Shared parsed template from the pool, restored when the with block exits
+        location_dict, template_file = self.get_template_details()
+        return TEMPLATE_POOL.checkout(template_file, location_dict)
+
+    def get_template_details(self):
+        if self.proj_type == "Fermentation":
+            location_dict = dict(
+                project="B1",
+                proj_id="B2",
+                proj_type="B3",
+                run_notes="A5",
+                source="A20",
+                total_greiner="A23",
+                total_proxiplates="A24",
+                pd="A21",
+                total_pd="A22",
+                cell_resus="C42",
+                dbi_vol="H42",
+                dbii_vol="E52",
+                dbi_vol_total="F20",
+                dbii_vol_total="F22",
+                dil_vol_1="D52",
+                dil_vol_2="D53",
+                dil_vol_3="D54",
+                dil_vol_4="D55",
+                pd_1_spike="C43",
+                pd_2_spike="C44",
+                pd_3_spike="C45",
+                pd_4_spike="C46",
+                pd_1_vol="H43",
+                pd_2_vol="H44",
+                pd_3_vol="H45",
+                pd_4_vol="H46",
+                standard_total_vol="F34",
+                standard_total_stock="F33",
+                standard_total_dbi="F32",
+                standard_stock_conc="C30",
+                standard_stock_mw="E30",
+                standard_conc_1="B32",
+                standard_conc_2="B33",
+                standard_conc_3="B34",
+                standard_conc_4="B35",
+                standard_conc_5="B36",
+                standard_conc_6="B37",
+                standard_data=(35, 9),
+                # reagent_details=(45, 2),
+                calced_vols=(52, 10),
+                folds=(52, 9),
+                assays=(62, 2),
+                pd_vols_data=(52, 13)
+            )
+            # wb = load_workbook(r"L:\High Throughput Screening\Personnel\Matthew Currie\Standard Protocol_FER_tabs.xlsx")
+            template_file = r"templates/Standard Protocol_FER_tabs.xlsx"
+        else:
+            location_dict = dict(
+                project="B1",
+                proj_id="B2",
+                proj_type="B3",
+                run_notes="A5",
+                source="B19",
+                total_greiner="B20",
+                total_proxiplates="B21",
+                cell_resus="C36",
+                dbi_vol="G36",
+                dbii_vol="E39",
+                dbi_vol_total="J19",
+                dbii_vol_total="J21",
+                dil_vol_1="D39",
+                dil_vol_2="D40",
+                dil_vol_3="D41",
+                dil_vol_4="D42",
+                standard_total_vol="F28",
+                standard_total_stock="F27",
+                standard_total_dbi="F26",
+                standard_stock_conc="C24",
+                standard_stock_mw="E24",
+                standard_conc_1="B26",
+                standard_conc_2="B27",
+                standard_conc_3="B28",
+                standard_conc_4="B29",
+                standard_conc_5="B30",
+                standard_conc_6="B31",
+                standard_data=(29, 9),
+                # reagent_details=(45, 2),
+                calced_vols=(39, 11),
+                folds=(39, 10),
+                assays=(45, 2),
+                # assay_db=(22, 10)
+            )
+
+            # wb = load_workbook(r"L:\High Throughput Screening\Personnel\Matthew Currie\Standard Protocol_SSF_tabs.xlsx")
+            template_file = r"templates/Standard Protocol_SSF_tabs.xlsx"
+
+        return location_dict, template_file
+
+
+class TemplatePool:
+    """
+    Keeps one parsed openpyxl workbook per template file so protocols don't re-parse the multi-tab template on
+    every write. TemplateBuilder only changes cell values on "Run Info", so a checkout snapshots that sheet's cells
+    and puts them back after the protocol is saved, leaving the pooled workbook as loaded.
+    """
+    def __init__(self):
+        self.templates = {}
+        self.lock = threading.Lock()
+
+    def get_entry(self, template_file):
+        template_key = os.path.abspath(template_file)
+        mtime = os.path.getmtime(template_file)
+        with self.lock:
+            entry = self.templates.get(template_key)
+            if entry is None or entry['mtime'] != mtime:
+                entry = dict(mtime=mtime, workbook=load_workbook(template_file), lock=threading.Lock())
+                self.templates[template_key] = entry
+        return entry
+
+    @contextmanager
+    def checkout(self, template_file, location_dict):
+        entry = self.get_entry(template_file)
+        with entry['lock']:
+            wb = entry['workbook']
+            ws = wb['Run Info']
+            original_cells = {key: cell.value for key, cell in ws._cells.items()}
+            # openpyxl records the column outline level while saving, put it back so every save writes identical sheets
+            original_outlines = [sheet.column_dimensions.max_outline for sheet in wb.worksheets]
+            try:
+                yield dict(location_dict=location_dict, workbook=wb, worksheet=ws)
+            finally:
+                for sheet, outline_level in zip(wb.worksheets, original_outlines):
+                    sheet.column_dimensions.max_outline = outline_level
+                for key, cell in list(ws._cells.items()):
+                    if key not in original_cells:
+                        del ws._cells[key]
+                    elif cell.value is not original_cells[key]:
+                        cell.value = original_cells[key]
+
+    def clear(self):
+        with self.lock:
+            self.templates.clear()
+
+
+TEMPLATE_POOL = TemplatePool()
@@ -0,0 +1,195 @@
+import os
+import re
+import threading
+import zipfile
+from math import isfinite
+from numbers import Integral, Real
+from xml.sax.saxutils import escape
+from openpyxl.utils.cell import coordinate_from_string, column_index_from_string, get_column_letter, range_boundaries
+
+ROW_PATTERN = re.compile(r'<row\b[^>]*?(?:/>|>.*?</row>)', re.S)
+CELL_PATTERN = re.compile(r'<c\b[^>]*?(?:/>|>.*?</c>)', re.S)
+OPEN_TAG_PATTERN = re.compile(r'<(?:row|c)\b[^>]*?(?=/?>)', re.S)
+ATTR_PATTERN = re.compile(r'([\w:]+)="([^"]*)"')
+SHEET_DATA_PATTERN = re.compile(r'<sheetData\s*/>|<sheetData>(.*?)</sheetData>', re.S)
+DIMENSION_PATTERN = re.compile(r'<dimension ref="([^"]*)"\s*/>')
+CALC_PR_PATTERN = re.compile(r'<calcPr\b([^>]*?)/>')
+CALC_CHAIN_REL_PATTERN = re.compile(r'<Relationship\b[^>]*?Target="[^"]*calcChain\.xml"[^>]*?/>')
+CALC_CHAIN_TYPE_PATTERN = re.compile(r'<Override\b[^>]*?PartName="/xl/calcChain\.xml"[^>]*?/>')
+
+WORKBOOK_PART = 'xl/workbook.xml'
+WORKBOOK_RELS_PART = 'xl/_rels/workbook.xml.rels'
+CONTENT_TYPES_PART = '[Content_Types].xml'
+CALC_CHAIN_PART = 'xl/calcChain.xml'
+
+
+def tag_attributes(xml):
+    return dict(ATTR_PATTERN.findall(OPEN_TAG_PATTERN.match(xml).group(0)))
+
+
+def render_attributes(attributes):
+    return ''.join(f' {name}="{value}"' for name, value in attributes.items())
+
+
+def render_cell(row, column, value, attributes=None):
+    # Keeps the template's style (and any other attributes) of the cell, only the value and its type change
+    attributes = {
+        name: attr_value for name, attr_value in (attributes or {}).items() if name not in ('r', 't')
+    }
+    attributes = dict(r=f"{get_column_letter(column)}{row}", **attributes)
+    if value is None or value == '' or (isinstance(value, Real) and not isfinite(value)):
+        return f"<c{render_attributes(attributes)}/>"
+    if isinstance(value, bool):
+        attributes['t'] = 'b'
+        content = f"<v>{int(value)}</v>"
+    elif isinstance(value, Integral):
+        content = f"<v>{int(value)}</v>"
+    elif isinstance(value, Real):
+        content = f"<v>{float(value)!r}</v>"
+    elif isinstance(value, str) and value.startswith('=') and len(value) > 1:
+        content = f"<f>{escape(value[1:])}</f>"
+    else:
+        attributes['t'] = 'inlineStr'
+        content = f'<is><t xml:space="preserve">{escape(str(value))}</t></is>'
+    return f"<c{render_attributes(attributes)}>{content}</c>"
+
+
+class SheetRow:
+    def __init__(self, xml):
+        self.xml = xml
+        self.attributes = tag_attributes(xml)
+        self.number = int(self.attributes['r'])
+        self.cells = {}
+        for cell_xml in CELL_PATTERN.findall(xml):
+            column, row = coordinate_from_string(tag_attributes(cell_xml)['r'])
+            self.cells[column_index_from_string(column)] = cell_xml
+
+    def render(self, writes):
+        if not writes:
+            return self.xml
+        cells = dict(self.cells)
+        for column, value in writes.items():
+            original = cells.get(column)
+            attributes = tag_attributes(original) if original else None
+            cells[column] = render_cell(self.number, column, value, attributes)
+        # spans is only an optimization hint and may no longer cover the row
+        attributes = {name: value for name, value in self.attributes.items() if name != 'spans'}
+        body = ''.join(cells[column] for column in sorted(cells))
+        return f"<row{render_attributes(attributes)}>{body}</row>"
+
+
+class XlsxPatcher:
+    """
+    Writes protocols by patching the template's xlsx archive directly. Only the sheet XML of "Run Info" is
+    re-rendered (rows that receive a value), workbook.xml is flagged to recalculate on open and the calculation
+    chain is dropped since overwritten formula cells would otherwise still be listed in it. All other members are
+    copied as they are in the template.
+    """
+    def __init__(self, template_file, sheet_name='Run Info'):
+        self.template_file = template_file
+        self.sheet_name = sheet_name
+        with zipfile.ZipFile(template_file) as archive:
+            self.members = [(info, archive.read(info.filename)) for info in archive.infolist()]
+        self.parts = {info.filename: data for info, data in self.members}
+        self.sheet_part = self.find_sheet_part()
+
+        sheet_xml = self.parts[self.sheet_part].decode('utf-8')
+        sheet_data = SHEET_DATA_PATTERN.search(sheet_xml)
+        self.sheet_head = sheet_xml[:sheet_data.start()]
+        self.sheet_tail = sheet_xml[sheet_data.end():]
+        self.rows = {}
+        for row_xml in ROW_PATTERN.findall(sheet_data.group(1) or ''):
+            row = SheetRow(row_xml)
+            self.rows[row.number] = row
+
+        self.workbook_xml = self.patch_workbook(self.parts[WORKBOOK_PART].decode('utf-8'))
+        self.workbook_rels_xml = CALC_CHAIN_REL_PATTERN.sub('', self.parts[WORKBOOK_RELS_PART].decode('utf-8'))
+        self.content_types_xml = CALC_CHAIN_TYPE_PATTERN.sub('', self.parts[CONTENT_TYPES_PART].decode('utf-8'))
+
+    def find_sheet_part(self):
+        workbook_xml = self.parts[WORKBOOK_PART].decode('utf-8')
+        rels_xml = self.parts[WORKBOOK_RELS_PART].decode('utf-8')
+        rel_id = None
+        for sheet in re.findall(r'<sheet\b[^>]*?/>', workbook_xml):
+            attributes = dict(ATTR_PATTERN.findall(sheet))
+            if attributes.get('name') == escape(self.sheet_name, {'"': '&quot;'}):
+                rel_id = attributes['r:id']
+        if rel_id is None:
+            raise KeyError(f"Worksheet {self.sheet_name} does not exist in {self.template_file}")
+        for rel in re.findall(r'<Relationship\b[^>]*?/>', rels_xml):
+            attributes = dict(ATTR_PATTERN.findall(rel))
+            if attributes['Id'] == rel_id:
+                target = attributes['Target']
+                return target.lstrip('/') if target.startswith('/') else f"xl/{target}"
+        raise KeyError(f"No relationship {rel_id} in {self.template_file}")
+
+    @staticmethod
+    def patch_workbook(workbook_xml):
+        def full_calc(match):
+            attributes = re.sub(r'\s*fullCalcOnLoad="[^"]*"', '', match.group(1))
+            return f'<calcPr{attributes} fullCalcOnLoad="1"/>'
+        return CALC_PR_PATTERN.sub(full_calc, workbook_xml)
+
+    def render_sheet(self, cell_writes):
+        row_writes = {}
+        for (row, column), value in cell_writes:
+            row_writes.setdefault(row, {})[column] = value
+
+        rows = []
+        for number in sorted(set(self.rows) | set(row_writes)):
+            row = self.rows.get(number) or SheetRow(f'<row r="{number}"/>')
+            rows.append(row.render(row_writes.get(number)))
+
+        head = self.sheet_head
+        if row_writes:
+            head = DIMENSION_PATTERN.sub(lambda match: self.dimension(match.group(1), cell_writes), head, count=1)
+        return f"{head}<sheetData>{''.join(rows)}</sheetData>{self.sheet_tail}"
+
+    @staticmethod
+    def dimension(ref, cell_writes):
+        min_col, min_row, max_col, max_row = range_boundaries(ref if ':' in ref else f"{ref}:{ref}")
+        for (row, column), value in cell_writes:
+            min_row, max_row = min(min_row, row), max(max_row, row)
+            min_col, max_col = min(min_col, column), max(max_col, column)
+        return (f'<dimension ref="{get_column_letter(min_col)}{min_row}:'
+                f'{get_column_letter(max_col)}{max_row}"/>')
+
+    def write(self, cell_writes, output_file):
+        """
+        cell_writes is an ordered list of ((row, column), value), later writes to the same cell win like they do
+        when assigning through openpyxl.
+        """
+        replaced = {
+            self.sheet_part: self.render_sheet(cell_writes).encode('utf-8'),
+            WORKBOOK_PART: self.workbook_xml.encode('utf-8'),
+            WORKBOOK_RELS_PART: self.workbook_rels_xml.encode('utf-8'),
+            CONTENT_TYPES_PART: self.content_types_xml.encode('utf-8'),
+        }
+        with zipfile.ZipFile(output_file, 'w') as archive:
+            for info, data in self.members:
+                if info.filename == CALC_CHAIN_PART:
+                    continue
+                archive.writestr(info, replaced.get(info.filename, data))
+
+
+class PatcherCache:
+    def __init__(self):
+        self.patchers = {}
+        self.lock = threading.Lock()
+
+    def get(self, template_file, sheet_name='Run Info'):
+        template_key = (os.path.abspath(template_file), sheet_name)
+        mtime = os.path.getmtime(template_file)
+        with self.lock:
+            patcher, patcher_mtime = self.patchers.get(template_key, (None, None))
+            if patcher is None or patcher_mtime != mtime:
+                patcher = XlsxPatcher(template_file, sheet_name)
+                self.patchers[template_key] = (patcher, mtime)
+        return patcher
+
+    def clear(self):
+        with self.lock:
+            self.patchers.clear()
+
+
+PATCHER_CACHE = PatcherCache()